@@ -35,12 +35,12 @@ if admin.site.is_registered(User):  # pragma: no branch
 
 
 class MicrosoftAccountAdmin(*base_admin):
-    readonly_fields = ("microsoft_id",)
+    readonly_fields = ("microsoft_id", "object_id")
 
 
 class MicrosoftAccountInlineAdmin(admin.StackedInline):
     model = MicrosoftAccount
-    readonly_fields = ("microsoft_id",)
+    readonly_fields = ("microsoft_id", "object_id")
 
 
 class XboxLiveAccountAdmin(*base_admin):
@@ -10,12 +10,16 @@ class MicrosoftAuthConfig(AppConfig):
     name = "microsoft_auth"
     verbose_name = "Microsoft Auth"
 
+    def ready(self):
+        from . import signals  # noqa
+
 
 @register()
 def microsoft_auth_validator(app_configs, **kwargs):
     from django.contrib.sites.models import Site
 
     from .conf import HOOK_SETTINGS, config
+    from .utils import get_hook_paths
 
     errors = []
 
@@ -93,13 +97,13 @@ def microsoft_auth_validator(app_configs, **kwargs):
 
     for hook_setting_name in HOOK_SETTINGS:
         hook_setting = getattr(config, hook_setting_name)
-        if hook_setting != "":
-            parts = hook_setting.rsplit(".", 1)
+        for hook_path in get_hook_paths(hook_setting):
+            parts = hook_path.rsplit(".", 1)
 
             if len(parts) != 2:
                 errors.append(
                     Critical(
-                        ("{} is not a valid python path".format(hook_setting)),
+                        ("{} is not a valid python path".format(hook_path)),
                         id="microsoft_auth.E002",
                     )
                 )
@@ -122,7 +126,7 @@ def microsoft_auth_validator(app_configs, **kwargs):
             except AttributeError:
                 errors.append(
                     Critical(
-                        ("{} does not exist".format(hook_setting)),
+                        ("{} does not exist".format(hook_path)),
                         id="microsoft_auth.E004",
                     )
                 )
@@ -131,7 +135,7 @@ def microsoft_auth_validator(app_configs, **kwargs):
             if not callable(function):
                 errors.append(
                     Critical(
-                        ("{} is not a callable".format(hook_setting)),
+                        ("{} is not a callable".format(hook_path)),
                         id="microsoft_auth.E005",
                     )
                 )
@@ -1,17 +1,112 @@
 import logging
+import random
+import time
 
+from asgiref.sync import sync_to_async
 from django.contrib.auth import get_user_model
 from django.contrib.auth.backends import ModelBackend
-
-from .client import MicrosoftClient
-from .conf import LOGIN_TYPE_XBL
+from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import IntegrityError, OperationalError, transaction
+from django.db.models import Q
+
+from .client import AsyncMicrosoftClient, MicrosoftClient
+from .conf import (
+    CACHE_KEY_USER,
+    LOGIN_CONFLICT_RETRIES,
+    LOGIN_LOCK_BACKOFF,
+    LOGIN_LOCK_ERRORS,
+    LOGIN_LOCK_RETRIES,
+    LOGIN_TYPE_XBL,
+    pinned_config,
+)
 from .models import MicrosoftAccount, XboxLiveAccount
-from .utils import get_hook
+from .tokens import save_token
+from .utils import get_hooks, get_username, split_name
 
 logger = logging.getLogger("django")
 User = get_user_model()
 
 
+def is_lock_error(error):
+    """Returns whether a database error means the transaction was rolled
+    back because of concurrent ones and can be started over"""
+
+    cause = error.__cause__
+    code = getattr(cause, "pgcode", None) or getattr(cause, "sqlstate", None)
+    if code is None and cause is not None and cause.args:
+        code = cause.args[0]
+    # SQLite has no error codes in its exceptions
+    return code in LOGIN_LOCK_ERRORS or "locked" in str(error)
+
+
+def get_user_cache_key(user_id):
+    return CACHE_KEY_USER.format(user_id)
+
+
+# accounts cached with the user, by the name of their relation to it
+CACHED_ACCOUNTS = {
+    "microsoft_account": MicrosoftAccount,
+    "xbox_live_account": XboxLiveAccount,
+}
+
+
+def _get_snapshot(instance):
+    if instance is None:
+        return None
+    return {
+        field.attname: getattr(instance, field.attname)
+        for field in instance._meta.concrete_fields
+    }
+
+
+def _from_snapshot(model, snapshot):
+    # fields added since the snapshot was cached are loaded on access
+    names = [
+        field.attname
+        for field in model._meta.concrete_fields
+        if field.attname in snapshot
+    ]
+    return model.from_db(
+        model._default_manager.db, names, [snapshot[name] for name in names]
+    )
+
+
+def get_user_snapshot(user):
+    """Returns the field values of user and its linked accounts, which is
+    what `MicrosoftAuthenticationBackend.get_user` caches instead of
+    pickling the user"""
+
+    snapshot = {"user": _get_snapshot(user)}
+    for name in CACHED_ACCOUNTS:
+        try:
+            snapshot[name] = _get_snapshot(getattr(user, name))
+        except ObjectDoesNotExist:
+            snapshot[name] = None
+    return snapshot
+
+
+def load_user_snapshot(snapshot):
+    """Rebuilds the user returned by `get_user_snapshot`, with its linked
+    accounts already loaded"""
+
+    user = _from_snapshot(User, snapshot["user"])
+    for name, model in CACHED_ACCOUNTS.items():
+        if snapshot.get(name) is not None:
+            setattr(user, name, _from_snapshot(model, snapshot[name]))
+        else:
+            # no account, without a query to find out
+            User._meta.get_field(name).set_cached_value(user, None)
+    return user
+
+
+def clear_cached_user(user_id):
+    """Removes the user cached by `MicrosoftAuthenticationBackend.get_user`"""
+
+    if user_id is not None:
+        cache.delete(get_user_cache_key(user_id))
+
+
 class MicrosoftAuthenticationBackend(ModelBackend):
     """Authentication backend to authenticate a user against their Microsoft
     Uses Microsoft's Graph OAuth and XBL servers to authentiate."""
@@ -47,10 +142,92 @@ class MicrosoftAuthenticationBackend(ModelBackend):
                 user = self._authenticate_user()
 
         if user is not None:
+            self._store_token(user)
             self._call_hook(user)
 
         return user
 
+    def get_user(self, user_id):
+        """Returns the user for an authenticated request, from the Django
+        cache if MICROSOFT_AUTH_USER_CACHE_TIMEOUT is set
+
+        Cached users come with their Microsoft and Xbox Live accounts, so
+        `user.microsoft_account` and `user.xbox_live_account` do not need
+        another query either. Only their field values are cached (see
+        `get_user_snapshot`), not pickled model instances.
+        """
+
+        timeout = self.config.MICROSOFT_AUTH_USER_CACHE_TIMEOUT
+        if not timeout:
+            return super().get_user(user_id)
+
+        key = get_user_cache_key(user_id)
+        snapshot = cache.get(key)
+        if snapshot is not None:
+            user = load_user_snapshot(snapshot)
+        else:
+            try:
+                user = User._default_manager.select_related(*CACHED_ACCOUNTS).get(
+                    pk=user_id
+                )
+            except User.DoesNotExist:
+                return None
+            cache.set(key, get_user_snapshot(user), timeout)
+
+        return user if self.user_can_authenticate(user) else None
+
+    async def aget_user(self, user_id):
+        """Async version of `get_user`, used by
+        `django.contrib.auth.aget_user` on Django 5.2+, with the same cache"""
+
+        return await sync_to_async(self.get_user)(user_id)
+
+    async def aauthenticate(self, request, code=None):
+        """
+        Async version of `authenticate`, used by the async callback views
+        (and `django.contrib.auth.aauthenticate` on Django 5.2+)
+
+        Requests to Microsoft and Xbox Live do not block, only reading the
+        config and looking up or creating the user is run in a thread.
+        """
+
+        # the config is read from a snapshot resolved in a thread
+        async with pinned_config():
+            # looks up the current Site
+            self.microsoft = await sync_to_async(AsyncMicrosoftClient)(request=request)
+
+            user = None
+            if code is not None:
+                # fetch OAuth token
+                token = await self.microsoft.afetch_token(code=code)
+
+                # validate permission scopes
+                if "access_token" in token and self.microsoft.valid_scopes(
+                    token["scope"]
+                ):
+                    user = await self._aauthenticate_user()
+
+            if user is not None:
+                await sync_to_async(self._store_token)(user)
+                await sync_to_async(self._call_hook)(user)
+
+            return user
+
+    async def _aauthenticate_user(self):
+        if self.config.MICROSOFT_AUTH_LOGIN_TYPE == LOGIN_TYPE_XBL:
+            xbox_token = await self.microsoft.afetch_xbox_token()
+
+            if "Token" in xbox_token:
+                response = await self.microsoft.aget_xbox_profile()
+                return await sync_to_async(self._get_user_from_xbox)(response)
+        else:
+            claims = await self.microsoft.aget_claims()
+
+            if claims is not None:
+                return await sync_to_async(self._get_user_from_microsoft)(claims)
+
+        return None
+
     def _authenticate_user(self):
         if self.config.MICROSOFT_AUTH_LOGIN_TYPE == LOGIN_TYPE_XBL:
             return self._authenticate_xbox_user()
@@ -73,7 +250,42 @@ class MicrosoftAuthenticationBackend(ModelBackend):
 
         return None
 
+    def _retry_on_conflict(self, function, data):
+        """Calls function(data) in a transaction, starting over if it
+        conflicts with a concurrent login for the same account
+
+        Accounts and users are unique by their ID and username, so the
+        login that inserts second gets an IntegrityError and will find the
+        rows of the one that won when it tries again. Transactions the
+        database rolled back because of concurrent ones (deadlocks,
+        serialization failures, SQLite's locked database) are started over
+        too, up to LOGIN_LOCK_RETRIES times with a growing random wait.
+        """
+
+        conflicts = lock_errors = 0
+        while True:
+            try:
+                with transaction.atomic():
+                    return function(data)
+            except IntegrityError as e:
+                conflicts += 1
+                if conflicts == LOGIN_CONFLICT_RETRIES:
+                    raise
+                logger.info(
+                    "login conflicted with another login, retrying: {}".format(e)
+                )
+            except OperationalError as e:
+                lock_errors += 1
+                if lock_errors == LOGIN_LOCK_RETRIES or not is_lock_error(e):
+                    raise
+                logger.info("login could not get a lock, retrying: {}".format(e))
+                # random, so the logins that collided do not collide again
+                time.sleep(random.uniform(0, LOGIN_LOCK_BACKOFF * 2**lock_errors))
+
     def _get_user_from_xbox(self, data):
+        return self._retry_on_conflict(self._get_or_create_xbox_user, data)
+
+    def _get_or_create_xbox_user(self, data):
         """Retrieves existing Django user or creates
         a new one from Xbox Live profile data"""
         user = None
@@ -89,7 +301,7 @@ class MicrosoftAuthenticationBackend(ModelBackend):
                 and user.username != xbox_user.gamertag
             ):
                 user.username = xbox_user.gamertag
-                user.save()
+                user.save(update_fields=["username"])
 
         return user
 
@@ -97,16 +309,18 @@ class MicrosoftAuthenticationBackend(ModelBackend):
         xbox_user = None
 
         try:
-            xbox_user = XboxLiveAccount.objects.get(xbox_id=data["xid"])
+            xbox_user = XboxLiveAccount.objects.select_related("user").get(
+                xbox_id=data["xid"]
+            )
             # update Gamertag since they can change over time
             if xbox_user.gamertag != data["gtg"]:
                 xbox_user.gamertag = data["gtg"]
-                xbox_user.save()
+                xbox_user.save(update_fields=["gamertag"])
         except XboxLiveAccount.DoesNotExist:
             if self.config.MICROSOFT_AUTH_AUTO_CREATE:
-                # create new Xbox Live Account
+                # new Xbox Live Account, saved with its user by
+                # _verify_xbox_user
                 xbox_user = XboxLiveAccount(xbox_id=data["xid"], gamertag=data["gtg"])
-                xbox_user.save()
 
         return xbox_user
 
@@ -116,11 +330,17 @@ class MicrosoftAuthenticationBackend(ModelBackend):
             user.save()
 
             xbox_user.user = user
-            xbox_user.save()
+            if xbox_user.pk is None:
+                xbox_user.save()
+            else:
+                xbox_user.save(update_fields=["user"])
 
     def _get_user_from_microsoft(self, data):
+        return self._retry_on_conflict(self._get_or_create_microsoft_user, data)
+
+    def _get_or_create_microsoft_user(self, data):
         """Retrieves existing Django user or creates
-        a new one from Xbox Live profile data"""
+        a new one from Microsoft profile data"""
         user = None
         microsoft_user = self._get_microsoft_user(data)
 
@@ -130,15 +350,28 @@ class MicrosoftAuthenticationBackend(ModelBackend):
         return user
 
     def _get_microsoft_user(self, data):
-        microsoft_user = None
-
-        try:
-            microsoft_user = MicrosoftAccount.objects.get(microsoft_id=data["sub"])
-        except MicrosoftAccount.DoesNotExist:
+        lookup = Q(microsoft_id=data["sub"])
+        if data.get("oid"):
+            # or imported ahead of the first login, when only the directory
+            # object ID of the account is known
+            lookup |= Q(object_id=data["oid"], microsoft_id__isnull=True)
+
+        # at most one of each, the account with the sub wins
+        accounts = sorted(
+            MicrosoftAccount.objects.select_related("user").filter(lookup),
+            key=lambda account: account.microsoft_id != data["sub"],
+        )
+        microsoft_user = accounts[0] if accounts else None
+
+        if microsoft_user is None:
             if self.config.MICROSOFT_AUTH_AUTO_CREATE:
-                # create new Microsoft Account
+                # new Microsoft Account, saved with its user by
+                # _verify_microsoft_user
                 microsoft_user = MicrosoftAccount(microsoft_id=data["sub"])
-                microsoft_user.save()
+        elif microsoft_user.microsoft_id != data["sub"]:
+            # first login of an imported account
+            microsoft_user.microsoft_id = data["sub"]
+            microsoft_user.save(update_fields=["microsoft_id"])
 
         return microsoft_user
 
@@ -146,40 +379,32 @@ class MicrosoftAuthenticationBackend(ModelBackend):
         user = microsoft_user.user
 
         if user is None:
-            fullname = data.get("name")
-            first_name, last_name = "", ""
-            if fullname is not None:
-                if ", " in fullname:
-                    last_name, first_name = fullname.split(", ")
-                elif " " in fullname:
-                    first_name, last_name = fullname.split(" ", 1)
-                elif "." in fullname:
-                    first_name, last_name = fullname.split(".", 1)
-                else:
-                    first_name = fullname
-
-            try:
-                # create new Django user from provided data
-                user = User.objects.get(email=data["email"])
-
-                if user.first_name == "" and user.last_name == "":
-                    user.first_name = first_name
-                    user.last_name = last_name
-                    user.save()
-            except User.DoesNotExist:
-                user = User(
-                    username=data["preferred_username"][:150],
-                    first_name=first_name,
-                    last_name=last_name,
-                    email=data["email"],
-                )
-                user.save()
-
-            existing_account = self._get_existing_microsoft_account(user)
+            first_name, last_name = split_name(data.get("name"))
+
+            # the user's current account (if any) comes with the user
+            user, created = User.objects.select_related(
+                "microsoft_account"
+            ).get_or_create(
+                email=data["email"],
+                defaults={
+                    "username": get_username(data["preferred_username"]),
+                    "first_name": first_name,
+                    "last_name": last_name,
+                },
+            )
+            if not created and user.first_name == "" and user.last_name == "":
+                user.first_name = first_name
+                user.last_name = last_name
+                user.save(update_fields=["first_name", "last_name"])
+
+            # a user that was just created cannot have an account yet
+            existing_account = None
+            if not created:
+                existing_account = self._get_existing_microsoft_account(user)
             if existing_account is not None:
                 if self.config.MICROSOFT_AUTH_AUTO_REPLACE_ACCOUNTS:
                     existing_account.user = None
-                    existing_account.save()
+                    existing_account.save(update_fields=["user"])
                 else:
                     logger.warning(
                         (
@@ -188,23 +413,42 @@ class MicrosoftAuthenticationBackend(ModelBackend):
                             "is False"
                         ).format(user.email)
                     )
+                    if microsoft_user.pk is None:
+                        microsoft_user.save()
                     return None
 
             microsoft_user.user = user
-            microsoft_user.save()
+            if microsoft_user.pk is None:
+                microsoft_user.save()
+            else:
+                microsoft_user.save(update_fields=["user"])
 
         return user
 
     def _get_existing_microsoft_account(self, user):
         try:
-            return MicrosoftAccount.objects.get(user=user)
+            return user.microsoft_account
         except MicrosoftAccount.DoesNotExist:
             return None
 
+    def _store_token(self, user):
+        if (
+            not self.config.MICROSOFT_AUTH_STORE_TOKENS
+            or self.config.MICROSOFT_AUTH_LOGIN_TYPE == LOGIN_TYPE_XBL
+        ):
+            return
+
+        account = self._get_existing_microsoft_account(user)
+        if account is not None:
+            save_token(account, self.microsoft.token)
+
     def _call_hook(self, user):
-        function = get_hook("MICROSOFT_AUTH_AUTHENTICATE_HOOK")
-        if function is not None:
+        hooks = get_hooks("MICROSOFT_AUTH_AUTHENTICATE_HOOK")
+        if hooks:
             if self.config.MICROSOFT_AUTH_LOGIN_TYPE == LOGIN_TYPE_XBL:
-                function(user, self.microsoft.xbox_token)
+                token = self.microsoft.xbox_token
             else:
-                function(user, self.microsoft.token)
+                token = self.microsoft.token
+
+            for function in hooks:
+                function(user, token)
@@ -1,25 +1,179 @@
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import copy
+from functools import partial
+import hashlib
+from itertools import islice
 import json
 import logging
+import os
+import threading
+import time
+from urllib.parse import quote_plus, urlencode
 
+from asgiref.sync import sync_to_async
 from django.contrib.sites.models import Site
 from django.core.cache import cache
 from django.urls import reverse
+from django.utils import timezone
 import jwt
 from jwt.algorithms import RSAAlgorithm
-import requests
 from requests_oauthlib import OAuth2Session
 
+from . import transport
 from .conf import (
+    AUTH_URL_CACHE_MAX_SIZE,
+    AUTH_URL_CACHE_TIMEOUT,
     CACHE_KEY_JWKS,
+    CACHE_KEY_JWKS_REFRESH,
     CACHE_KEY_OPENID,
-    CACHE_TIMEOUT,
+    CACHE_KEY_UNKNOWN_KID,
+    CACHE_REFRESH_AHEAD,
+    JWKS_REFRESH_INTERVAL,
+    KEY_CACHE_MAX_SIZE,
+    KEY_CACHE_TIMEOUT,
     LOGIN_TYPE_XBL,
+    METADATA_SNAPSHOT_VERSION,
+    UNKNOWN_KID_TIMEOUT,
     config,
 )
+from .metadata import (
+    MetadataRefresher,
+    aget_metadata,
+    get_entry,
+    get_json,
+    get_metadata,
+    needs_refresh,
+    refresh,
+    set_default,
+    set_metadata,
+    stats,
+)
 from .utils import get_scheme
 
 logger = logging.getLogger("django")
 
+TokenValidationResult = namedtuple(
+    "TokenValidationResult", ["index", "token", "claims", "error"]
+)
+
+
+class PublicKeyCache:
+    """Process-local registry of parsed JWKS public keys, keyed by the
+    metadata namespace (authority and tenant) and `kid`
+
+    Sits in front of the `CACHE_KEY_JWKS` Django cache entries so validating
+    an id_token does not need a cache round trip or a JWK parse once the key
+    has been seen. Entries expire after `timeout` seconds and the least
+    recently used key is evicted once `max_size` keys are held, whichever
+    tenants they belong to.
+    """
+
+    def __init__(self, timeout=KEY_CACHE_TIMEOUT, max_size=KEY_CACHE_MAX_SIZE):
+        self.timeout = timeout
+        self.max_size = max_size
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, namespace, kid):
+        with self._lock:
+            entry = self._keys.get((namespace, kid))
+            if entry is None:
+                return None
+
+            public_key, expires = entry
+            if expires <= time.monotonic():
+                del self._keys[(namespace, kid)]
+                return None
+
+            self._keys.move_to_end((namespace, kid))
+            return public_key
+
+    def set(self, namespace, kid, public_key):
+        with self._lock:
+            self._keys[(namespace, kid)] = (
+                public_key,
+                time.monotonic() + self.timeout,
+            )
+            self._keys.move_to_end((namespace, kid))
+
+            while len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+
+    def clear(self, namespace=None):
+        """Drops all keys, or only the keys for namespace if given"""
+
+        with self._lock:
+            if namespace is None:
+                self._keys.clear()
+                return
+
+            for key in [key for key in self._keys if key[0] == namespace]:
+                del self._keys[key]
+
+    def __len__(self):
+        return len(self._keys)
+
+
+public_key_cache = PublicKeyCache()
+
+
+class ClaimsCache:
+    """Process-local LRU of verified id_token claims, keyed by a hash of the
+    client ID and the id_token
+
+    Lets `MicrosoftClient.get_claims` skip the signature check for an
+    id_token it has already verified. Entries expire with the id_token
+    (its `exp` claim) and at most MICROSOFT_AUTH_CLAIMS_CACHE_SIZE are
+    kept, so the cache is disabled by default.
+    """
+
+    def __init__(self):
+        self._claims = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_key(client_id, token):
+        return hashlib.sha256(client_id.encode("utf8") + b"." + token).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._claims.get(key)
+            if entry is None:
+                return None
+
+            claims, expires = entry
+            if expires <= time.time():
+                del self._claims[key]
+                return None
+
+            self._claims.move_to_end(key)
+        # callers are free to modify the claims they get back
+        return copy.deepcopy(claims)
+
+    def set(self, key, claims):
+        max_size = config.MICROSOFT_AUTH_CLAIMS_CACHE_SIZE
+        expires = claims.get("exp")
+        if max_size <= 0 or not isinstance(expires, (int, float)):
+            return
+
+        with self._lock:
+            self._claims[key] = (copy.deepcopy(claims), expires)
+            self._claims.move_to_end(key)
+
+            while len(self._claims) > max_size:
+                self._claims.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._claims.clear()
+
+    def __len__(self):
+        return len(self._claims)
+
+
+claims_cache = ClaimsCache()
+
 
 class MicrosoftClient(OAuth2Session):
     """Simple Microsoft OAuth2 Client to authenticate them
@@ -33,7 +187,7 @@ class MicrosoftClient(OAuth2Session):
     https://developer.microsoft.com/en-us/graph/docs/get-started/rest
     """
 
-    _config_url = "https://login.microsoftonline.com/{tenant}/v2.0/.well-known/openid-configuration"  # noqa
+    _config_url = "{authority}/{tenant}/v2.0/.well-known/openid-configuration"
 
     _xbox_authorization_url = "https://login.live.com/oauth20_authorize.srf"
     _xbox_token_url = "https://user.auth.xboxlive.com/user/authenticate"  # nosec
@@ -41,6 +195,12 @@ class MicrosoftClient(OAuth2Session):
 
     xbox_token = {}
 
+    # Content-type MUST be json for Xbox Live
+    _xbox_headers = {
+        "Content-type": "application/json",
+        "Accept": "application/json",
+    }
+
     config = None
 
     # required OAuth scopes
@@ -59,96 +219,83 @@ class MicrosoftClient(OAuth2Session):
             **kwargs,
         )
 
+        setup_metadata()
+        transport.mount(self)
         if self.config.MICROSOFT_AUTH_PROXIES:
             self.proxies = self.config.MICROSOFT_AUTH_PROXIES
 
     def _get_scopes(self):
-        scope = " ".join(self.SCOPE_MICROSOFT)
-
-        if self.config.MICROSOFT_AUTH_LOGIN_TYPE == LOGIN_TYPE_XBL:
-            scope = " ".join(self.SCOPE_XBL)
-
-        extra_scopes = self.config.MICROSOFT_AUTH_EXTRA_SCOPES
-        scope = "{} {}".format(scope, extra_scopes).strip()
-
-        return scope
+        return get_scopes()
 
     def _get_redirect_uri(self, request):
-        try:
-            current_site = Site.objects.get_current(request)
-        except Site.DoesNotExist:
-            current_site = Site.objects.first()
-
-        domain = current_site.domain
-        callback = reverse("microsoft_auth:auth-callback")
-        redirect = reverse("microsoft_auth:from-auth-redirect")
-        if not request or "redirect" not in request.path:
-            path = callback
-        else:
-            path = redirect
-
-        return f"{get_scheme(request, self.config)}://{domain}{path}"
+        return get_redirect_uri(request)
 
     @property
     def openid_config(self):
-        config = cache.get(CACHE_KEY_OPENID)
+        return get_openid_config(self)
 
-        if config is None:
-            config_url = self._config_url.format(
-                tenant=self.config.MICROSOFT_AUTH_TENANT_ID
-            )
-            response = self.get(config_url)
+    @property
+    def jwks(self):
+        return get_jwks(self)
 
-            if response.ok:
-                config = response.json()
-                cache.set(CACHE_KEY_OPENID, config, CACHE_TIMEOUT)
+    def _get_public_key(self, kid, jwks=None):
+        namespace = get_namespace()
+        public_key = public_key_cache.get(namespace, kid)
+        if public_key is not None:
+            return public_key
 
-        return config
+        for key in self.jwks if jwks is None else jwks:
+            if kid == key["kid"]:
+                public_key = RSAAlgorithm.from_jwk(json.dumps(key))
+                public_key_cache.set(namespace, kid, public_key)
+                break
 
-    @property
-    def jwks(self):
-        jwks = cache.get(CACHE_KEY_JWKS, [])
+        return public_key
 
-        if len(jwks) == 0:
-            jwks_uri = self.openid_config["jwks_uri"]
-            if jwks_uri is None:
-                return []
+    def _refresh_public_key(self, kid):
+        """Refreshes the JWKS to look for a key that is not known yet
 
-            response = self.get(jwks_uri)
+        kids that are still unknown after a refresh are remembered in the
+        Django cache so further tokens using them are rejected without a
+        fetch, and forced refreshes happen at most once every
+        JWKS_REFRESH_INTERVAL seconds per tenant across all nodes.
+        """
 
-            if response.ok:
-                jwks = response.json()["keys"]
-                cache.set(CACHE_KEY_JWKS, jwks, CACHE_TIMEOUT)
-        return jwks
+        namespace = get_namespace()
+        stats["unknown_kid"] += 1
+        unknown_kid_key = CACHE_KEY_UNKNOWN_KID.format(
+            hashlib.sha256("{}/{}".format(namespace, kid).encode("utf8")).hexdigest()
+        )
+        if cache.get(unknown_kid_key) is not None:
+            stats["unknown_kid_rejected"] += 1
+            return None
 
-    def get_claims(self, allow_refresh=True):
-        if self.token is None:
+        logger.warning("could not find public key for id_token, refreshing JWKS")
+        if not force_jwks_refresh(self):
             return None
 
-        token = self.token["id_token"].encode("utf8")
+        public_key = self._get_public_key(kid)
+        if public_key is None:
+            cache.set(unknown_kid_key, True, UNKNOWN_KID_TIMEOUT)
+        return public_key
 
-        kid = jwt.get_unverified_header(token)["kid"]
-        jwk = None
-        public_key = None
-        for key in self.jwks:
-            if kid == key["kid"]:
-                jwk = key
-                break
+    def _get_cached_claims(self, token):
+        """Returns the key of token in the claims cache (None if it is
+        disabled) and its cached claims, if any"""
 
-        if jwk is None:
-            if allow_refresh:
-                logger.warn(
-                    "could not find public key for id_token, " "refreshing OIDC config"
-                )
-                cache.delete(CACHE_KEY_JWKS)
-                cache.delete(CACHE_KEY_OPENID)
+        if self.config.MICROSOFT_AUTH_CLAIMS_CACHE_SIZE <= 0:
+            return None, None
 
-                return self.get_claims(allow_refresh=False)
-            else:
-                logger.warn("could not find public key for id_token")
-                return None
+        claims_key = ClaimsCache.get_key(self.config.MICROSOFT_AUTH_CLIENT_ID, token)
+        claims = claims_cache.get(claims_key)
+        if claims is not None:
+            stats["claims_cache_hit"] += 1
+        return claims_key, claims
 
-        public_key = RSAAlgorithm.from_jwk(json.dumps(jwk))
+    def _verify_claims(self, token, public_key, claims_key):
+        if public_key is None:
+            logger.warning("could not find public key for id_token")
+            return None
 
         try:
             claims = jwt.decode(
@@ -161,8 +308,31 @@ class MicrosoftClient(OAuth2Session):
             logger.warn("could not verify id_token sig: {}".format(e))
             return None
 
+        if claims_key is not None:
+            claims_cache.set(claims_key, claims)
         return claims
 
+    def get_claims(self, allow_refresh=True):
+        if self.token is None:
+            return None
+
+        token = self.token["id_token"].encode("utf8")
+        claims_key, claims = self._get_cached_claims(token)
+        if claims is not None:
+            return claims
+
+        try:
+            kid = jwt.get_unverified_header(token).get("kid")
+        except jwt.PyJWTError as e:
+            logger.warning("could not read id_token header: {}".format(e))
+            return None
+
+        public_key = self._get_public_key(kid)
+        if public_key is None and allow_refresh:
+            public_key = self._refresh_public_key(kid)
+
+        return self._verify_claims(token, public_key, claims_key)
+
     def authorization_url(self):
         """Generates Microsoft/Xbox or a Office 365 Authorization URL"""
 
@@ -170,7 +340,8 @@ class MicrosoftClient(OAuth2Session):
         if self.config.MICROSOFT_AUTH_LOGIN_TYPE == LOGIN_TYPE_XBL:
             auth_url = self._xbox_authorization_url
 
-        extra_parameters = self.config.MICROSOFT_AUTH_EXTRA_PARAMETERS
+        # copy, the config value is shared
+        extra_parameters = dict(self.config.MICROSOFT_AUTH_EXTRA_PARAMETERS)
         extra_parameters["response_mode"] = "form_post"
         built_auth_url = super().authorization_url(auth_url, **extra_parameters)
         return built_auth_url
@@ -184,6 +355,27 @@ class MicrosoftClient(OAuth2Session):
             **kwargs,
         )
 
+    def _get_xbox_token_params(self):
+        return {
+            "RelyingParty": "http://auth.xboxlive.com",
+            "TokenType": "JWT",
+            "Properties": {
+                "AuthMethod": "RPS",
+                "SiteName": "user.auth.xboxlive.com",
+                "RpsTicket": "d={}".format(self.token["access_token"]),
+            },
+        }
+
+    def _get_xbox_profile_params(self):
+        return {
+            "RelyingParty": "http://xboxlive.com",
+            "TokenType": "JWT",
+            "Properties": {
+                "UserTokens": [self.xbox_token["Token"]],
+                "SandboxId": "RETAIL",
+            },
+        }
+
     def fetch_xbox_token(self):
         """Fetches Xbox Live Auth token.
 
@@ -202,22 +394,11 @@ class MicrosoftClient(OAuth2Session):
         }
         """
 
-        # Content-type MUST be json for Xbox Live
-        headers = {
-            "Content-type": "application/json",
-            "Accept": "application/json",
-        }
-        params = {
-            "RelyingParty": "http://auth.xboxlive.com",
-            "TokenType": "JWT",
-            "Properties": {
-                "AuthMethod": "RPS",
-                "SiteName": "user.auth.xboxlive.com",
-                "RpsTicket": "d={}".format(self.token["access_token"]),
-            },
-        }
-        response = requests.post(
-            self._xbox_token_url, data=json.dumps(params), headers=headers
+        response = self.post(
+            self._xbox_token_url,
+            data=json.dumps(self._get_xbox_token_params()),
+            headers=self._xbox_headers,
+            withhold_token=True,
         )
 
         if response.status_code == 200:
@@ -252,21 +433,11 @@ class MicrosoftClient(OAuth2Session):
         """
 
         if "Token" in self.xbox_token:
-            # Content-type MUST be json for Xbox Live
-            headers = {
-                "Content-type": "application/json",
-                "Accept": "application/json",
-            }
-            params = {
-                "RelyingParty": "http://xboxlive.com",
-                "TokenType": "JWT",
-                "Properties": {
-                    "UserTokens": [self.xbox_token["Token"]],
-                    "SandboxId": "RETAIL",
-                },
-            }
-            response = requests.post(
-                self._profile_url, data=json.dumps(params), headers=headers
+            response = self.post(
+                self._profile_url,
+                data=json.dumps(self._get_xbox_profile_params()),
+                headers=self._xbox_headers,
+                withhold_token=True,
             )
 
             if response.status_code == 200:
@@ -285,3 +456,695 @@ class MicrosoftClient(OAuth2Session):
 
         # verify all require_scopes are in scopes
         return required_scopes <= scopes
+
+
+# resolved scope string and redirect URIs (keyed by site id, scheme and
+# whether the request came from the redirect views), see `clear_resolved`
+_resolved_scopes = None
+_redirect_uris = {}
+
+
+def clear_resolved():
+    """Forgets the resolved scopes and redirect URIs, called when a `Site`
+    or a setting changes"""
+
+    global _resolved_scopes
+
+    _resolved_scopes = None
+    _redirect_uris.clear()
+    authorization_url_builder.clear()
+
+
+def get_scopes():
+    """Returns the OAuth scopes to request for the configured login type"""
+
+    global _resolved_scopes
+
+    scope = _resolved_scopes
+    if scope is not None:
+        return scope
+
+    scope = " ".join(MicrosoftClient.SCOPE_MICROSOFT)
+
+    if config.MICROSOFT_AUTH_LOGIN_TYPE == LOGIN_TYPE_XBL:
+        scope = " ".join(MicrosoftClient.SCOPE_XBL)
+
+    extra_scopes = config.MICROSOFT_AUTH_EXTRA_SCOPES
+    scope = "{} {}".format(scope, extra_scopes).strip()
+
+    _resolved_scopes = scope
+    return scope
+
+
+def _get_current_site(request):
+    try:
+        return Site.objects.get_current(request)
+    except Site.DoesNotExist:
+        return Site.objects.first()
+
+
+def _is_redirect(request):
+    return request is not None and "redirect" in request.path
+
+
+def get_redirect_uri(request=None):
+    """Returns the URI Microsoft should send the user back to for request"""
+
+    site = _get_current_site(request)
+    scheme = get_scheme(request, config)
+    is_redirect = _is_redirect(request)
+
+    key = (site.pk, scheme, is_redirect)
+    redirect_uri = _redirect_uris.get(key)
+    if redirect_uri is not None:
+        return redirect_uri
+
+    if is_redirect:
+        path = reverse("microsoft_auth:from-auth-redirect")
+    else:
+        path = reverse("microsoft_auth:auth-callback")
+
+    redirect_uri = f"{scheme}://{site.domain}{path}"
+    _redirect_uris[key] = redirect_uri
+    return redirect_uri
+
+
+class AuthorizationUrlBuilder:
+    """Builds authorization URLs without creating a `MicrosoftClient`
+
+    Everything in the URL except the state is the same for every request to
+    the same site, scheme and login type, so it is URL encoded once and kept
+    for `timeout` seconds (at most `max_size` variants); building a URL is
+    then a string concatenation with the signed state.
+    """
+
+    def __init__(
+        self, timeout=AUTH_URL_CACHE_TIMEOUT, max_size=AUTH_URL_CACHE_MAX_SIZE
+    ):
+        self.timeout = timeout
+        self.max_size = max_size
+        self._parts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_key(self, request):
+        return (
+            _get_current_site(request).domain,
+            get_scheme(request, config),
+            _is_redirect(request),
+            config.MICROSOFT_AUTH_LOGIN_TYPE,
+            config.MICROSOFT_AUTH_CLIENT_ID,
+            config.MICROSOFT_AUTH_EXTRA_SCOPES,
+            json.dumps(config.MICROSOFT_AUTH_EXTRA_PARAMETERS, sort_keys=True),
+            get_namespace(),
+        )
+
+    def _get_parts(self, request):
+        if config.MICROSOFT_AUTH_LOGIN_TYPE == LOGIN_TYPE_XBL:
+            endpoint = MicrosoftClient._xbox_authorization_url
+        else:
+            endpoint = get_openid_config(_get_metadata_session())[
+                "authorization_endpoint"
+            ]
+
+        prefix = "{}{}{}&state=".format(
+            endpoint,
+            "&" if "?" in endpoint else "?",
+            urlencode(
+                [
+                    ("response_type", "code"),
+                    ("client_id", config.MICROSOFT_AUTH_CLIENT_ID),
+                    ("redirect_uri", get_redirect_uri(request)),
+                    ("scope", get_scopes()),
+                ]
+            ),
+        )
+
+        extra_parameters = dict(config.MICROSOFT_AUTH_EXTRA_PARAMETERS)
+        extra_parameters["response_mode"] = "form_post"
+        suffix = "&{}".format(urlencode(extra_parameters))
+
+        return prefix, suffix
+
+    def build(self, state, request=None):
+        """Returns the authorization URL for request with state"""
+
+        setup_metadata()
+        key = self._get_key(request)
+        with self._lock:
+            entry = self._parts.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self._parts.move_to_end(key)
+                parts = entry[0]
+            else:
+                parts = None
+
+        if parts is None:
+            stats["authorization_url_miss"] += 1
+            parts = self._get_parts(request)
+            with self._lock:
+                self._parts[key] = (parts, time.monotonic() + self.timeout)
+                self._parts.move_to_end(key)
+                while len(self._parts) > self.max_size:
+                    self._parts.popitem(last=False)
+
+        prefix, suffix = parts
+        return prefix + quote_plus(state) + suffix
+
+    def clear(self):
+        with self._lock:
+            self._parts.clear()
+
+
+authorization_url_builder = AuthorizationUrlBuilder()
+
+
+def build_authorization_url(state, request=None):
+    """Returns the Microsoft/Xbox Live authorization URL for request, same
+    as `MicrosoftClient(state=state, request=request).authorization_url()`
+    but without creating a client"""
+
+    return authorization_url_builder.build(state, request)
+
+
+class AsyncMicrosoftClient(MicrosoftClient):
+    """`MicrosoftClient` with async versions of the methods that make network
+    requests, for use in async views under ASGI
+
+    Requests are made with the shared `httpx.AsyncClient` of the running
+    event loop, so httpx must be installed (`django_microsoft_auth[async]`).
+    The client must still be created outside of the event loop (e.g. with
+    `sync_to_async`) since it looks up the current `Site`.
+    """
+
+    async def aopenid_config(self):
+        return await aget_openid_config(self)
+
+    async def ajwks(self):
+        return await aget_jwks(self)
+
+    async def afetch_token(self, **kwargs):
+        """Async version of `fetch_token`"""
+
+        openid_config = await self.aopenid_config()
+        body = self._client.prepare_request_body(
+            redirect_uri=self.redirect_uri,
+            include_client_id=True,
+            client_secret=self.config.MICROSOFT_AUTH_CLIENT_SECRET,
+            **kwargs,
+        )
+        response = await transport.get_async_client().post(
+            openid_config["token_endpoint"],
+            content=body,
+            headers={
+                "Accept": "application/json",
+                "Content-Type": "application/x-www-form-urlencoded;charset=UTF-8",
+            },
+        )
+
+        self.token = self._client.parse_request_body_response(
+            response.text, scope=self.scope
+        )
+        return self.token
+
+    async def aget_claims(self, allow_refresh=True):
+        """Async version of `get_claims`, which verifies the id_token
+        against the keys returned by `ajwks`"""
+
+        if self.token is None:
+            return None
+
+        token = self.token["id_token"].encode("utf8")
+        claims_key, claims = self._get_cached_claims(token)
+        if claims is not None:
+            return claims
+
+        try:
+            kid = jwt.get_unverified_header(token).get("kid")
+        except jwt.PyJWTError as e:
+            logger.warning("could not read id_token header: {}".format(e))
+            return None
+
+        public_key = self._get_public_key(kid, await self.ajwks())
+        if public_key is None and allow_refresh:
+            # fetches the JWKS again in a thread, at most once every
+            # JWKS_REFRESH_INTERVAL seconds
+            public_key = await sync_to_async(
+                self._refresh_public_key, thread_sensitive=False
+            )(kid)
+
+        return self._verify_claims(token, public_key, claims_key)
+
+    async def afetch_xbox_token(self):
+        """Async version of `fetch_xbox_token`"""
+
+        response = await transport.get_async_client().post(
+            self._xbox_token_url,
+            content=json.dumps(self._get_xbox_token_params()),
+            headers=self._xbox_headers,
+        )
+
+        if response.status_code == 200:
+            self.xbox_token = response.json()
+
+        return self.xbox_token
+
+    async def aget_xbox_profile(self):
+        """Async version of `get_xbox_profile`"""
+
+        if "Token" in self.xbox_token:
+            response = await transport.get_async_client().post(
+                self._profile_url,
+                content=json.dumps(self._get_xbox_profile_params()),
+                headers=self._xbox_headers,
+            )
+
+            if response.status_code == 200:
+                return response.json()["DisplayClaims"]["xui"][0]
+        return {}
+
+
+def _get_metadata_session():
+    return transport.get_session()
+
+
+def get_tenant(tenant=None, authority=None):
+    """Returns the (authority, tenant) pair to use, defaulting to the
+    configured ones"""
+
+    if authority is None:
+        authority = config.MICROSOFT_AUTH_AUTHORITY
+    if tenant is None:
+        tenant = config.MICROSOFT_AUTH_TENANT_ID
+    return authority.rstrip("/"), tenant
+
+
+def get_namespace(tenant=None, authority=None):
+    """Returns a cache safe identifier for the metadata of a tenant"""
+
+    authority, tenant = get_tenant(tenant, authority)
+    name = "{}/{}".format(authority, tenant).encode("utf8")
+    return hashlib.sha256(name).hexdigest()[:32]
+
+
+def get_cache_key(prefix, tenant=None, authority=None):
+    return "{}_{}".format(prefix, get_namespace(tenant, authority))
+
+
+def fetch_openid_config(session, authority, tenant, entry=None):
+    """Fetches the OpenID Connect discovery document for tenant using
+    session, revalidating the cached entry if given"""
+
+    config_url = MicrosoftClient._config_url.format(authority=authority, tenant=tenant)
+    return get_json(session, config_url, entry)
+
+
+def _parse_jwks(data):
+    jwks = data["keys"]
+    if len(jwks) > 0:
+        return jwks
+    return None
+
+
+def fetch_jwks(session, authority, tenant, entry=None):
+    """Fetches the signing keys listed by the discovery document of tenant
+    using session, revalidating the cached entry if given"""
+
+    openid_config = get_openid_config(session, tenant, authority)
+    if openid_config is None or openid_config.get("jwks_uri") is None:
+        return None
+
+    jwks_uri = openid_config["jwks_uri"]
+    response = get_json(session, jwks_uri, entry, parse=_parse_jwks)
+
+    if response is not None and (entry is None or response.value != entry["value"]):
+        # keys have rolled over, drop anything parsed or verified previously
+        public_key_cache.clear(get_namespace(tenant, authority))
+        claims_cache.clear()
+    return response
+
+
+def force_jwks_refresh(session, tenant=None, authority=None):
+    """Refetches the JWKS of tenant, at most once every JWKS_REFRESH_INTERVAL
+    seconds across all nodes. Returns whether it was refetched."""
+
+    authority, tenant = get_tenant(tenant, authority)
+    refresh_key = get_cache_key(CACHE_KEY_JWKS_REFRESH, tenant, authority)
+    if not cache.add(refresh_key, True, JWKS_REFRESH_INTERVAL):
+        stats["jwks_refresh_throttled"] += 1
+        return False
+
+    stats["jwks_refresh_forced"] += 1
+    refresh(
+        get_cache_key(CACHE_KEY_JWKS, tenant, authority),
+        partial(fetch_jwks, session, authority, tenant),
+        force=True,
+    )
+    return True
+
+
+def get_openid_config(session, tenant=None, authority=None):
+    authority, tenant = get_tenant(tenant, authority)
+    return get_metadata(
+        get_cache_key(CACHE_KEY_OPENID, tenant, authority),
+        partial(fetch_openid_config, session, authority, tenant),
+    )
+
+
+def get_jwks(session, tenant=None, authority=None):
+    authority, tenant = get_tenant(tenant, authority)
+    jwks = get_metadata(
+        get_cache_key(CACHE_KEY_JWKS, tenant, authority),
+        partial(fetch_jwks, session, authority, tenant),
+    )
+    return jwks or []
+
+
+async def aget_openid_config(session, tenant=None, authority=None):
+    authority, tenant = get_tenant(tenant, authority)
+    return await aget_metadata(
+        get_cache_key(CACHE_KEY_OPENID, tenant, authority),
+        partial(fetch_openid_config, session, authority, tenant),
+    )
+
+
+async def aget_jwks(session, tenant=None, authority=None):
+    authority, tenant = get_tenant(tenant, authority)
+    jwks = await aget_metadata(
+        get_cache_key(CACHE_KEY_JWKS, tenant, authority),
+        partial(fetch_jwks, session, authority, tenant),
+    )
+    return jwks or []
+
+
+def refresh_metadata(
+    force=False, ahead=CACHE_REFRESH_AHEAD, session=None, tenants=None
+):
+    """Refreshes the discovery document and JWKS of each tenant (by default
+    just the configured one) if they are missing or expire within `ahead`
+    seconds (or always if force is set)
+
+    Does not need a request or `Site` so it can be run outside of the
+    request cycle. Returns the cache keys that were refreshed and are now
+    fresh.
+    """
+
+    if session is None:
+        session = _get_metadata_session()
+    if tenants is None:
+        tenants = [None]
+
+    refreshed = []
+    for tenant in tenants:
+        authority, tenant = get_tenant(tenant)
+        for prefix, fetch in (
+            (CACHE_KEY_OPENID, fetch_openid_config),
+            (CACHE_KEY_JWKS, fetch_jwks),
+        ):
+            key = get_cache_key(prefix, tenant, authority)
+            if force or needs_refresh(key, ahead):
+                refresh(key, partial(fetch, session, authority, tenant), force=True)
+                if not needs_refresh(key):
+                    refreshed.append(key)
+    return refreshed
+
+
+def export_metadata_snapshot(tenants=None, session=None):
+    """Returns a JSON serializable snapshot of the discovery document and
+    JWKS of each tenant (by default just the configured one), fetching them
+    if they are not cached"""
+
+    if session is None:
+        session = _get_metadata_session()
+    if tenants is None:
+        tenants = [None]
+
+    snapshot = {
+        "version": METADATA_SNAPSHOT_VERSION,
+        "created": timezone.now().isoformat(),
+        "tenants": [],
+    }
+    for tenant in tenants:
+        authority, tenant = get_tenant(tenant)
+        openid_config = get_openid_config(session, tenant, authority)
+        jwks = get_jwks(session, tenant, authority)
+        if openid_config is None or len(jwks) == 0:
+            raise ValueError("could not retrieve metadata for {}".format(tenant))
+
+        snapshot["tenants"].append(
+            {
+                "authority": authority,
+                "tenant": tenant,
+                "openid_config": openid_config,
+                "jwks": jwks,
+            }
+        )
+    return snapshot
+
+
+def load_metadata_snapshot(path):
+    """Loads a snapshot written by `export_metadata_snapshot`
+
+    Values are added to the cache (if not already there) as fresh for
+    MICROSOFT_AUTH_METADATA_MIN_TTL seconds and kept in process to be served
+    as stale whenever they go missing from the cache afterwards.
+    """
+
+    with open(path) as snapshot_file:
+        snapshot = json.load(snapshot_file)
+
+    if snapshot.get("version") != METADATA_SNAPSHOT_VERSION:
+        raise ValueError(
+            "unsupported metadata snapshot version: {}".format(snapshot.get("version"))
+        )
+
+    timeout = config.MICROSOFT_AUTH_METADATA_MIN_TTL
+    for tenant in snapshot["tenants"]:
+        for prefix, value in (
+            (CACHE_KEY_OPENID, tenant["openid_config"]),
+            (CACHE_KEY_JWKS, tenant["jwks"]),
+        ):
+            key = get_cache_key(prefix, tenant["tenant"], tenant["authority"])
+            set_default(key, value)
+            if get_entry(key) is None:
+                set_metadata(key, value, timeout)
+
+
+def _verify_id_tokens(jwk, tokens, audience, options):
+    """Verifies the signature and claims of each of tokens with jwk
+
+    Module level so it can run in a `ProcessPoolExecutor`. Returns a list of
+    (claims, error) pairs in the same order as tokens.
+    """
+
+    public_key = RSAAlgorithm.from_jwk(json.dumps(jwk))
+
+    results = []
+    for token in tokens:
+        try:
+            claims = jwt.decode(
+                token,
+                public_key,
+                algorithms=["RS256"],
+                audience=audience,
+                options=options,
+            )
+        except jwt.PyJWTError as e:
+            results.append((None, e))
+        else:
+            results.append((claims, None))
+    return results
+
+
+def _validate_id_token_chunk(
+    chunk, start, jwks, audience, options, executor, batch_size, refresh_jwks
+):
+    results = [None] * len(chunk)
+    groups = {}
+    for offset, token in enumerate(chunk):
+        try:
+            kid = jwt.get_unverified_header(token).get("kid")
+        except jwt.PyJWTError as e:
+            results[offset] = TokenValidationResult(start + offset, token, None, e)
+            continue
+        groups.setdefault(kid, []).append(offset)
+
+    keys = jwks()
+    if refresh_jwks is not None and any(kid not in keys for kid in groups):
+        keys = refresh_jwks()
+
+    futures = []
+    for kid, offsets in groups.items():
+        if kid not in keys:
+            error = jwt.InvalidKeyError("unknown kid: {}".format(kid))
+            for offset in offsets:
+                results[offset] = TokenValidationResult(
+                    start + offset, chunk[offset], None, error
+                )
+            continue
+
+        for i in range(0, len(offsets), batch_size):
+            end = i + batch_size
+            batch = offsets[i:end]
+            future = executor.submit(
+                _verify_id_tokens,
+                keys[kid],
+                [chunk[offset] for offset in batch],
+                audience,
+                options,
+            )
+            futures.append((batch, future))
+
+    for batch, future in futures:
+        for offset, (claims, error) in zip(batch, future.result()):
+            results[offset] = TokenValidationResult(
+                start + offset, chunk[offset], claims, error
+            )
+    return results
+
+
+def validate_id_tokens(
+    tokens,
+    audience=None,
+    tenant=None,
+    authority=None,
+    jwks=None,
+    options=None,
+    session=None,
+    executor=None,
+    max_workers=None,
+    chunk_size=1000,
+):
+    """Validates many id_tokens, yielding a `TokenValidationResult` (with
+    either the claims or the error) for each, in order
+
+    tokens can be any iterable and is consumed chunk_size tokens at a time,
+    so memory use does not grow with the number of tokens. The kids used
+    by each chunk are resolved against the tenant's JWKS (or the given
+    list of JWKs, e.g. keys since rotated out) in one pass, refreshing the
+    JWKS at most once per call for unknown kids. Tokens are then grouped
+    by key and verified in batches on executor, a `ThreadPoolExecutor` of
+    max_workers threads by default; pass a `ProcessPoolExecutor` to verify
+    signatures on more than one CPU.
+
+    options is passed on to `jwt.decode`, e.g. `{"verify_exp": False}` to
+    validate expired id_tokens.
+    """
+
+    if audience is None:
+        audience = config.MICROSOFT_AUTH_CLIENT_ID
+
+    if jwks is not None:
+        keys = {key["kid"]: key for key in jwks}
+
+        def get_keys():
+            return keys
+
+        refresh_keys = None
+    else:
+        if session is None:
+            session = _get_metadata_session()
+        authority, tenant = get_tenant(tenant, authority)
+
+        def get_keys():
+            return {key["kid"]: key for key in get_jwks(session, tenant, authority)}
+
+        def refresh_keys():
+            nonlocal refresh_keys
+
+            # only worth trying once per call
+            refresh_keys = None
+            force_jwks_refresh(session, tenant, authority)
+            return get_keys()
+
+    owns_executor = executor is None
+    if owns_executor:
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+    # split each chunk so every worker gets a share of it
+    batch_size = max(1, chunk_size // (max_workers or os.cpu_count() or 1))
+
+    try:
+        tokens = iter(tokens)
+        start = 0
+        while True:
+            chunk = list(islice(tokens, chunk_size))
+            if len(chunk) == 0:
+                break
+
+            yield from _validate_id_token_chunk(
+                chunk,
+                start,
+                get_keys,
+                audience,
+                options,
+                executor,
+                batch_size,
+                refresh_keys,
+            )
+            start += len(chunk)
+    finally:
+        if owns_executor:
+            executor.shutdown(wait=False)
+
+
+metadata_refresher = None
+
+
+def start_metadata_refresher(interval):
+    """Starts a daemon thread that refreshes the OIDC metadata every
+    `interval` seconds, ahead of it expiring
+
+    Safe to call more than once; a refresher inherited from a parent process
+    by fork is not running in the child, so a new one is started.
+    """
+
+    global metadata_refresher
+
+    if metadata_refresher is not None:
+        if metadata_refresher.pid == os.getpid() and metadata_refresher.is_alive():
+            return metadata_refresher
+
+    metadata_refresher = MetadataRefresher(
+        interval, partial(refresh_metadata, ahead=interval * 2)
+    )
+    metadata_refresher.start()
+    return metadata_refresher
+
+
+_metadata_pid = None
+_metadata_lock = threading.Lock()
+
+
+def setup_metadata():
+    """Loads MICROSOFT_AUTH_METADATA_SNAPSHOT and starts the metadata
+    refresher (MICROSOFT_AUTH_METADATA_REFRESH_INTERVAL) once per process
+
+    Called the first time a process logs someone in rather than when the
+    app is loaded, so management commands and the autoreloader never start
+    the refresher, and workers forked from a process that already did get
+    their own.
+    """
+
+    global _metadata_pid
+
+    pid = os.getpid()
+    if _metadata_pid == pid:
+        return
+
+    with _metadata_lock:
+        if _metadata_pid == pid:
+            return
+        _metadata_pid = pid
+
+        snapshot = config.MICROSOFT_AUTH_METADATA_SNAPSHOT
+        if snapshot:
+            try:
+                load_metadata_snapshot(snapshot)
+            except (OSError, KeyError, ValueError) as e:
+                logger.warning(
+                    "could not load metadata snapshot {}: {}".format(snapshot, e)
+                )
+
+        # keep renewing the OIDC metadata off the request path
+        interval = config.MICROSOFT_AUTH_METADATA_REFRESH_INTERVAL
+        if interval:
+            start_metadata_refresher(interval)
@@ -1,11 +1,24 @@
+from contextlib import asynccontextmanager
+import contextvars
 from importlib import import_module
+import time
+from types import MappingProxyType
+import uuid
 
+from asgiref.sync import sync_to_async
+from django.dispatch import Signal
 from django.test.signals import setting_changed
 from django.utils.functional import SimpleLazyObject
 from django.utils.translation import gettext_lazy as _
 
 constance_config = None
 settings = None
+# incremented every time the config is reloaded in this process
+config_version = 0
+# sent after the config has been reloaded, with the changed key (or None)
+config_reloaded = Signal()
+# snapshot served instead of the current one inside `pinned_config`
+pinned_snapshot = contextvars.ContextVar("microsoft_auth_snapshot", default=None)
 
 """ List of all possible default configs for microsoft_auth
 
@@ -29,13 +42,83 @@ settings = None
 
 LOGIN_TYPE_MA = "ma"
 LOGIN_TYPE_XBL = "xbl"
+# how many times a login is tried when it conflicts with a concurrent login
+# creating the same account
+LOGIN_CONFLICT_RETRIES = 3
+# database errors (SQLSTATE or MySQL error codes) of a transaction that was
+# rolled back because of concurrent ones (serialization failures, deadlocks
+# and lock timeouts) and can be started over
+LOGIN_LOCK_ERRORS = ("40001", "40P01", 1205, 1213)
+# how many times a login is tried when it gets one of those, and the base
+# of the random wait (in seconds, doubled every time) before trying again
+LOGIN_LOCK_RETRIES = 8
+LOGIN_LOCK_BACKOFF = 0.01
+
 HOOK_SETTINGS = [
     "MICROSOFT_AUTH_AUTHENTICATE_HOOK",
     "MICROSOFT_AUTH_CALLBACK_HOOK",
 ]
 CACHE_TIMEOUT = 86400
+CACHE_KEY_CONFIG_VERSION = "microsoft_auth_config_version"
+# how often nodes check the cache for config changed on other nodes
+CONFIG_VERSION_CHECK_INTERVAL = 5
+# default for how long (in seconds) values read from constance are served
+# for, MICROSOFT_AUTH_CONSTANCE_TIMEOUT
+CONSTANCE_TIMEOUT = 30
+# how long an expired value is still served while it is being refreshed
+CACHE_STALE_TIMEOUT = 86400
+CACHE_LOCK_TIMEOUT = 30
+# refresh_metadata refetches values that expire within this many seconds
+CACHE_REFRESH_AHEAD = 3600
+CACHE_LOCK_WAIT = 5
+# how long to wait before trying again after failing to refresh a stale value
+CACHE_RETRY_INTERVAL = 60
 CACHE_KEY_OPENID = "microsoft_auth_openid_config"
 CACHE_KEY_JWKS = "microsoft_auth_jwks"
+CACHE_KEY_JWKS_REFRESH = "microsoft_auth_jwks_refresh"
+CACHE_KEY_UNKNOWN_KID = "microsoft_auth_unknown_kid_{}"
+CACHE_KEY_USER = "microsoft_auth_user_{}"
+# tenants that are not a directory (and so cannot be synced)
+NON_DIRECTORY_TENANTS = ("common", "organizations", "consumers")
+# seconds before it expires that a Graph access token is renewed
+GRAPH_TOKEN_LEEWAY = 300
+# requests combined into one Graph $batch request (the most Graph allows)
+GRAPH_BATCH_SIZE = 20
+# throttled Graph requests are retried this many times, waiting for their
+# Retry-After (or GRAPH_RETRY_AFTER seconds), at most GRAPH_MAX_RETRY_AFTER
+GRAPH_MAX_RETRIES = 3
+GRAPH_RETRY_STATUSES = (429, 503)
+GRAPH_RETRY_AFTER = 5
+GRAPH_MAX_RETRY_AFTER = 60
+# Graph user properties requested when syncing users
+GRAPH_USER_FIELDS = (
+    "id",
+    "displayName",
+    "givenName",
+    "surname",
+    "mail",
+    "userPrincipalName",
+    "accountEnabled",
+)
+# seconds before it expires that a stored access token is refreshed by
+# get_valid_token
+TOKEN_REFRESH_AHEAD = 300
+METADATA_SNAPSHOT_VERSION = 1
+# minimum time between JWKS refreshes forced by an unknown kid
+JWKS_REFRESH_INTERVAL = 300
+# how long a kid still unknown after a forced refresh is rejected outright
+UNKNOWN_KID_TIMEOUT = 3600
+# parsed public keys are kept in process for at most KEY_CACHE_TIMEOUT seconds
+KEY_CACHE_TIMEOUT = 3600
+KEY_CACHE_MAX_SIZE = 512
+
+# static parts of authorization URLs are kept in process for at most
+# AUTH_URL_CACHE_TIMEOUT seconds
+AUTH_URL_CACHE_TIMEOUT = 300
+AUTH_URL_CACHE_MAX_SIZE = 64
+
+# responses retried (for idempotent requests only) by the shared transport
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
 
 DEFAULT_CONFIG = {
     "defaults": {
@@ -60,6 +143,14 @@ DEFAULT_CONFIG = {
             _("Microsoft Office 365 Tenant ID"),
             str,
         ),
+        "MICROSOFT_AUTH_AUTHORITY": (
+            "https://login.microsoftonline.com",
+            _(
+                """Microsoft identity platform authority to authenticate
+                against. Only needs to be changed for national clouds."""
+            ),
+            str,
+        ),
         "MICROSOFT_AUTH_CLIENT_ID": (
             "",
             _(
@@ -145,7 +236,10 @@ DEFAULT_CONFIG = {
                 `(User:user, dict: token)` where token is the Xbox Token,
                 see `microsoft_auth.client.MicrosoftClient.fetch_xbox_token`
 
-                for format"""
+                for format
+
+                Several hooks can be given as a comma separated list, they
+                are called in order"""
             ),
             str,
         ),
@@ -170,6 +264,9 @@ DEFAULT_CONFIG = {
 
                 `message` is a dictionary that will be serialized as a JSON
                 string and passoed back to the initiating window.
+
+                Several hooks can be given as a comma separated list, each
+                is passed the context returned by the one before it.
                 """
             ),
             str,
@@ -182,6 +279,156 @@ DEFAULT_CONFIG = {
             ),
             dict,
         ),
+        "MICROSOFT_AUTH_ASYNC_VIEWS": (
+            False,
+            _(
+                """Use async versions of the authentication callback views,
+                so logins do not block a worker thread when running under
+                ASGI. Requires httpx (`django_microsoft_auth[async]`) and
+                Django 4.1+. Requires restart of app for setting to take
+                effect."""
+            ),
+            bool,
+        ),
+        "MICROSOFT_AUTH_HTTP_POOL_CONNECTIONS": (
+            10,
+            _(
+                """Number of hosts to keep a pool of keep-alive connections
+                for, shared by all requests to Microsoft and Xbox Live.
+                Requires restart of app for setting to take effect."""
+            ),
+            int,
+        ),
+        "MICROSOFT_AUTH_HTTP_POOL_MAXSIZE": (
+            10,
+            _(
+                """Maximum number of keep-alive connections to keep open per
+                host. Should be at least the number of threads per process.
+                Requires restart of app for setting to take effect."""
+            ),
+            int,
+        ),
+        "MICROSOFT_AUTH_HTTP_CONNECT_TIMEOUT": (
+            5.0,
+            _(
+                """Timeout (in seconds) for connecting to Microsoft and Xbox
+                Live. Requires restart of app for setting to take effect."""
+            ),
+            float,
+        ),
+        "MICROSOFT_AUTH_HTTP_READ_TIMEOUT": (
+            15.0,
+            _(
+                """Timeout (in seconds) for reading a response from Microsoft
+                and Xbox Live. Requires restart of app for setting to take
+                effect."""
+            ),
+            float,
+        ),
+        "MICROSOFT_AUTH_HTTP_RETRIES": (
+            3,
+            _(
+                """Number of times to retry failed connections and idempotent
+                (GET) requests that failed with a 429 or 5xx response.
+                Requires restart of app for setting to take effect."""
+            ),
+            int,
+        ),
+        "MICROSOFT_AUTH_HTTP_BACKOFF_FACTOR": (
+            0.5,
+            _(
+                """Backoff factor between retries, the nth retry waits
+                factor * 2 ** (n - 1) seconds (or as long as a Retry-After
+                header says). Requires restart of app for setting to take
+                effect."""
+            ),
+            float,
+        ),
+        "MICROSOFT_AUTH_METADATA_REFRESH_INTERVAL": (
+            0,
+            _(
+                """How often (in seconds) a background thread should refresh
+                the OpenID Connect discovery document and JWKS, so logins
+                never wait on fetching them. The thread is started by the
+                first login in each process. 0 disables the background
+                thread. The `microsoft_auth_refresh_metadata`
+                management command can be run from cron instead.
+                Requires restart of app for setting to take effect."""
+            ),
+            int,
+        ),
+        "MICROSOFT_AUTH_METADATA_SNAPSHOT": (
+            "",
+            _(
+                """Path to a metadata snapshot created with the
+                `microsoft_auth_export_metadata` management command. It is
+                loaded by the first login in each process and used as the
+                initial OpenID Connect discovery document and JWKS, so
+                id_tokens can be validated before (or without) being able to
+                reach Microsoft.
+                Requires restart of app for setting to take effect."""
+            ),
+            str,
+        ),
+        "MICROSOFT_AUTH_METADATA_MIN_TTL": (
+            300,
+            _(
+                """Minimum time (in seconds) the OpenID Connect discovery
+                document and JWKS are cached for, regardless of what the
+                Cache-Control/Expires headers from Microsoft say."""
+            ),
+            int,
+        ),
+        "MICROSOFT_AUTH_METADATA_MAX_TTL": (
+            86400,
+            _(
+                """Maximum time (in seconds) the OpenID Connect discovery
+                document and JWKS are cached for before being revalidated,
+                regardless of what the Cache-Control/Expires headers from
+                Microsoft say."""
+            ),
+            int,
+        ),
+        "MICROSOFT_AUTH_CLAIMS_CACHE_SIZE": (
+            0,
+            _(
+                """Number of verified id_token claims to keep in memory (per
+                process) so validating the same id_token again skips the
+                signature check. Entries are dropped once the id_token
+                expires. 0 disables the cache."""
+            ),
+            int,
+        ),
+        "MICROSOFT_AUTH_GRAPH_URL": (
+            "https://graph.microsoft.com/v1.0",
+            _(
+                """Microsoft Graph endpoint used to sync users from the
+                directory. Only needs to be changed for national clouds."""
+            ),
+            str,
+        ),
+        "MICROSOFT_AUTH_STORE_TOKENS": (
+            False,
+            _(
+                """Store the OAuth tokens of users that log in with a
+                Microsoft account (encrypted) so they can be used later
+                with `microsoft_auth.tokens.get_valid_token`. Add
+                `offline_access` to MICROSOFT_AUTH_EXTRA_SCOPES to get a
+                refresh token."""
+            ),
+            bool,
+        ),
+        "MICROSOFT_AUTH_USER_CACHE_TIMEOUT": (
+            0,
+            _(
+                """How long (in seconds) users loaded for authenticated
+                requests by `MicrosoftAuthenticationBackend.get_user` are
+                kept in the Django cache, together with their linked
+                Microsoft/Xbox Live account. Saving or deleting the user or
+                account removes it from the cache. 0 disables the cache."""
+            ),
+            int,
+        ),
     },
     "fieldsets": {
         "Microsoft Login": (
@@ -216,8 +463,28 @@ DEFAULT_CONFIG = {
 
 
 class SimpleConfig:
+    """Reads microsoft_auth settings from Django settings, then
+    django-constance (if installed), then the defaults
+
+    All keys of DEFAULT_CONFIG are resolved together into an immutable
+    snapshot that is served until the config is reloaded (`setting_changed`
+    or constance's `config_updated`). With constance, other nodes are told
+    about changes through a version stamp in the Django cache, which is
+    checked at most every CONFIG_VERSION_CHECK_INTERVAL seconds.
+
+    Values from constance are loaded with one request to its backend and
+    are also reloaded after MICROSOFT_AUTH_CONSTANCE_TIMEOUT seconds (set in
+    Django settings, None to only reload on changes), in case they were
+    changed some other way.
+    """
+
     def __init__(self, config=None):
         self._defaults = {}
+        self._snapshot = None
+        self._snapshot_version = None
+        self._snapshot_expires = None
+        self._cache_version = None
+        self._cache_checked = None
 
         if config:
             self.add_default_config(config)
@@ -229,8 +496,24 @@ class SimpleConfig:
             tmp_dict[key] = value[0]
 
         self._defaults.update(tmp_dict)
+        self._snapshot = None
 
-    def __getattr__(self, attr):
+    def _get_constance_values(self):
+        """Returns the constance values of every DEFAULT_CONFIG key, using a
+        single request to the constance backend"""
+
+        from constance import settings as constance_settings
+
+        keys = [key for key in self._defaults if key in constance_settings.CONFIG]
+        values = {key: constance_settings.CONFIG[key][0] for key in keys}
+        try:
+            values.update(constance_config._backend.mget(keys))
+        except AttributeError:
+            # backend without mget (or a custom config), read one at a time
+            return None
+        return values
+
+    def _resolve(self, attr, constance_values=None):
         val = None
 
         # Django settings take priority
@@ -242,7 +525,9 @@ class SimpleConfig:
 
         # Check Constance first if it is installed
 
-        if val is None and constance_config:
+        if val is None and constance_values is not None:
+            val = constance_values.get(attr)
+        elif val is None and constance_config:
             try:
                 val = getattr(constance_config, attr)
             except AttributeError:
@@ -257,6 +542,66 @@ class SimpleConfig:
 
         return val
 
+    def _check_cache_version(self):
+        now = time.monotonic()
+        checked = self._cache_checked
+        if checked is not None and now - checked < CONFIG_VERSION_CHECK_INTERVAL:
+            return
+        self._cache_checked = now
+
+        version = get_cache_version()
+        if checked is not None and version != self._cache_version:
+            # changed on another node
+            reload_settings(key=None)
+        self._cache_version = version
+
+    def _is_expired(self):
+        if self._snapshot is None or self._snapshot_version != config_version:
+            return True
+        if self._snapshot_expires is not None:
+            return self._snapshot_expires <= time.monotonic()
+        return False
+
+    def get_snapshot(self):
+        """Returns a read only mapping of every DEFAULT_CONFIG key to its
+        current value (or the one pinned by `pinned_config`)"""
+
+        pinned = pinned_snapshot.get()
+        if pinned is not None:
+            return pinned
+
+        constance_values = None
+        if constance_config:
+            self._check_cache_version()
+
+        if self._is_expired():
+            version = config_version
+            expires = None
+            if constance_config:
+                constance_values = self._get_constance_values()
+                timeout = getattr(
+                    settings, "MICROSOFT_AUTH_CONSTANCE_TIMEOUT", CONSTANCE_TIMEOUT
+                )
+                if timeout is not None:
+                    expires = time.monotonic() + timeout
+
+            self._snapshot = MappingProxyType(
+                {key: self._resolve(key, constance_values) for key in self._defaults}
+            )
+            self._snapshot_version = version
+            self._snapshot_expires = expires
+        return self._snapshot
+
+    def __getattr__(self, attr):
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+
+        try:
+            return self.get_snapshot()[attr]
+        except KeyError:
+            # not a microsoft_auth setting (e.g. DEBUG), always read live
+            return self._resolve(attr)
+
 
 def init_config():
     global config, constance_config, settings
@@ -269,6 +614,11 @@ def init_config():
 
     if "constance" in settings.INSTALLED_APPS:
         from constance import config as constance_config
+        from constance.signals import config_updated
+
+        config_updated.connect(
+            constance_updated, dispatch_uid="microsoft_auth_constance_updated"
+        )
     else:
         constance_config = None
 
@@ -300,15 +650,53 @@ def init_config():
 config = SimpleLazyObject(init_config)
 
 
+@asynccontextmanager
+async def pinned_config():
+    """Resolves the config snapshot in a thread and serves it for the rest
+    of the block, so async code can read `config` without querying
+    constance (or the Django cache) on the event loop
+
+    Does nothing for custom config classes without `get_snapshot`.
+    """
+
+    get_snapshot = getattr(config, "get_snapshot", None)
+    if get_snapshot is None:
+        yield
+        return
+
+    token = pinned_snapshot.set(await sync_to_async(get_snapshot)())
+    try:
+        yield
+    finally:
+        pinned_snapshot.reset(token)
+
+
+def get_cache_version():
+    from django.core.cache import cache
+
+    return cache.get(CACHE_KEY_CONFIG_VERSION)
+
+
 def reload_settings(*args, **kwargs):
-    global config
+    global config, config_version
 
     setting = kwargs.get("setting", kwargs.get("key"))
 
     # only reinitialize config if settings changed
 
-    if setting.startswith("MICROSOFT_AUTH_"):
-        init_config()
+    if setting is None or setting.startswith("MICROSOFT_AUTH_"):
+        config_version += 1
+        if setting is not None:
+            init_config()
+        config_reloaded.send(sender=SimpleConfig, key=setting)
+
+
+def constance_updated(*args, **kwargs):
+    from django.core.cache import cache
+
+    reload_settings(*args, **kwargs)
+    # tell other nodes
+    cache.set(CACHE_KEY_CONFIG_VERSION, uuid.uuid4().hex, None)
 
 
 setting_changed.connect(reload_settings)
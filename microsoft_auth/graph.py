@@ -0,0 +1,246 @@
+from collections import namedtuple
+import logging
+import time
+from urllib.parse import urljoin, urlsplit
+
+from django.core.exceptions import ImproperlyConfigured
+from requests.structures import CaseInsensitiveDict
+
+from . import transport
+from .client import get_tenant
+from .conf import (
+    GRAPH_BATCH_SIZE,
+    GRAPH_MAX_RETRIES,
+    GRAPH_MAX_RETRY_AFTER,
+    GRAPH_RETRY_AFTER,
+    GRAPH_RETRY_STATUSES,
+    GRAPH_TOKEN_LEEWAY,
+    NON_DIRECTORY_TENANTS,
+    config,
+)
+
+logger = logging.getLogger("django")
+
+""" Minimal Microsoft Graph client, either for the app itself with the
+    client credentials of MICROSOFT_AUTH_CLIENT_ID/MICROSOFT_AUTH_CLIENT_SECRET
+    or on behalf of a user with their access token
+
+    App-only requests require a tenant ID (MICROSOFT_AUTH_TENANT_ID or passed
+    in) and the Graph application permissions needed for the requests made,
+    e.g. `User.Read.All` to sync users.
+
+    Requests that are throttled (429 or 503) are retried after the time
+    Graph asks for in `Retry-After`, and several requests can be combined
+    into `$batch` requests of up to GRAPH_BATCH_SIZE requests each.
+"""
+
+BatchResponse = namedtuple("BatchResponse", ["status", "headers", "body"])
+
+
+def get_retry_after(headers):
+    """Returns how many seconds to wait before retrying a throttled
+    request, from its Retry-After header"""
+
+    try:
+        retry_after = float(CaseInsensitiveDict(headers or {})["Retry-After"])
+    except (KeyError, TypeError, ValueError):
+        retry_after = GRAPH_RETRY_AFTER
+    return min(max(retry_after, 0), GRAPH_MAX_RETRY_AFTER)
+
+
+class GraphClient:
+    """Makes requests to Microsoft Graph
+
+    Without a token, an app-only access token is fetched when needed and
+    reused until it is about to expire. token can be a user's access token
+    (or the OAuth token passed to MICROSOFT_AUTH_AUTHENTICATE_HOOK), which
+    is used as is. session can be any `requests.Session`, such as the
+    backend's `MicrosoftClient`; the shared transport session is used
+    otherwise.
+    """
+
+    def __init__(self, tenant=None, authority=None, session=None, token=None):
+        self.authority, self.tenant = get_tenant(tenant, authority)
+        if token is None and self.tenant in NON_DIRECTORY_TENANTS:
+            raise ImproperlyConfigured(
+                "Microsoft Graph requires a tenant ID, not {}".format(self.tenant)
+            )
+
+        if session is None:
+            session = transport.get_session()
+        self.session = session
+        self.base_url = config.MICROSOFT_AUTH_GRAPH_URL.rstrip("/") + "/"
+
+        if isinstance(token, dict):
+            token = token["access_token"]
+        self._token = token
+        self._token_expires = None if token is not None else 0
+
+    @property
+    def token_url(self):
+        return "{}/{}/oauth2/v2.0/token".format(self.authority, self.tenant)
+
+    @property
+    def scope(self):
+        parts = urlsplit(self.base_url)
+        return "{}://{}/.default".format(parts.scheme, parts.netloc)
+
+    def get_token(self):
+        """Returns an access token for Graph, fetching a new one if needed"""
+
+        # a token that was passed in is never renewed
+        if self._token_expires is None:
+            return self._token
+
+        if self._token is None or self._token_expires <= time.time():
+            response = self.session.post(
+                self.token_url,
+                data={
+                    "client_id": config.MICROSOFT_AUTH_CLIENT_ID,
+                    "client_secret": config.MICROSOFT_AUTH_CLIENT_SECRET,
+                    "scope": self.scope,
+                    "grant_type": "client_credentials",
+                },
+            )
+            response.raise_for_status()
+            data = response.json()
+
+            self._token = data["access_token"]
+            expires_in = int(data.get("expires_in", 3600))
+            self._token_expires = time.time() + expires_in - GRAPH_TOKEN_LEEWAY
+        return self._token
+
+    def get_url(self, path):
+        """Returns the absolute URL for path, which can be relative to
+        MICROSOFT_AUTH_GRAPH_URL or a link returned by Graph"""
+
+        return urljoin(self.base_url, path)
+
+    def request(self, method, path, headers=None, **kwargs):
+        """Makes a request to Graph, raising `requests.HTTPError` if it
+        fails. Throttled requests are retried up to GRAPH_MAX_RETRIES
+        times."""
+
+        headers = dict(headers or {})
+        headers["Authorization"] = "Bearer {}".format(self.get_token())
+
+        url = self.get_url(path)
+        for attempt in range(GRAPH_MAX_RETRIES + 1):
+            response = self.session.request(method, url, headers=headers, **kwargs)
+            if (
+                response.status_code not in GRAPH_RETRY_STATUSES
+                or attempt == GRAPH_MAX_RETRIES
+            ):
+                break
+
+            retry_after = get_retry_after(response.headers)
+            logger.warning(
+                "Graph request throttled, retrying in {}s".format(retry_after)
+            )
+            time.sleep(retry_after)
+
+        response.raise_for_status()
+        return response
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs).json()
+
+    def get_all(self, path, **kwargs):
+        """Yields the items of a collection, following `@odata.nextLink` to
+        the next page until there are no more"""
+
+        while path:
+            page = self.get(path, **kwargs)
+            yield from page.get("value", [])
+            path = page.get("@odata.nextLink")
+
+    def _get_batch_url(self, url):
+        # requests in a batch are relative to the Graph version
+        prefix = len(self.base_url)
+        if url.startswith(self.base_url):
+            url = url[prefix:]
+        return url if url.startswith("/") else "/{}".format(url)
+
+    def _get_batch_request(self, request):
+        if isinstance(request, str):
+            request = {"url": request}
+
+        request = dict(request)
+        request.setdefault("method", "GET")
+        request["url"] = self._get_batch_url(request["url"])
+        if "body" in request:
+            request["headers"] = dict(
+                {"Content-Type": "application/json"}, **request.get("headers", {})
+            )
+        return request
+
+    def batch(self, requests, follow_pages=True):
+        """Makes several requests with as few `$batch` requests as possible
+        and returns a `BatchResponse` for each, in the same order
+
+        requests are paths to GET or dicts with the method, url and
+        optionally the (JSON) body and headers of a request. Requests are
+        sent GRAPH_BATCH_SIZE at a time. Throttled requests are sent again
+        in the next batch once their Retry-After has passed, and if
+        follow_pages is True the remaining pages of collections are fetched
+        in the next batches as well and added to the first page's `value`.
+        Requests that fail are not raised, check their status.
+        """
+
+        results = [None] * len(requests)
+        # (index in requests, batch request, attempts)
+        pending = [
+            (index, self._get_batch_request(request), 0)
+            for index, request in enumerate(requests)
+        ]
+
+        while pending:
+            next_pending = []
+            retry_after = 0
+
+            for start in range(0, len(pending), GRAPH_BATCH_SIZE):
+                end = start + GRAPH_BATCH_SIZE
+                chunk = pending[start:end]
+                payload = {
+                    "requests": [
+                        dict(request, id=str(number))
+                        for number, (_, request, _) in enumerate(chunk)
+                    ]
+                }
+                responses = self.request("POST", "$batch", json=payload).json()
+
+                for item in responses.get("responses", []):
+                    index, request, attempts = chunk[int(item["id"])]
+                    status = item["status"]
+                    headers = item.get("headers", {})
+                    body = item.get("body")
+
+                    if status in GRAPH_RETRY_STATUSES and attempts < GRAPH_MAX_RETRIES:
+                        next_pending.append((index, request, attempts + 1))
+                        retry_after = max(retry_after, get_retry_after(headers))
+                        continue
+
+                    previous = results[index]
+                    if previous is not None and status < 400:
+                        # next page of a collection
+                        body = dict(
+                            body, value=previous.body["value"] + body.get("value", [])
+                        )
+                    results[index] = BatchResponse(status, headers, body)
+
+                    next_link = isinstance(body, dict) and body.get("@odata.nextLink")
+                    if follow_pages and status < 400 and next_link:
+                        request = {
+                            "method": "GET",
+                            "url": self._get_batch_url(next_link),
+                        }
+                        next_pending.append((index, request, 0))
+
+            if retry_after:
+                logger.warning(
+                    "Graph batch throttled, retrying in {}s".format(retry_after)
+                )
+                time.sleep(retry_after)
+            pending = next_pending
+
+        return results
@@ -0,0 +1,141 @@
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.migrations.loader import MigrationLoader
+from django.db.models import Count
+
+from microsoft_auth.backends import clear_cached_user
+
+# duplicates can only exist before the unique index is added
+MIGRATION = ("microsoft_auth", "0003_microsoft_id_openid")
+
+
+def get_models():
+    """Returns the MicrosoftAccount and user models as they are before the
+    unique index, so deletes do not cascade to tables that are only
+    created by later migrations"""
+
+    apps = MigrationLoader(connection).project_state(MIGRATION).apps
+    return (
+        apps.get_model("microsoft_auth", "MicrosoftAccount"),
+        apps.get_model(settings.AUTH_USER_MODEL),
+    )
+
+
+class Command(BaseCommand):
+    help = (
+        "Merges Microsoft accounts that share a microsoft_id so the unique "
+        "index on microsoft_id can be added. Of each set of duplicates, the "
+        "account linked to the user that logged in last is kept."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Number of duplicated microsoft_ids to merge in one transaction",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report the duplicates, do not delete anything",
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        self.MicrosoftAccount, self.User = get_models()
+
+        # there is no index on microsoft_id yet, so the duplicates are
+        # found with a single pass over the table (streamed, only the
+        # duplicated ids are kept)
+        duplicates = list(
+            self.MicrosoftAccount.objects.values("microsoft_id")
+            .annotate(count=Count("id"))
+            .filter(count__gt=1)
+            .order_by()
+            .values_list("microsoft_id", flat=True)
+            .iterator(chunk_size=batch_size)
+        )
+
+        removed = 0
+        for start in range(0, len(duplicates), batch_size):
+            end = start + batch_size
+            removed += self._merge(duplicates[start:end], options["dry_run"])
+
+        if options["dry_run"]:
+            self.stdout.write(
+                "Found {} duplicated microsoft_id(s), {} account(s) would be "
+                "removed".format(len(duplicates), removed)
+            )
+        else:
+            self.stdout.write(
+                self.style.SUCCESS(
+                    "Merged {} duplicated microsoft_id(s), removed {} "
+                    "account(s)".format(len(duplicates), removed)
+                )
+            )
+
+    def _merge(self, microsoft_ids, dry_run):
+        """Keeps one account for each of microsoft_ids and deletes the
+        others, returns how many were (or would be) deleted"""
+
+        # one short transaction per batch, only its rows are locked
+        with transaction.atomic():
+            by_id = {}
+            for account in (
+                self.MicrosoftAccount.objects.select_for_update()
+                .filter(microsoft_id__in=microsoft_ids)
+                .order_by("pk")
+            ):
+                by_id.setdefault(account.microsoft_id, []).append(account)
+
+            last_logins = dict(
+                self.User.objects.filter(
+                    pk__in=[
+                        account.user_id
+                        for accounts in by_id.values()
+                        for account in accounts
+                        if account.user_id is not None
+                    ]
+                ).values_list("pk", "last_login")
+            )
+            never = datetime.min.replace(tzinfo=timezone.utc)
+
+            def _key(account):
+                last_login = last_logins.get(account.user_id) or never
+                if last_login.tzinfo is None:
+                    last_login = last_login.replace(tzinfo=timezone.utc)
+                return (account.user_id is not None, last_login, account.pk)
+
+            remove = []
+            for microsoft_id in microsoft_ids:
+                # fewer than 2 if already merged by someone else
+                accounts = by_id.get(microsoft_id, [])
+                if len(accounts) < 2:
+                    continue
+
+                keep = max(accounts, key=_key)
+                for account in accounts:
+                    if account.pk == keep.pk:
+                        continue
+                    remove.append(account)
+                    if account.user_id is not None:
+                        self.stdout.write(
+                            "User {} is no longer linked to {}, kept account {} "
+                            "(user {})".format(
+                                account.user_id, microsoft_id, keep.pk, keep.user_id
+                            )
+                        )
+
+            if remove and not dry_run:
+                self.MicrosoftAccount.objects.filter(
+                    pk__in=[account.pk for account in remove]
+                ).delete()
+                # historical models do not send the signals that keep the
+                # users cached by the backend in sync
+                for account in remove:
+                    clear_cached_user(account.user_id)
+        return len(remove)
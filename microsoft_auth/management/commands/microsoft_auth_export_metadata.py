@@ -0,0 +1,43 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+import requests
+
+from microsoft_auth.client import export_metadata_snapshot
+
+
+class Command(BaseCommand):
+    help = (
+        "Exports the Microsoft OpenID Connect discovery document and JWKS to a "
+        "snapshot file that can be loaded with MICROSOFT_AUTH_METADATA_SNAPSHOT."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "path", help="File to write the snapshot to, - for standard output"
+        )
+        parser.add_argument(
+            "--tenant",
+            action="append",
+            dest="tenants",
+            help=(
+                "Tenant ID to export the metadata of, can be given more than "
+                "once (default: MICROSOFT_AUTH_TENANT_ID)"
+            ),
+        )
+
+    def handle(self, *args, **options):
+        try:
+            snapshot = export_metadata_snapshot(tenants=options["tenants"])
+        except (requests.RequestException, ValueError) as e:
+            raise CommandError("Could not fetch OIDC metadata: {}".format(e))
+
+        data = json.dumps(snapshot, indent=2, sort_keys=True)
+        if options["path"] == "-":
+            self.stdout.write(data)
+        else:
+            with open(options["path"], "w") as snapshot_file:
+                snapshot_file.write(data)
+            self.stdout.write(
+                self.style.SUCCESS("Exported metadata to {}".format(options["path"]))
+            )
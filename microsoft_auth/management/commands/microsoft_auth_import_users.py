@@ -0,0 +1,309 @@
+import csv
+import json
+import os
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
+
+from microsoft_auth.backends import clear_cached_user
+from microsoft_auth.conf import config
+from microsoft_auth.models import MicrosoftAccount
+from microsoft_auth.utils import get_username, split_name
+
+User = get_user_model()
+
+# column names accepted for each value, the first one present is used
+SUB_FIELDS = ("sub",)
+OBJECT_ID_FIELDS = ("oid", "id")
+EMAIL_FIELDS = ("email", "mail")
+NAME_FIELDS = ("name", "displayName")
+USERNAME_FIELDS = ("preferred_username", "upn", "userPrincipalName")
+
+
+def _get_field(row, fields):
+    for field in fields:
+        value = row.get(field)
+        if value:
+            return value.strip()
+    return ""
+
+
+def _get_key(data):
+    # the sub claim is what logins look accounts up by, the directory
+    # object ID (the oid claim) is only used until the first login
+    if data["sub"]:
+        return ("microsoft_id", data["sub"])
+    return ("object_id", data["oid"])
+
+
+class Command(BaseCommand):
+    help = (
+        "Creates users and Microsoft accounts ahead of their first login from "
+        "a CSV or JSON lines export with the columns sub or oid (or id), email, "
+        "name and preferred_username (or upn). Existing users are linked by "
+        "email like they are on login."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="CSV or JSON lines file to import")
+        parser.add_argument(
+            "--format",
+            choices=["csv", "jsonl"],
+            help="Format of the file (default: from the file extension)",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1000,
+            help="Number of rows imported per transaction",
+        )
+        parser.add_argument(
+            "--state-file",
+            help=(
+                "File to record progress in, an interrupted import started "
+                "again with the same file continues where it stopped"
+            ),
+        )
+
+    def handle(self, *args, **options):
+        file_format = options["format"]
+        if file_format is None:
+            if options["path"].endswith(".csv"):
+                file_format = "csv"
+            else:
+                file_format = "jsonl"
+
+        self.verbosity = options["verbosity"]
+        state_file = options["state_file"]
+        done = self._read_state(state_file)
+        if done:
+            self.stdout.write("Resuming after row {}".format(done))
+
+        self.counts = {"created": 0, "linked": 0, "skipped": 0}
+        rows_read = 0
+        chunk = []
+        with open(options["path"], newline="") as import_file:
+            for row in self._read_rows(import_file, file_format):
+                rows_read += 1
+                if rows_read <= done:
+                    continue
+
+                chunk.append(row)
+                if len(chunk) >= options["chunk_size"]:
+                    self._import_chunk(chunk)
+                    chunk = []
+                    self._write_state(state_file, rows_read)
+                    if self.verbosity > 0:
+                        self.stdout.write(self._get_progress(rows_read))
+
+        if chunk:
+            self._import_chunk(chunk)
+        if state_file is not None and os.path.exists(state_file):
+            os.remove(state_file)
+
+        self.stdout.write(self.style.SUCCESS(self._get_progress(rows_read)))
+
+    def _get_progress(self, rows):
+        return (
+            "Imported {} rows: {created} users created, {linked} accounts "
+            "linked, {skipped} rows skipped".format(rows, **self.counts)
+        )
+
+    def _read_rows(self, import_file, file_format):
+        if file_format == "csv":
+            rows = csv.DictReader(import_file)
+        else:
+            rows = (json.loads(line) for line in import_file if line.strip())
+
+        for row in rows:
+            yield {
+                "sub": _get_field(row, SUB_FIELDS),
+                "oid": _get_field(row, OBJECT_ID_FIELDS),
+                "email": _get_field(row, EMAIL_FIELDS),
+                "name": _get_field(row, NAME_FIELDS),
+                "preferred_username": _get_field(row, USERNAME_FIELDS),
+            }
+
+    def _read_state(self, state_file):
+        if state_file is None or not os.path.exists(state_file):
+            return 0
+
+        try:
+            with open(state_file) as f:
+                return json.load(f)["rows"]
+        except (KeyError, TypeError, ValueError):
+            raise CommandError("{} is not a valid state file".format(state_file))
+
+    def _write_state(self, state_file, rows):
+        if state_file is None:
+            return
+
+        # replace, so an interrupted write never leaves a broken state file
+        tmp_file = "{}.tmp".format(state_file)
+        with open(tmp_file, "w") as f:
+            json.dump({"rows": rows}, f)
+        os.replace(tmp_file, state_file)
+
+    def _skip(self, data, reason):
+        self.counts["skipped"] += 1
+        if self.verbosity > 1:
+            self.stdout.write(
+                "Skipped {}: {}".format(data["sub"] or data["oid"] or data, reason)
+            )
+
+    def _import_chunk(self, rows):
+        """Links (creating them where needed) the users and accounts of rows
+        in one transaction, with a fixed number of queries"""
+
+        # one row per account and per email, the first one wins
+        by_id, ids, emails = {}, set(), set()
+        for data in rows:
+            row_ids = {
+                ("microsoft_id", data["sub"]),
+                ("object_id", data["oid"]),
+            } - {("microsoft_id", ""), ("object_id", "")}
+            if not row_ids or not data["email"]:
+                self._skip(data, "missing sub/oid or email")
+            elif row_ids & ids or data["email"].lower() in emails:
+                self._skip(data, "duplicated sub/oid or email")
+            else:
+                by_id[_get_key(data)] = data
+                ids.update(row_ids)
+                emails.add(data["email"].lower())
+
+        with transaction.atomic():
+            accounts = {}
+            for account in MicrosoftAccount.objects.filter(
+                Q(microsoft_id__in=[data["sub"] for data in by_id.values()])
+                | Q(object_id__in=[data["oid"] for data in by_id.values()])
+            ):
+                accounts[("microsoft_id", account.microsoft_id)] = account
+                accounts[("object_id", account.object_id)] = account
+
+            pending = {}
+            for key, data in by_id.items():
+                account = self._get_account(accounts, data)
+                if account is not None and account.user_id is not None:
+                    # already linked, exactly like on login
+                    continue
+                pending[key] = data
+
+            users = {}
+            for user in User._default_manager.filter(
+                email__in=[data["email"] for data in pending.values()]
+            ).select_related("microsoft_account"):
+                # the backend cannot pick between users sharing an email either
+                users.setdefault(user.email, []).append(user)
+
+            new_users, updated_users, unlink = [], [], []
+            for key, data in list(pending.items()):
+                matches = users.get(data["email"], [])
+                if len(matches) > 1:
+                    self._skip(data, "more than one user with this email")
+                    del pending[key]
+                    continue
+
+                first_name, last_name = split_name(data["name"] or None)
+                if not matches:
+                    new_users.append(
+                        User(
+                            username=get_username(
+                                data["preferred_username"] or data["email"]
+                            ),
+                            first_name=first_name,
+                            last_name=last_name,
+                            email=data["email"],
+                        )
+                    )
+                    continue
+
+                user = matches[0]
+                try:
+                    existing_account = user.microsoft_account
+                except MicrosoftAccount.DoesNotExist:
+                    existing_account = None
+                if existing_account is not None:
+                    if not config.MICROSOFT_AUTH_AUTO_REPLACE_ACCOUNTS:
+                        self._skip(data, "user already has a Microsoft account")
+                        del pending[key]
+                        continue
+                    unlink.append(existing_account.pk)
+
+                if user.first_name == "" and user.last_name == "":
+                    user.first_name = first_name
+                    user.last_name = last_name
+                    updated_users.append(user)
+
+            self._create_users(new_users, pending)
+
+            if updated_users:
+                User._default_manager.bulk_update(
+                    updated_users, ["first_name", "last_name"]
+                )
+            if unlink:
+                MicrosoftAccount.objects.filter(pk__in=unlink).update(user=None)
+
+            # look the users up again, not every database returns the primary
+            # keys of created rows
+            user_ids = dict(
+                User._default_manager.filter(
+                    email__in=[data["email"] for data in pending.values()]
+                ).values_list("email", "pk")
+            )
+
+            new_accounts, linked_accounts = [], []
+            for data in pending.values():
+                account = self._get_account(accounts, data)
+                if account is None:
+                    account = MicrosoftAccount(
+                        microsoft_id=data["sub"] or None, object_id=data["oid"] or None
+                    )
+                    new_accounts.append(account)
+                else:
+                    linked_accounts.append(account)
+                account.user_id = user_ids[data["email"]]
+
+            MicrosoftAccount.objects.bulk_create(new_accounts)
+            MicrosoftAccount.objects.bulk_update(linked_accounts, ["user"])
+            self.counts["linked"] += len(pending)
+
+        # bulk queries do not send the signals that clear cached users
+        if config.MICROSOFT_AUTH_USER_CACHE_TIMEOUT:
+            for user in updated_users:
+                clear_cached_user(user.pk)
+            for user_id in user_ids.values():
+                clear_cached_user(user_id)
+
+    def _get_account(self, accounts, data):
+        account = None
+        if data["sub"]:
+            account = accounts.get(("microsoft_id", data["sub"]))
+        if account is None and data["oid"]:
+            account = accounts.get(("object_id", data["oid"]))
+        return account
+
+    def _create_users(self, new_users, pending):
+        if not new_users:
+            return
+
+        taken = set(
+            User._default_manager.filter(
+                username__in=[user.username for user in new_users]
+            ).values_list("username", flat=True)
+        )
+        create = []
+        for user in new_users:
+            if user.username in taken:
+                # another user has that username, leave it to the first login
+                key = next(k for k, d in pending.items() if d["email"] == user.email)
+                self._skip(
+                    pending.pop(key), "username {} is taken".format(user.username)
+                )
+                continue
+            taken.add(user.username)
+            create.append(user)
+
+        User._default_manager.bulk_create(create)
+        self.counts["created"] += len(create)
@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand, CommandError
+import requests
+
+from microsoft_auth.client import refresh_metadata
+from microsoft_auth.conf import CACHE_REFRESH_AHEAD
+
+
+class Command(BaseCommand):
+    help = (
+        "Fetches the Microsoft OpenID Connect discovery document and JWKS into "
+        "the cache ahead of them expiring. Suitable for running from cron."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Refetch even if the cached values are not about to expire",
+        )
+        parser.add_argument(
+            "--ahead",
+            type=int,
+            default=CACHE_REFRESH_AHEAD,
+            help=(
+                "Refetch values that expire within this many seconds "
+                "(default: %(default)s)"
+            ),
+        )
+        parser.add_argument(
+            "--tenant",
+            action="append",
+            dest="tenants",
+            help=(
+                "Tenant ID to refresh the metadata of, can be given more than "
+                "once (default: MICROSOFT_AUTH_TENANT_ID)"
+            ),
+        )
+
+    def handle(self, *args, **options):
+        try:
+            refreshed = refresh_metadata(
+                force=options["force"],
+                ahead=options["ahead"],
+                tenants=options["tenants"],
+            )
+        except requests.RequestException as e:
+            raise CommandError("Could not fetch OIDC metadata: {}".format(e))
+
+        if refreshed:
+            for key in refreshed:
+                self.stdout.write(self.style.SUCCESS("Refreshed {}".format(key)))
+        else:
+            self.stdout.write("Nothing refreshed")
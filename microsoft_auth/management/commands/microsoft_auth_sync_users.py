@@ -0,0 +1,58 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+import requests
+
+from microsoft_auth.sync import sync_users
+
+
+class Command(BaseCommand):
+    help = (
+        "Updates the names, emails and active status of users from the "
+        "tenant's directory with Microsoft Graph, only fetching the users that "
+        "changed since the last run. Requires the User.Read.All application "
+        "permission."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--tenant",
+            help="Tenant ID to sync (default: MICROSOFT_AUTH_TENANT_ID)",
+        )
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            help="Sync every user instead of only the ones that changed",
+        )
+        parser.add_argument(
+            "--page-size",
+            type=int,
+            help="Number of users to ask Graph for per page (at most 999)",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            stats = sync_users(
+                tenant=options["tenant"],
+                full=options["full"],
+                page_size=options["page_size"],
+            )
+        except ImproperlyConfigured as e:
+            raise CommandError(str(e))
+        except requests.RequestException as e:
+            raise CommandError(
+                "Could not sync users, run again to continue: {}".format(e)
+            )
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                "Synced {pages} page(s): {updated} users updated, {deactivated} "
+                "deactivated, {reactivated} reactivated, {unmatched} not "
+                "found".format(
+                    pages=stats["pages"],
+                    updated=stats["updated"],
+                    deactivated=stats["deactivated"],
+                    reactivated=stats["reactivated"],
+                    unmatched=stats["unmatched"],
+                )
+            )
+        )
@@ -0,0 +1,355 @@
+from collections import Counter, namedtuple
+from email.utils import parsedate_to_datetime
+import logging
+import os
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+import requests
+
+from .conf import (
+    CACHE_LOCK_TIMEOUT,
+    CACHE_LOCK_WAIT,
+    CACHE_RETRY_INTERVAL,
+    CACHE_STALE_TIMEOUT,
+    CACHE_TIMEOUT,
+    config,
+)
+
+logger = logging.getLogger("django")
+
+""" Django cache backed storage for the OpenID Connect metadata (discovery
+    document and JWKS) used by `microsoft_auth.client.MicrosoftClient`
+
+    Values are stored in an envelope with the time they should be refreshed
+    at and are kept in the cache for CACHE_STALE_TIMEOUT seconds longer than
+    that, so an expired value can still be served while a single caller
+    refreshes it in the background (stale-while-revalidate).
+
+    Only one caller fetches a given key at a time: a `threading.Lock` per key
+    covers a single process and a short-lived lock added to the Django cache
+    covers every other node sharing that cache.
+
+    Fetches are conditional requests using the ETag/Last-Modified of the
+    cached value, and how long a value stays fresh comes from the response's
+    Cache-Control/Expires headers, clamped to
+    MICROSOFT_AUTH_METADATA_MIN_TTL and MICROSOFT_AUTH_METADATA_MAX_TTL.
+"""
+
+MetadataResponse = namedtuple(
+    "MetadataResponse", ["value", "timeout", "etag", "last_modified"]
+)
+
+# counts of notable metadata events in this process, for instrumentation
+stats = Counter()
+
+_locks = {}
+_locks_lock = threading.Lock()
+_refresh_threads = {}
+# values served (as stale) when a key is missing from the cache, e.g. loaded
+# from a metadata snapshot
+_defaults = {}
+
+
+def _get_lock(key):
+    with _locks_lock:
+        if key not in _locks:
+            _locks[key] = threading.Lock()
+        return _locks[key]
+
+
+def _get_lock_key(key):
+    return "{}_lock".format(key)
+
+
+def get_entry(key):
+    """Returns the cached envelope for key or None if there is not one"""
+
+    return cache.get(key)
+
+
+def set_metadata(key, value, timeout=CACHE_TIMEOUT, etag=None, last_modified=None):
+    entry = {
+        "value": value,
+        "expires": time.time() + timeout,
+        "etag": etag,
+        "last_modified": last_modified,
+    }
+    cache.set(key, entry, timeout + CACHE_STALE_TIMEOUT)
+    return entry
+
+
+def get_max_age(response):
+    """Returns how long (in seconds) response may be cached for according to
+    its Cache-Control or Expires headers, or None if it does not say"""
+
+    headers = response.headers
+    max_age = None
+
+    directives = {}
+    for directive in headers.get("Cache-Control", "").split(","):
+        name, _, value = directive.strip().partition("=")
+        directives[name.lower()] = value.strip('"')
+
+    if "no-store" in directives or "no-cache" in directives:
+        return 0
+
+    for name in ("s-maxage", "max-age"):
+        try:
+            max_age = int(directives[name])
+        except (KeyError, ValueError):
+            continue
+        break
+
+    if max_age is None and "Expires" in headers:
+        try:
+            expires = parsedate_to_datetime(headers["Expires"]).timestamp()
+        except (TypeError, ValueError):
+            # invalid dates (such as "0") mean already expired
+            return 0
+        try:
+            date = parsedate_to_datetime(headers["Date"]).timestamp()
+        except (KeyError, TypeError, ValueError):
+            date = time.time()
+        max_age = int(expires - date)
+
+    if max_age is not None:
+        try:
+            max_age -= int(headers.get("Age", 0))
+        except ValueError:
+            pass
+    return max_age
+
+
+def _clamp_timeout(timeout):
+    min_ttl = config.MICROSOFT_AUTH_METADATA_MIN_TTL
+    max_ttl = config.MICROSOFT_AUTH_METADATA_MAX_TTL
+    return max(min_ttl, min(max_ttl, timeout))
+
+
+def get_json(session, url, entry=None, parse=None):
+    """GETs the JSON document at url, revalidating entry if given
+
+    Sends If-None-Match/If-Modified-Since for the cached entry so an
+    unchanged document comes back as an empty 304. Returns a
+    `MetadataResponse` with the (optionally parsed) value, or None if the
+    request failed or parse returned None.
+    """
+
+    headers = {}
+    if entry is not None:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+    if headers:
+        response = session.get(url, headers=headers)
+    else:
+        response = session.get(url)
+
+    if response.status_code == 304 and entry is not None:
+        stats["not_modified"] += 1
+        value = entry["value"]
+        etag = response.headers.get("ETag", entry.get("etag"))
+        last_modified = response.headers.get(
+            "Last-Modified", entry.get("last_modified")
+        )
+    elif response.ok:
+        value = response.json()
+        if parse is not None:
+            value = parse(value)
+            if value is None:
+                return None
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+    else:
+        return None
+
+    return MetadataResponse(value, get_max_age(response), etag, last_modified)
+
+
+def set_default(key, value):
+    """Sets the value to serve for key if it is ever missing from the cache"""
+
+    _defaults[key] = value
+
+
+def _is_fresh(entry):
+    return entry is not None and entry["expires"] > time.time()
+
+
+def needs_refresh(key, ahead=0):
+    """Whether key is missing or expires within `ahead` seconds"""
+
+    entry = get_entry(key)
+    return entry is None or entry["expires"] - ahead <= time.time()
+
+
+def _wait_for_refresh(key):
+    """Waits for another node to finish refreshing key"""
+
+    deadline = time.monotonic() + CACHE_LOCK_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(0.1)
+
+        entry = get_entry(key)
+        if _is_fresh(entry):
+            return entry
+        if cache.get(_get_lock_key(key)) is None:
+            break
+    return None
+
+
+def refresh(key, fetch, timeout=CACHE_TIMEOUT, force=False):
+    """Fetches a new value for key using fetch and stores it in the cache
+
+    If another caller in this process is already refreshing key, waits for
+    it and uses its result. If another node holds the cache lock, the stale
+    value is returned if there is one, otherwise waits up to CACHE_LOCK_WAIT
+    seconds for that node before fetching anyway.
+
+    fetch is passed the current entry (or None) and should return the new
+    value, a `MetadataResponse` or None if the value could not be retrieved,
+    in which case the stale value (if any) is kept and returned. Network
+    errors are only raised if there is no stale value to fall back to.
+    """
+
+    with _get_lock(key):
+        entry = get_entry(key)
+        if not force and _is_fresh(entry):
+            return entry["value"]
+
+        lock_key = _get_lock_key(key)
+        locked = cache.add(lock_key, True, CACHE_LOCK_TIMEOUT)
+        if not locked:
+            if entry is not None:
+                return entry["value"]
+
+            entry = _wait_for_refresh(key)
+            if entry is not None:
+                return entry["value"]
+
+        try:
+            stats["fetch"] += 1
+            value = fetch(entry)
+        except requests.RequestException as e:
+            # nothing to fall back to, let the caller see the error
+            if entry is None:
+                raise
+            logger.warning("could not refresh {}: {}".format(key, e))
+            stats["fetch_error"] += 1
+            value = None
+        finally:
+            if locked:
+                cache.delete(lock_key)
+
+        if isinstance(value, MetadataResponse):
+            if value.timeout is not None:
+                timeout = value.timeout
+            return set_metadata(
+                key,
+                value.value,
+                _clamp_timeout(timeout),
+                etag=value.etag,
+                last_modified=value.last_modified,
+            )["value"]
+        if value is not None:
+            return set_metadata(key, value, timeout)["value"]
+        if entry is not None:
+            # keep serving the stale value, but do not try again straight away
+            entry = dict(entry, retry=time.time() + CACHE_RETRY_INTERVAL)
+            cache.set(key, entry, CACHE_STALE_TIMEOUT)
+            return entry["value"]
+        return None
+
+
+def _background_refresh(key, fetch, timeout):
+    try:
+        refresh(key, fetch, timeout)
+    finally:
+        cache.close()
+
+
+def refresh_in_background(key, fetch, timeout=CACHE_TIMEOUT):
+    """Starts refreshing key in a daemon thread unless one is already
+    running for it in this process"""
+
+    with _locks_lock:
+        thread = _refresh_threads.get(key)
+        if thread is not None and thread.is_alive():
+            return thread
+
+        thread = threading.Thread(
+            target=_background_refresh,
+            args=(key, fetch, timeout),
+            name="microsoft_auth-refresh-{}".format(key),
+            daemon=True,
+        )
+        _refresh_threads[key] = thread
+
+    thread.start()
+    return thread
+
+
+def get_metadata(key, fetch, timeout=CACHE_TIMEOUT):
+    """Returns the cached value for key
+
+    A missing value is fetched synchronously (once across all callers),
+    unless a default was set for key. An expired value (or the default) is
+    returned as is and refreshed in the background, at most once every
+    CACHE_RETRY_INTERVAL seconds while refreshing keeps failing.
+    """
+
+    entry = get_entry(key)
+    if entry is None:
+        if key not in _defaults:
+            return refresh(key, fetch, timeout)
+        entry = set_metadata(key, _defaults[key], 0)
+
+    if not _is_fresh(entry) and entry.get("retry", 0) <= time.time():
+        refresh_in_background(key, fetch, timeout)
+    return entry["value"]
+
+
+async def aget_metadata(key, fetch, timeout=CACHE_TIMEOUT):
+    """Async version of `get_metadata`
+
+    Only fetching a missing value blocks, so that is done in a worker
+    thread; cached values are returned (and refreshed) as in
+    `get_metadata`.
+    """
+
+    if get_entry(key) is None and key not in _defaults:
+        return await sync_to_async(refresh, thread_sensitive=False)(key, fetch, timeout)
+    return get_metadata(key, fetch, timeout)
+
+
+class MetadataRefresher(threading.Thread):
+    """Daemon thread that calls `refresh` straight away and then every
+    `interval` seconds until stopped"""
+
+    def __init__(self, interval, refresh):
+        super().__init__(name="microsoft_auth-metadata-refresher", daemon=True)
+
+        self.interval = interval
+        self.pid = os.getpid()
+        self._refresh = refresh
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self._refresh()
+            except Exception:
+                # keep running, the next run might succeed
+                logger.exception("could not refresh OIDC metadata")
+            finally:
+                cache.close()
+
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
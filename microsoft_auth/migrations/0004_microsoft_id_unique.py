@@ -0,0 +1,36 @@
+from django.db import migrations, models
+
+
+def check_duplicates(apps, schema_editor):
+    MicrosoftAccount = apps.get_model("microsoft_auth", "MicrosoftAccount")
+
+    duplicates = (
+        MicrosoftAccount.objects.using(schema_editor.connection.alias)
+        .values("microsoft_id")
+        .annotate(count=models.Count("id"))
+        .filter(count__gt=1)
+        .count()
+    )
+    if duplicates:
+        raise RuntimeError(
+            "{} microsoft_id(s) belong to more than one Microsoft account, run "
+            "`manage.py microsoft_auth_dedupe_accounts` before migrating".format(
+                duplicates
+            )
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("microsoft_auth", "0003_microsoft_id_openid")]
+
+    operations = [
+        migrations.RunPython(check_duplicates, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="microsoftaccount",
+            name="microsoft_id",
+            field=models.CharField(
+                max_length=64, unique=True, verbose_name="microsoft account id"
+            ),
+        ),
+    ]
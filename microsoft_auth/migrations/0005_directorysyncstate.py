@@ -0,0 +1,43 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("microsoft_auth", "0004_microsoft_id_unique")]
+
+    operations = [
+        migrations.CreateModel(
+            name="DirectorySyncState",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "tenant_id",
+                    models.CharField(
+                        max_length=64, unique=True, verbose_name="tenant id"
+                    ),
+                ),
+                (
+                    "delta_link",
+                    models.TextField(blank=True, verbose_name="delta link"),
+                ),
+                (
+                    "next_link",
+                    models.TextField(blank=True, verbose_name="next link"),
+                ),
+                (
+                    "last_sync",
+                    models.DateTimeField(
+                        blank=True, null=True, verbose_name="last completed sync"
+                    ),
+                ),
+            ],
+        )
+    ]
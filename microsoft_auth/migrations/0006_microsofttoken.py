@@ -0,0 +1,42 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("microsoft_auth", "0005_directorysyncstate")]
+
+    operations = [
+        migrations.CreateModel(
+            name="MicrosoftToken",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("access_token", models.TextField(verbose_name="access token")),
+                (
+                    "refresh_token",
+                    models.TextField(blank=True, verbose_name="refresh token"),
+                ),
+                (
+                    "expires_at",
+                    models.DateTimeField(verbose_name="access token expires at"),
+                ),
+                ("scope", models.TextField(blank=True, verbose_name="scope")),
+                (
+                    "account",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="token",
+                        to="microsoft_auth.microsoftaccount",
+                    ),
+                ),
+            ],
+        )
+    ]
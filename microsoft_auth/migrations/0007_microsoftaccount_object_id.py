@@ -0,0 +1,30 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("microsoft_auth", "0006_microsofttoken")]
+
+    operations = [
+        migrations.AddField(
+            model_name="microsoftaccount",
+            name="object_id",
+            field=models.CharField(
+                blank=True,
+                max_length=64,
+                null=True,
+                unique=True,
+                verbose_name="directory object id",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="microsoftaccount",
+            name="microsoft_id",
+            field=models.CharField(
+                max_length=64,
+                null=True,
+                unique=True,
+                verbose_name="microsoft account id",
+            ),
+        ),
+    ]
@@ -22,7 +22,15 @@ for field in User._meta.fields:
 
 
 class MicrosoftAccount(models.Model):
-    microsoft_id = models.CharField(_("microsoft account id"), max_length=64)
+    # the `sub` claim, not known yet for accounts imported ahead of the
+    # first login
+    microsoft_id = models.CharField(
+        _("microsoft account id"), max_length=64, unique=True, null=True
+    )
+    # the `oid` claim, the ID of the user in the directory
+    object_id = models.CharField(
+        _("directory object id"), max_length=64, unique=True, null=True, blank=True
+    )
     user = models.OneToOneField(
         settings.AUTH_USER_MODEL,
         on_delete=models.CASCADE,
@@ -31,7 +39,7 @@ class MicrosoftAccount(models.Model):
     )
 
     def __str__(self):
-        return self.microsoft_id
+        return self.microsoft_id or self.object_id or ""
 
 
 class XboxLiveAccount(models.Model):
@@ -46,3 +54,30 @@ class XboxLiveAccount(models.Model):
 
     def __str__(self):
         return self.gamertag
+
+
+class DirectorySyncState(models.Model):
+    tenant_id = models.CharField(_("tenant id"), max_length=64, unique=True)
+    delta_link = models.TextField(_("delta link"), blank=True)
+    next_link = models.TextField(_("next link"), blank=True)
+    last_sync = models.DateTimeField(_("last completed sync"), null=True, blank=True)
+
+    def __str__(self):
+        return self.tenant_id
+
+
+class MicrosoftToken(models.Model):
+    """OAuth tokens of a Microsoft account, stored when
+    MICROSOFT_AUTH_STORE_TOKENS is enabled. The tokens are encrypted, use
+    `microsoft_auth.tokens.get_valid_token` to read them."""
+
+    account = models.OneToOneField(
+        MicrosoftAccount, on_delete=models.CASCADE, related_name="token"
+    )
+    access_token = models.TextField(_("access token"))
+    refresh_token = models.TextField(_("refresh token"), blank=True)
+    expires_at = models.DateTimeField(_("access token expires at"))
+    scope = models.TextField(_("scope"), blank=True)
+
+    def __str__(self):
+        return str(self.account)
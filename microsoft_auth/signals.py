@@ -0,0 +1,71 @@
+from django.contrib.auth import get_user_model
+from django.contrib.sites.models import Site
+from django.db.models.signals import post_delete, post_init, post_save
+from django.test.signals import setting_changed
+
+from .backends import clear_cached_user
+from .client import clear_resolved
+from .conf import config, config_reloaded
+from .models import MicrosoftAccount, XboxLiveAccount
+from .utils import clear_hooks
+
+""" Keeps values microsoft_auth resolves once (redirect URIs, scopes, hooks)
+    in sync with the `Site` objects and settings they are built from, and
+    users cached by `MicrosoftAuthenticationBackend.get_user` in sync with
+    the users and accounts
+"""
+
+User = get_user_model()
+
+
+def site_changed(*args, **kwargs):
+    clear_resolved()
+
+
+def config_changed(*args, **kwargs):
+    # the redirect URI also depends on non MICROSOFT_AUTH_ settings (DEBUG,
+    # ROOT_URLCONF, SITE_ID) and settings only change like this in tests
+    clear_resolved()
+    clear_hooks()
+
+
+def user_changed(sender, instance, **kwargs):
+    if config.MICROSOFT_AUTH_USER_CACHE_TIMEOUT:
+        clear_cached_user(instance.pk)
+
+
+def account_loaded(sender, instance, **kwargs):
+    # remember the user the account belongs to, in case it is unlinked or
+    # moved to another user (user_id could be deferred, do not load it)
+    instance._microsoft_auth_user_id = instance.__dict__.get("user_id")
+
+
+def account_changed(sender, instance, **kwargs):
+    if config.MICROSOFT_AUTH_USER_CACHE_TIMEOUT:
+        user_id = instance.__dict__.get("user_id")
+        clear_cached_user(user_id)
+
+        previous_user_id = getattr(instance, "_microsoft_auth_user_id", None)
+        if previous_user_id != user_id:
+            clear_cached_user(previous_user_id)
+    instance._microsoft_auth_user_id = instance.__dict__.get("user_id")
+
+
+post_save.connect(site_changed, sender=Site, dispatch_uid="microsoft_auth_site")
+post_delete.connect(site_changed, sender=Site, dispatch_uid="microsoft_auth_site")
+setting_changed.connect(config_changed, dispatch_uid="microsoft_auth_config")
+# also sent for changes made with django-constance, including on other nodes
+config_reloaded.connect(config_changed, dispatch_uid="microsoft_auth_config")
+
+post_save.connect(user_changed, sender=User, dispatch_uid="microsoft_auth_user")
+post_delete.connect(user_changed, sender=User, dispatch_uid="microsoft_auth_user")
+for account_model in (MicrosoftAccount, XboxLiveAccount):
+    post_init.connect(
+        account_loaded, sender=account_model, dispatch_uid="microsoft_auth_account"
+    )
+    post_save.connect(
+        account_changed, sender=account_model, dispatch_uid="microsoft_auth_account"
+    )
+    post_delete.connect(
+        account_changed, sender=account_model, dispatch_uid="microsoft_auth_account"
+    )
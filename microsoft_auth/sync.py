@@ -0,0 +1,176 @@
+from collections import Counter
+import logging
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.utils import timezone
+import requests
+
+from .backends import clear_cached_user
+from .conf import GRAPH_USER_FIELDS, config
+from .graph import GraphClient
+from .models import DirectorySyncState, MicrosoftAccount
+from .utils import split_name
+
+logger = logging.getLogger("django")
+User = get_user_model()
+
+""" Incremental sync of users from a tenant's directory with Microsoft
+    Graph delta queries (`users/delta`)
+
+    The first sync pages through every user in the directory, later ones
+    only through the users that changed since the previous one. Each page
+    is applied in its own transaction together with the link to the next
+    page, so memory use does not grow with the size of the directory and
+    an interrupted sync continues from the last page that was applied.
+
+    Users are only updated, never created: directory users are matched to
+    Django users by the directory object ID of their Microsoft account
+    (known for accounts created by `microsoft_auth_import_users`) or else
+    by email.
+    Users that are disabled or deleted in the directory are deactivated,
+    and activated again when they are enabled.
+"""
+
+# fields of User that can be changed by a sync
+SYNC_FIELDS = ["first_name", "last_name", "email", "is_active"]
+
+
+def _get_email(entry):
+    return entry.get("mail") or entry.get("userPrincipalName")
+
+
+def _apply_entry(user, entry):
+    """Updates user from a delta entry, which only has the properties that
+    changed. Returns whether user was changed."""
+
+    if "@removed" in entry or entry.get("accountEnabled") is False:
+        if user.is_active:
+            user.is_active = False
+            return True
+        return False
+
+    changed = False
+    if entry.get("accountEnabled") is True and not user.is_active:
+        user.is_active = True
+        changed = True
+
+    first_name = entry.get("givenName", user.first_name) or ""
+    last_name = entry.get("surname", user.last_name) or ""
+    if not first_name and not last_name and entry.get("displayName"):
+        first_name, last_name = split_name(entry["displayName"])
+
+    email = entry.get("mail") or user.email
+    for field, value in (
+        ("first_name", first_name[:150]),
+        ("last_name", last_name[:150]),
+        ("email", email),
+    ):
+        if getattr(user, field) != value:
+            setattr(user, field, value)
+            changed = True
+    return changed
+
+
+def apply_page(entries, stats):
+    """Applies a page of delta entries to the matching users, with a fixed
+    number of queries"""
+
+    ids = [entry["id"] for entry in entries]
+    users = {}
+    for account in MicrosoftAccount.objects.filter(
+        object_id__in=ids, user__isnull=False
+    ).select_related("user"):
+        users[account.object_id] = account.user
+
+    # entries for deleted users only have their ID
+    emails = [
+        _get_email(entry)
+        for entry in entries
+        if entry["id"] not in users and _get_email(entry)
+    ]
+    by_email = {}
+    for user in User._default_manager.filter(email__in=emails):
+        by_email.setdefault(user.email, []).append(user)
+
+    changed = {}
+    for entry in entries:
+        user = users.get(entry["id"])
+        if user is None:
+            matches = by_email.get(_get_email(entry), [])
+            if len(matches) != 1:
+                stats["unmatched"] += 1
+                continue
+            user = matches[0]
+
+        user = changed.get(user.pk, user)
+        was_active = user.is_active
+        if _apply_entry(user, entry):
+            changed[user.pk] = user
+            if was_active and not user.is_active:
+                stats["deactivated"] += 1
+            elif not was_active and user.is_active:
+                stats["reactivated"] += 1
+            else:
+                stats["updated"] += 1
+
+    if changed:
+        User._default_manager.bulk_update(list(changed.values()), SYNC_FIELDS)
+    return list(changed)
+
+
+def get_delta_url():
+    return "users/delta?$select={}".format(",".join(GRAPH_USER_FIELDS))
+
+
+def sync_users(tenant=None, client=None, full=False, page_size=None):
+    """Applies the changes to the tenant's users since the last sync (or
+    all users if there was none or full is True) and returns a `Counter`
+    of what was done"""
+
+    if client is None:
+        client = GraphClient(tenant)
+    stats = Counter()
+
+    state, _ = DirectorySyncState.objects.get_or_create(tenant_id=client.tenant)
+    if full:
+        state.delta_link = state.next_link = ""
+
+    headers = {}
+    if page_size:
+        headers["Prefer"] = "odata.maxpagesize={}".format(page_size)
+
+    url = state.next_link or state.delta_link or get_delta_url()
+    while url:
+        try:
+            page = client.get(url, headers=headers)
+        except requests.HTTPError as e:
+            if (
+                e.response is None
+                or e.response.status_code != 410
+                or not (state.next_link or state.delta_link)
+            ):
+                raise
+            # the delta token expired, Graph wants a full sync
+            logger.warning("delta token for {} expired".format(client.tenant))
+            state.delta_link = state.next_link = ""
+            url = get_delta_url()
+            continue
+
+        with transaction.atomic():
+            changed = apply_page(page.get("value", []), stats)
+
+            state.next_link = page.get("@odata.nextLink", "")
+            if "@odata.deltaLink" in page:
+                state.delta_link = page["@odata.deltaLink"]
+                state.last_sync = timezone.now()
+            state.save()
+
+        # bulk_update does not send the signals that clear cached users
+        if config.MICROSOFT_AUTH_USER_CACHE_TIMEOUT:
+            for user_id in changed:
+                clear_cached_user(user_id)
+
+        stats["pages"] += 1
+        url = state.next_link
+    return stats
@@ -0,0 +1,192 @@
+import base64
+from datetime import datetime, timedelta, timezone as dt_timezone
+import hashlib
+import logging
+import threading
+import weakref
+
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import transport
+from .client import get_openid_config
+from .conf import TOKEN_REFRESH_AHEAD, config
+from .models import MicrosoftToken
+
+logger = logging.getLogger("django")
+
+""" Encrypted storage of the OAuth tokens of users that logged in with a
+    Microsoft account (MICROSOFT_AUTH_STORE_TOKENS), so they can be used to
+    call Microsoft Graph on the user's behalf after the login
+
+    Tokens are encrypted with Fernet (from cryptography, which PyJWT
+    already requires) using the keys in MICROSOFT_AUTH_TOKEN_KEYS (Django
+    settings only), or a key derived from SECRET_KEY if there are none.
+    The first key encrypts, all of them decrypt, so a new key can be put
+    in front of the old ones to rotate them.
+
+    Access tokens are refreshed with the refresh token shortly before they
+    expire. Only one caller refreshes a given token at a time: a
+    `threading.Lock` per token covers a single process and a row lock
+    (`select_for_update`) the other processes, which then use the token
+    that was refreshed while they waited instead of refreshing it again.
+"""
+
+_fernets = {}
+# a lock only lives as long as a caller holds it
+_locks = weakref.WeakValueDictionary()
+_locks_lock = threading.Lock()
+
+
+def _get_fernet():
+    keys = getattr(settings, "MICROSOFT_AUTH_TOKEN_KEYS", None)
+    if not keys:
+        digest = hashlib.sha256(
+            "microsoft_auth.tokens:{}".format(settings.SECRET_KEY).encode("utf8")
+        ).digest()
+        keys = [base64.urlsafe_b64encode(digest)]
+    keys = tuple(keys)
+
+    fernet = _fernets.get(keys)
+    if fernet is None:
+        fernet = _fernets[keys] = MultiFernet([Fernet(key) for key in keys])
+    return fernet
+
+
+def encrypt(value):
+    if not value:
+        return ""
+    return _get_fernet().encrypt(value.encode("utf8")).decode("ascii")
+
+
+def decrypt(value):
+    """Decrypts a stored token, raises `cryptography.fernet.InvalidToken`
+    if none of the keys can"""
+
+    if not value:
+        return ""
+    return _get_fernet().decrypt(value.encode("ascii")).decode("utf8")
+
+
+def _get_lock(token_id):
+    with _locks_lock:
+        lock = _locks.get(token_id)
+        if lock is None:
+            lock = _locks[token_id] = threading.Lock()
+        return lock
+
+
+def _set_token(stored, token):
+    """Copies an OAuth token response to stored, keeping the old refresh
+    token if there is no new one"""
+
+    stored.access_token = encrypt(token["access_token"])
+    if token.get("refresh_token"):
+        stored.refresh_token = encrypt(token["refresh_token"])
+
+    if token.get("expires_at"):
+        stored.expires_at = datetime.fromtimestamp(
+            float(token["expires_at"]), tz=dt_timezone.utc
+        )
+    else:
+        stored.expires_at = timezone.now() + timedelta(
+            seconds=int(token.get("expires_in", 3600))
+        )
+
+    scope = token.get("scope", stored.scope)
+    if not isinstance(scope, str):
+        scope = " ".join(scope)
+    stored.scope = scope
+
+
+def save_token(account, token):
+    """Stores (or replaces) the OAuth token of a Microsoft account"""
+
+    stored = MicrosoftToken.objects.filter(account=account).first()
+    if stored is None:
+        stored = MicrosoftToken(account=account)
+    _set_token(stored, token)
+    stored.save()
+    return stored
+
+
+def _expires_soon(stored):
+    return stored.expires_at <= timezone.now() + timedelta(seconds=TOKEN_REFRESH_AHEAD)
+
+
+def _get_error(response):
+    try:
+        return response.json().get("error")
+    except (AttributeError, ValueError):
+        return None
+
+
+def _refresh(stored):
+    """Gets a new access token with the refresh token. Returns None (and
+    forgets the tokens) if the refresh token is no longer valid."""
+
+    session = transport.get_session()
+    response = session.post(
+        get_openid_config(session)["token_endpoint"],
+        data={
+            "grant_type": "refresh_token",
+            "client_id": config.MICROSOFT_AUTH_CLIENT_ID,
+            "client_secret": config.MICROSOFT_AUTH_CLIENT_SECRET,
+            "refresh_token": decrypt(stored.refresh_token),
+            "scope": stored.scope,
+        },
+    )
+    # invalid_grant: the refresh token expired, was revoked or consent
+    # was withdrawn, the user has to log in again. Other errors (a bad
+    # request or client configuration) say nothing about the token.
+    if response.status_code == 400 and _get_error(response) == "invalid_grant":
+        logger.warning(
+            "could not refresh token for account {}: {}".format(
+                stored.account_id, response.text
+            )
+        )
+        stored.delete()
+        return None
+    response.raise_for_status()
+
+    _set_token(stored, response.json())
+    stored.save()
+    return stored
+
+
+def get_valid_token(user):
+    """Returns an access token for user that is valid for at least
+    TOKEN_REFRESH_AHEAD seconds, refreshing it if needed, or None if there
+    is no usable token and the user has to log in again
+
+    Raises `requests.RequestException` if the token endpoint could not be
+    reached or returned an error other than `invalid_grant`.
+    """
+
+    stored = MicrosoftToken.objects.filter(account__user=user).first()
+    if stored is None:
+        return None
+
+    try:
+        if not _expires_soon(stored):
+            return decrypt(stored.access_token)
+
+        with _get_lock(stored.pk), transaction.atomic():
+            stored = MicrosoftToken.objects.select_for_update().filter(pk=stored.pk)
+            stored = stored.first()
+            if stored is None:
+                return None
+
+            # another caller may have refreshed it while we waited
+            if _expires_soon(stored):
+                if not stored.refresh_token:
+                    return None
+                stored = _refresh(stored)
+                if stored is None:
+                    return None
+            return decrypt(stored.access_token)
+    except InvalidToken:
+        logger.warning("could not decrypt stored token, the key may have changed")
+        return None
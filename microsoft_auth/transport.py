@@ -0,0 +1,185 @@
+import asyncio
+import os
+import threading
+import weakref
+
+from django.core.exceptions import ImproperlyConfigured
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .conf import HTTP_RETRY_STATUSES, config
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover
+    httpx = None
+
+""" Process-wide HTTP transport for every request made to Microsoft and
+    Xbox Live
+
+    A single `requests` adapter (and so a single set of keep-alive connection
+    pools, one per host) is shared by every `MicrosoftClient`, the metadata
+    session and the Xbox Live calls, so a login reuses connections opened by
+    earlier ones instead of paying for new TCP and TLS handshakes.
+    `AsyncMicrosoftClient` gets the same from one `httpx.AsyncClient` per
+    event loop.
+
+    Pools are never shared across processes: a process forked after the
+    adapter was created (e.g. `gunicorn --preload`) gets its own.
+"""
+
+_adapter = None
+_session = None
+_async_clients = weakref.WeakKeyDictionary()
+_async_pid = None
+_lock = threading.Lock()
+
+
+class TransportAdapter(HTTPAdapter):
+    """`HTTPAdapter` that applies the configured timeouts to requests that
+    do not set their own and stays open when a session using it is
+    closed"""
+
+    def __init__(self, timeout=None, **kwargs):
+        self.timeout = timeout
+        self.pid = os.getpid()
+        super().__init__(**kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.timeout
+        return super().send(request, timeout=timeout, **kwargs)
+
+    def close(self):
+        # shared by every session, closing a client must not close the pools
+        pass
+
+    def reset(self):
+        super().close()
+
+
+def _create_adapter():
+    retry = Retry(
+        total=config.MICROSOFT_AUTH_HTTP_RETRIES,
+        backoff_factor=config.MICROSOFT_AUTH_HTTP_BACKOFF_FACTOR,
+        status_forcelist=HTTP_RETRY_STATUSES,
+        # never retry token requests and other POSTs once they were sent
+        allowed_methods=frozenset(["HEAD", "GET", "OPTIONS"]),
+        raise_on_status=False,
+    )
+
+    return TransportAdapter(
+        timeout=(
+            config.MICROSOFT_AUTH_HTTP_CONNECT_TIMEOUT,
+            config.MICROSOFT_AUTH_HTTP_READ_TIMEOUT,
+        ),
+        pool_connections=config.MICROSOFT_AUTH_HTTP_POOL_CONNECTIONS,
+        pool_maxsize=config.MICROSOFT_AUTH_HTTP_POOL_MAXSIZE,
+        max_retries=retry,
+    )
+
+
+def get_adapter():
+    """Returns the adapter for this process, creating it if needed"""
+
+    global _adapter, _session
+
+    with _lock:
+        if _adapter is None or _adapter.pid != os.getpid():
+            # connections inherited from a parent process are not ours to use
+            _adapter = _create_adapter()
+            _session = None
+        return _adapter
+
+
+def mount(session):
+    """Routes all HTTP(S) requests made with session through the shared
+    adapter"""
+
+    adapter = get_adapter()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session():
+    """Returns a `requests.Session` for requests that are not tied to a
+    user, such as fetching the OpenID Connect metadata"""
+
+    global _session
+
+    adapter = get_adapter()
+    with _lock:
+        if _session is None or _session.get_adapter("https://") is not adapter:
+            _session = requests.Session()
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        if config.MICROSOFT_AUTH_PROXIES:
+            _session.proxies = config.MICROSOFT_AUTH_PROXIES
+        else:
+            _session.proxies = {}
+        return _session
+
+
+def _create_async_client():
+    limits = httpx.Limits(
+        max_connections=None,
+        max_keepalive_connections=config.MICROSOFT_AUTH_HTTP_POOL_MAXSIZE,
+    )
+    # httpx only retries failed connections, never requests that were sent
+    retries = config.MICROSOFT_AUTH_HTTP_RETRIES
+
+    mounts = {}
+    for scheme, proxy in config.MICROSOFT_AUTH_PROXIES.items():
+        mounts["{}://".format(scheme)] = httpx.AsyncHTTPTransport(
+            proxy=proxy, limits=limits, retries=retries
+        )
+
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(
+            config.MICROSOFT_AUTH_HTTP_READ_TIMEOUT,
+            connect=config.MICROSOFT_AUTH_HTTP_CONNECT_TIMEOUT,
+        ),
+        transport=httpx.AsyncHTTPTransport(limits=limits, retries=retries),
+        mounts=mounts,
+    )
+
+
+def get_async_client():
+    """Returns the `httpx.AsyncClient` for the running event loop, creating
+    it if needed. Requires httpx (`django_microsoft_auth[async]`)."""
+
+    global _async_pid
+
+    if httpx is None:
+        raise ImproperlyConfigured(
+            "httpx is required for async support, "
+            "install django_microsoft_auth[async]"
+        )
+
+    loop = asyncio.get_running_loop()
+    with _lock:
+        if _async_pid != os.getpid():
+            _async_clients.clear()
+            _async_pid = os.getpid()
+
+        client = _async_clients.get(loop)
+        if client is None or client.is_closed:
+            client = _create_async_client()
+            _async_clients[loop] = client
+        return client
+
+
+def reset():
+    """Closes all pooled connections and drops the adapter, e.g. after
+    changing the HTTP settings"""
+
+    global _adapter, _session
+
+    with _lock:
+        if _adapter is not None and _adapter.pid == os.getpid():
+            _adapter.reset()
+        _adapter = None
+        _session = None
+        _async_clients.clear()
@@ -9,15 +9,21 @@ urlpatterns = []
 if config.MICROSOFT_AUTH_LOGIN_ENABLED:  # pragma: no branch
     from . import views
 
+    callback_view = views.AuthenticateCallbackView
+    callback_redirect = views.AuthenticateCallbackRedirect
+    if config.MICROSOFT_AUTH_ASYNC_VIEWS:
+        callback_view = views.AsyncAuthenticateCallbackView
+        callback_redirect = views.AsyncAuthenticateCallbackRedirect
+
     urlpatterns = [
         path(
             "auth-callback/",
-            views.AuthenticateCallbackView.as_view(),
+            callback_view.as_view(),
             name="auth-callback",
         ),
         path(
             "from-auth-redirect/",
-            views.AuthenticateCallbackRedirect.as_view(),
+            callback_redirect.as_view(),
             name="from-auth-redirect",
         ),
         path(
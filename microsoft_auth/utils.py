@@ -2,6 +2,9 @@ import importlib
 
 from .conf import HOOK_SETTINGS, config as global_config
 
+# hook setting name -> tuple of callables
+_hooks = {}
+
 
 def get_scheme(request, config=None):
     if config is None:
@@ -16,13 +19,75 @@ def get_scheme(request, config=None):
     return scheme
 
 
-def get_hook(name):
+def split_name(fullname):
+    """Splits a display name from Microsoft ("First Last", "Last, First" or
+    "first.last") into a (first_name, last_name) tuple"""
+
+    first_name, last_name = "", ""
+    if fullname is not None:
+        if ", " in fullname:
+            last_name, first_name = fullname.split(", ")
+        elif " " in fullname:
+            first_name, last_name = fullname.split(" ", 1)
+        elif "." in fullname:
+            first_name, last_name = fullname.split(".", 1)
+        else:
+            first_name = fullname
+    return first_name, last_name
+
+
+def get_username(preferred_username):
+    """Returns the username for a new user from their Microsoft
+    preferred_username (UPN)"""
+
+    return preferred_username[:150]
+
+
+def get_hook_paths(hook_setting):
+    """Returns the python paths in a hook setting, which can be a comma
+    separated string or a list"""
+
+    if isinstance(hook_setting, str):
+        hook_setting = hook_setting.split(",")
+    return [path.strip() for path in hook_setting if path.strip()]
+
+
+def _import_hook(path):
+    module_path, function_name = path.rsplit(".", 1)
+    module = importlib.import_module(module_path)
+    return getattr(module, function_name)
+
+
+def get_hooks(name):
+    """Returns a tuple of the callables configured for the hook setting
+    name, in the order they should be called
+
+    Hooks are imported on first use and kept until the config is reloaded
+    (see `clear_hooks`)
+    """
+
+    try:
+        return _hooks[name]
+    except KeyError:
+        pass
+
+    hooks = ()
     if name in HOOK_SETTINGS:
         hook_setting = getattr(global_config, name)
-        if hook_setting != "":
-            module_path, function_name = hook_setting.rsplit(".", 1)
-            module = importlib.import_module(module_path)
-            function = getattr(module, function_name)
+        hooks = tuple(_import_hook(path) for path in get_hook_paths(hook_setting))
+    _hooks[name] = hooks
+    return hooks
 
-            return function
+
+def get_hook(name):
+    """Returns the first callable configured for the hook setting name or
+    None, use `get_hooks` to get all of them"""
+
+    hooks = get_hooks(name)
+    if hooks:
+        return hooks[0]
     return None
+
+
+def clear_hooks():
+    _hooks.clear()
@@ -1,9 +1,15 @@
+import inspect
 import json
 import logging
 import re
 
-from django.contrib.auth import authenticate, login
+from asgiref.sync import sync_to_async
+import django
+from django.conf import settings
+from django.contrib.auth import authenticate, load_backend, login
+from django.contrib.auth.signals import user_login_failed
 from django.contrib.sites.models import Site
+from django.core.exceptions import PermissionDenied
 from django.core.signing import BadSignature, SignatureExpired, loads
 from django.http import HttpResponse
 from django.middleware.csrf import CSRF_TOKEN_LENGTH
@@ -14,12 +20,56 @@ from django.utils.translation import gettext as _
 from django.views import View
 from django.views.decorators.csrf import csrf_exempt
 
-from .context_processors import microsoft
-from .utils import get_hook, get_scheme
+from .conf import pinned_config
+from .context_processors import get_authorization_url
+from .utils import get_hooks, get_scheme
+
+try:
+    from django.contrib.auth import alogin
+except ImportError:  # pragma: no cover
+    # Django < 5.0
+    alogin = sync_to_async(login)
 
 logger = logging.getLogger("django")
 
 
+async def _aauthenticate(request=None, **credentials):
+    """`django.contrib.auth.aauthenticate` for Django < 5.2, where it only
+    runs `authenticate` in a thread and so never uses the backends'
+    `aauthenticate`"""
+
+    for backend_path in settings.AUTHENTICATION_BACKENDS:
+        backend = load_backend(backend_path)
+        try:
+            inspect.signature(backend.authenticate).bind(request, **credentials)
+        except TypeError:
+            # this backend doesn't accept these credentials
+            continue
+
+        try:
+            if hasattr(backend, "aauthenticate"):
+                user = await backend.aauthenticate(request, **credentials)
+            else:
+                user = await sync_to_async(backend.authenticate)(request, **credentials)
+        except PermissionDenied:
+            # this backend says to stop in our tracks
+            break
+        if user is not None:
+            user.backend = backend_path
+            return user
+
+    await sync_to_async(user_login_failed.send)(
+        sender="django.contrib.auth", credentials=credentials, request=request
+    )
+    return None
+
+
+if django.VERSION >= (5, 2):
+    from django.contrib.auth import aauthenticate
+else:  # pragma: no cover
+    aauthenticate = _aauthenticate
+
+
 class AuthenticateCallbackView(View):
     """Authentication callback for Microsoft to call as part of OAuth2
         implicit grant flow
@@ -49,7 +99,19 @@ class AuthenticateCallbackView(View):
 
     def get_context_data(self, **kwargs):
         domain = Site.objects.get_current(self.request).domain
+        self._check_request(domain, **kwargs)
+
+        # validates the code param and logs user in
+        self._authenticate(kwargs.get("code"))
+
+        self._populate_error_description()
 
+        for function in get_hooks("MICROSOFT_AUTH_CALLBACK_HOOK"):
+            self.context = function(self.request, self.context)
+
+        return self._finalize_context()
+
+    def _check_request(self, domain, **kwargs):
         scheme = get_scheme(self.request)
 
         self.context = {
@@ -68,9 +130,7 @@ class AuthenticateCallbackView(View):
             kwargs.get("error"), kwargs.get("error_description")
         )
 
-        # validates the code param and logs user in
-        self._authenticate(kwargs.get("code"))
-
+    def _populate_error_description(self):
         # populates error_description if it does not exist yet
         if (
             "error" in self.context["message"]
@@ -80,10 +140,7 @@ class AuthenticateCallbackView(View):
                 self.context["message"]["error"]
             ]
 
-        function = get_hook("MICROSOFT_AUTH_CALLBACK_HOOK")
-        if function is not None:
-            self.context = function(self.request, self.context)
-
+    def _finalize_context(self):
         self.context["message"] = mark_safe(  # nosec
             json.dumps({"microsoft_auth": self.context["message"]})
         )
@@ -164,7 +221,7 @@ class AuthenticateCallbackView(View):
 
 
 def to_ms_redirect(request):
-    url = microsoft(request)["microsoft_authorization_url"]
+    url = get_authorization_url(request)
     return redirect(url)
 
 
@@ -182,3 +239,70 @@ class AuthenticateCallbackRedirect(AuthenticateCallbackView):
             return HttpResponse(context["message"], status=400)
         else:
             return redirect(context.get("next", "/"))
+
+
+class AsyncAuthenticateCallbackMixin:
+    """Makes a callback view async, so the token exchange and requests to
+    Microsoft and Xbox Live do not tie up a thread under ASGI
+
+    Requires httpx (`django_microsoft_auth[async]`).
+    """
+
+    async def aget_context_data(self, **kwargs):
+        # the config is read from a snapshot resolved in a thread
+        async with pinned_config():
+            site = await sync_to_async(Site.objects.get_current)(self.request)
+            self._check_request(site.domain, **kwargs)
+
+            # validates the code param and logs user in
+            await self._aauthenticate(kwargs.get("code"))
+
+            self._populate_error_description()
+
+            for function in get_hooks("MICROSOFT_AUTH_CALLBACK_HOOK"):
+                self.context = await sync_to_async(function)(self.request, self.context)
+
+            return self._finalize_context()
+
+    async def _aauthenticate(self, code):
+        if "error" not in self.context["message"]:
+            if code is None:
+                self.context["message"] = {"error": "missing_code"}
+            else:
+                # authenticate user using Microsoft code
+                user = await aauthenticate(self.request, code=code)
+                if user is None:
+                    self.context["message"] = {"error": "login_failed"}
+                else:
+                    await alogin(self.request, user)
+
+
+class AsyncAuthenticateCallbackView(
+    AsyncAuthenticateCallbackMixin, AuthenticateCallbackView
+):
+    async def post(self, request):
+        context = await self.aget_context_data(**request.POST.dict())
+
+        status_code = 200
+        if "error" in context["message"]:
+            status_code = 400
+
+        # context processors may hit the database
+        return await sync_to_async(render)(
+            request,
+            "microsoft/auth_callback.html",
+            context,
+            status=status_code,
+        )
+
+
+class AsyncAuthenticateCallbackRedirect(
+    AsyncAuthenticateCallbackMixin, AuthenticateCallbackRedirect
+):
+    async def post(self, request):
+        context = await self.aget_context_data(**request.POST.dict())
+
+        if "error" in context["message"]:
+            return HttpResponse(context["message"], status=400)
+        else:
+            return redirect(context.get("next", "/"))
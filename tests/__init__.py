@@ -1,7 +1,13 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+from unittest.mock import Mock
+
 from django.test import (
     TestCase as BaseTestCase,
     TransactionTestCase as BaseTransactionTestCase,
 )
+from requests.structures import CaseInsensitiveDict
 
 
 class TestServerSiteMixin:
@@ -20,3 +26,80 @@ class TestCase(TestServerSiteMixin, BaseTestCase):
 
 class TransactionTestCase(TestServerSiteMixin, BaseTransactionTestCase):
     pass
+
+
+def get_response(data=None, status_code=200, headers=None):
+    """Returns a fake `requests.Response` with a JSON body"""
+
+    return Mock(
+        status_code=status_code,
+        ok=status_code < 400,
+        headers=CaseInsensitiveDict(headers or {}),
+        json=Mock(return_value=data),
+    )
+
+
+class GraphServer:
+    """Local HTTP server standing in for the Microsoft identity platform and
+    Microsoft Graph
+
+    `routes` maps "METHOD /path?query" to the JSON to respond with, a
+    (status_code, data) or (status_code, data, headers) tuple, a list of
+    any of these to respond with in turn or a function that is passed the
+    request body and returns one of them.
+    Requests are recorded in `requests` as (method, path, headers, body).
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self.requests = []
+
+        graph_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _respond(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length).decode("utf8")
+                graph_server.requests.append(
+                    (self.command, self.path, dict(self.headers), body)
+                )
+
+                status_code, data, headers = graph_server.get_response(
+                    "{} {}".format(self.command, self.path), body
+                )
+                content = json.dumps(data).encode("utf8")
+                self.send_response(status_code)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_GET = do_POST = _respond
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:{}".format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def get_response(self, route, body=""):
+        response = self.routes.get(route, (404, {"error": "not found"}))
+        if callable(response):
+            response = response(body)
+        if isinstance(response, list):
+            response = response.pop(0) if len(response) > 1 else response[0]
+        if not isinstance(response, tuple):
+            response = (200, response)
+        if len(response) == 2:
+            response = response + ({},)
+        return response
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -1,6 +1,8 @@
 import io
 import sys
+from unittest.mock import patch
 
+from django.apps import apps
 from django.core.management import call_command
 from django.core.management.base import SystemCheckError
 from django.test import modify_settings, override_settings
@@ -113,3 +115,22 @@ class ChecksTests(TransactionTestCase):
         call_command("check")
 
         self.assertNotIn("microsoft_auth", self.captured.getvalue())
+
+    @override_settings(
+        MICROSOFT_AUTH_AUTHENTICATE_HOOK="tests.test_apps.hook_callback,bogus.function"
+    )
+    def test_config_hook_multiple_invalid(self):
+        with self.assertRaises(SystemCheckError) as exc:
+            call_command("check")
+
+        self.assertIn("microsoft_auth.E003", str(exc.exception))
+
+
+class MicrosoftAuthConfigTests(TransactionTestCase):
+    @override_settings(MICROSOFT_AUTH_METADATA_REFRESH_INTERVAL=60)
+    @patch("microsoft_auth.client.start_metadata_refresher")
+    def test_ready(self, mock_start):
+        apps.get_app_config("microsoft_auth").ready()
+
+        # started by the first login instead, not by management commands
+        mock_start.assert_not_called()
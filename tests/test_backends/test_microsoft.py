@@ -1,11 +1,20 @@
-from unittest.mock import Mock, patch
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from unittest.mock import AsyncMock, Mock, call, patch
 
+from asgiref.sync import async_to_sync
 from django.contrib.auth import authenticate, get_user_model
+from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import IntegrityError, OperationalError, connection
 from django.test import RequestFactory, override_settings
 
+from microsoft_auth.backends import MicrosoftAuthenticationBackend, get_user_cache_key
+from microsoft_auth.conf import LOGIN_CONFLICT_RETRIES, SimpleConfig
 from microsoft_auth.models import MicrosoftAccount
 
-from .. import TestCase
+from .. import TestCase, TransactionTestCase
 
 CODE = "test_code"
 TOKEN = {"access_token": "test_token", "scope": ["test"]}
@@ -118,6 +127,66 @@ class MicrosoftBackendsTests(TestCase):
         self.assertIsNot(user, None)
         self.assertEqual(user.id, self.linked_account.user.id)
 
+    @patch("microsoft_auth.backends.AsyncMicrosoftClient")
+    async def test_aauthenticate_existing_user(self, mock_client):
+        mock_auth = Mock()
+        mock_auth.afetch_token = AsyncMock(return_value=TOKEN)
+        mock_auth.valid_scopes.return_value = True
+        mock_auth.aget_claims = AsyncMock(
+            return_value={"sub": self.linked_account.microsoft_id}
+        )
+
+        mock_client.return_value = mock_auth
+
+        user = await MicrosoftAuthenticationBackend().aauthenticate(
+            self.request, code=CODE
+        )
+
+        self.assertIsNot(user, None)
+        self.assertEqual(user.id, self.linked_account.user_id)
+        mock_auth.afetch_token.assert_awaited_once_with(code=CODE)
+
+    @patch.object(SimpleConfig, "_is_expired", autospec=True)
+    @patch("microsoft_auth.backends.AsyncMicrosoftClient")
+    async def test_aauthenticate_config_in_thread(self, mock_client, mock_expired):
+        def is_expired(config):
+            # reloading could query constance, not on the event loop
+            with self.assertRaises(RuntimeError):
+                asyncio.get_running_loop()
+            return True
+
+        mock_expired.side_effect = is_expired
+        mock_auth = Mock()
+        mock_auth.afetch_token = AsyncMock(return_value=TOKEN)
+        mock_auth.valid_scopes.return_value = True
+        mock_auth.aget_claims = AsyncMock(
+            return_value={"sub": self.linked_account.microsoft_id}
+        )
+
+        mock_client.return_value = mock_auth
+
+        user = await MicrosoftAuthenticationBackend().aauthenticate(
+            self.request, code=CODE
+        )
+
+        self.assertEqual(user.id, self.linked_account.user_id)
+        mock_expired.assert_called()
+
+    @patch("microsoft_auth.backends.AsyncMicrosoftClient")
+    async def test_aauthenticate_invalid_profile(self, mock_client):
+        mock_auth = Mock()
+        mock_auth.afetch_token = AsyncMock(return_value=TOKEN)
+        mock_auth.valid_scopes.return_value = True
+        mock_auth.aget_claims = AsyncMock(return_value=None)
+
+        mock_client.return_value = mock_auth
+
+        user = await MicrosoftAuthenticationBackend().aauthenticate(
+            self.request, code=CODE
+        )
+
+        self.assertIs(user, None)
+
     @patch("microsoft_auth.backends.MicrosoftClient")
     def test_authenticate_existing_user_missing_user(self, mock_client):
         mock_auth = Mock()
@@ -382,10 +451,10 @@ class MicrosoftBackendsTests(TestCase):
         MICROSOFT_AUTH_AUTHENTICATE_HOOK="tests.test_backends.test_microsoft.hook_callback"  # noqa
     )
     @patch("microsoft_auth.backends.MicrosoftClient")
-    @patch("microsoft_auth.backends.get_hook")
-    def test_authenticate_hook(self, mock_get_hook, mock_client):
+    @patch("microsoft_auth.backends.get_hooks")
+    def test_authenticate_hook(self, mock_get_hooks, mock_client):
         mock_hook = Mock()
-        mock_get_hook.return_value = mock_hook
+        mock_get_hooks.return_value = (mock_hook,)
 
         mock_auth = Mock()
         mock_auth.fetch_token.return_value = TOKEN
@@ -408,3 +477,344 @@ class MicrosoftBackendsTests(TestCase):
         self.assertEqual(self.unlinked_user.id, self.unlinked_account.user.id)
 
         mock_hook.assert_called_with(user, TOKEN)
+
+    @patch("microsoft_auth.backends.MicrosoftClient")
+    @patch("microsoft_auth.backends.get_hooks")
+    def test_authenticate_hooks_in_order(self, mock_get_hooks, mock_client):
+        mock_hooks = Mock()
+        mock_get_hooks.return_value = (mock_hooks.first, mock_hooks.second)
+
+        mock_auth = Mock()
+        mock_auth.fetch_token.return_value = TOKEN
+        mock_auth.valid_scopes.return_value = True
+        mock_auth.get_claims.return_value = {
+            "sub": self.unlinked_account.microsoft_id,
+            "email": self.unlinked_user.email,
+            "name": "{} {}".format(FIRST, LAST),
+            "preferred_username": EMAIL,
+        }
+        mock_auth.token = TOKEN
+
+        mock_client.return_value = mock_auth
+
+        user = authenticate(self.request, code=CODE)
+
+        self.assertEqual(
+            [call.first(user, TOKEN), call.second(user, TOKEN)],
+            mock_hooks.mock_calls,
+        )
+
+
+@override_settings(
+    AUTHENTICATION_BACKENDS=["microsoft_auth.backends.MicrosoftAuthenticationBackend"]
+)
+class MicrosoftBackendsQueryTests(TransactionTestCase):
+    """Query budget of a login, see docs/usage.rst
+
+    The BEGIN and COMMIT of the login's transaction are counted as well
+    (+ 2)
+    """
+
+    def setUp(self):
+        super().setUp()
+
+        User = get_user_model()
+
+        self.request = RequestFactory().get("/")
+        self.user = User.objects.create(username="user1", email=EMAIL2)
+        MicrosoftAccount.objects.create(microsoft_id="test_id", user=self.user)
+
+        # like Azure AD id_tokens, with the directory object ID
+        self.claims = {
+            "sub": MISSING_ID,
+            "oid": "test_oid",
+            "email": EMAIL,
+            "name": "{} {}".format(FIRST, LAST),
+            "preferred_username": EMAIL,
+        }
+        self.mock_auth = Mock()
+        self.mock_auth.fetch_token.return_value = TOKEN
+        self.mock_auth.valid_scopes.return_value = True
+        self.mock_auth.get_claims.return_value = self.claims
+
+        patcher = patch(
+            "microsoft_auth.backends.MicrosoftClient", return_value=self.mock_auth
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_returning_user(self):
+        self.claims["sub"] = "test_id"
+
+        with self.assertNumQueries(1 + 2):
+            user = authenticate(self.request, code=CODE)
+        self.assertEqual(self.user, user)
+
+    def test_new_user(self):
+        # savepoint, insert and release are get_or_create's
+        with self.assertNumQueries(6 + 2):
+            user = authenticate(self.request, code=CODE)
+        self.assertEqual(MISSING_ID, user.microsoft_account.microsoft_id)
+
+    def test_imported_user(self):
+        User = get_user_model()
+        imported = User.objects.create(username="user2", email=EMAIL)
+        MicrosoftAccount.objects.create(object_id="test_oid", user=imported)
+
+        with self.assertNumQueries(2 + 2):
+            user = authenticate(self.request, code=CODE)
+        self.assertEqual(imported, user)
+        self.assertEqual(MISSING_ID, user.microsoft_account.microsoft_id)
+
+    def test_sub_preferred(self):
+        User = get_user_model()
+        imported = User.objects.create(username="user2", email=EMAIL)
+        MicrosoftAccount.objects.create(object_id="test_oid", user=imported)
+        self.claims["sub"] = "test_id"
+
+        with self.assertNumQueries(1 + 2):
+            user = authenticate(self.request, code=CODE)
+        self.assertEqual(self.user, user)
+        self.assertIsNone(MicrosoftAccount.objects.get(user=imported).microsoft_id)
+
+    def test_existing_user(self):
+        User = get_user_model()
+        existing = User.objects.create(
+            username="user2", email=EMAIL, first_name=FIRST, last_name=LAST
+        )
+
+        with self.assertNumQueries(3 + 2):
+            user = authenticate(self.request, code=CODE)
+        self.assertEqual(existing, user)
+
+    @override_settings(MICROSOFT_AUTH_AUTO_REPLACE_ACCOUNTS=True)
+    def test_replace_account(self):
+        self.claims["email"] = EMAIL2
+        self.user.first_name = FIRST
+        self.user.save()
+
+        with self.assertNumQueries(4 + 2):
+            user = authenticate(self.request, code=CODE)
+        self.assertEqual(MISSING_ID, user.microsoft_account.microsoft_id)
+
+
+class MicrosoftBackendsConcurrencyTests(TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.claims = {
+            "sub": MISSING_ID,
+            "email": EMAIL,
+            "name": "{} {}".format(FIRST, LAST),
+            "preferred_username": EMAIL,
+        }
+
+    def test_conflict_retried(self):
+        User = get_user_model()
+        backend = MicrosoftAuthenticationBackend()
+        get_microsoft_user = backend._get_microsoft_user
+
+        # another login for the same account committed after this one
+        # looked the account up
+        other = User.objects.create(username="other", email=EMAIL)
+        MicrosoftAccount.objects.create(microsoft_id=MISSING_ID, user=other)
+        missed = [MicrosoftAccount(microsoft_id=MISSING_ID)]
+
+        def _get_microsoft_user(data):
+            if missed:
+                return missed.pop()
+            return get_microsoft_user(data)
+
+        with patch.object(
+            backend, "_get_microsoft_user", side_effect=_get_microsoft_user
+        ) as mock_get:
+            user = backend._get_user_from_microsoft(self.claims)
+
+        self.assertEqual(2, mock_get.call_count)
+        self.assertEqual("other", user.username)
+        self.assertEqual(1, MicrosoftAccount.objects.count())
+        self.assertEqual(1, User.objects.filter(email=EMAIL).count())
+
+    @override_settings(MICROSOFT_AUTH_AUTO_REPLACE_ACCOUNTS=True)
+    def test_conflict_gives_up(self):
+        backend = MicrosoftAuthenticationBackend()
+
+        with patch.object(
+            backend, "_verify_microsoft_user", side_effect=IntegrityError
+        ) as mock_verify:
+            with self.assertRaises(IntegrityError):
+                backend._get_user_from_microsoft(self.claims)
+
+        self.assertEqual(LOGIN_CONFLICT_RETRIES, mock_verify.call_count)
+        self.assertFalse(MicrosoftAccount.objects.exists())
+
+    @patch("microsoft_auth.backends.time.sleep")
+    def test_lock_error_retried(self, mock_sleep):
+        backend = MicrosoftAuthenticationBackend()
+        verify = backend._verify_microsoft_user
+        locked = [OperationalError("database is locked")]
+
+        def _verify_microsoft_user(*args):
+            if locked:
+                raise locked.pop()
+            return verify(*args)
+
+        with patch.object(
+            backend, "_verify_microsoft_user", side_effect=_verify_microsoft_user
+        ):
+            user = backend._get_user_from_microsoft(self.claims)
+
+        self.assertEqual(EMAIL, user.email)
+        mock_sleep.assert_called_once()
+
+    def test_other_operational_error(self):
+        backend = MicrosoftAuthenticationBackend()
+
+        with patch.object(
+            backend,
+            "_verify_microsoft_user",
+            side_effect=OperationalError("no such table"),
+        ) as mock_verify:
+            with self.assertRaises(OperationalError):
+                backend._get_user_from_microsoft(self.claims)
+
+        mock_verify.assert_called_once()
+
+    def test_concurrent_first_logins(self):
+        User = get_user_model()
+        workers = 8
+        barrier = threading.Barrier(workers)
+
+        def _login():
+            try:
+                barrier.wait()
+                backend = MicrosoftAuthenticationBackend()
+                return backend._get_user_from_microsoft(dict(self.claims)).pk
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(workers) as executor:
+            futures = [executor.submit(_login) for _ in range(workers)]
+            user_ids = {future.result() for future in futures}
+
+        self.assertEqual(1, len(user_ids))
+        self.assertEqual(1, MicrosoftAccount.objects.count())
+        self.assertEqual(1, User.objects.filter(email=EMAIL).count())
+        self.assertEqual(
+            user_ids.pop(),
+            MicrosoftAccount.objects.get(microsoft_id=MISSING_ID).user_id,
+        )
+
+
+@override_settings(MICROSOFT_AUTH_USER_CACHE_TIMEOUT=300)
+class UserCacheTests(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+        User = get_user_model()
+
+        self.backend = MicrosoftAuthenticationBackend()
+        self.user = User.objects.create(username="user1", email=EMAIL)
+        self.account = MicrosoftAccount.objects.create(
+            microsoft_id="test_id", user=self.user
+        )
+
+    def test_get_user_cached(self):
+        with self.assertNumQueries(1):
+            user = self.backend.get_user(self.user.pk)
+
+        with self.assertNumQueries(0):
+            user = self.backend.get_user(self.user.pk)
+            self.assertEqual(self.user, user)
+            self.assertEqual(self.account, user.microsoft_account)
+
+    def test_get_user_snapshot(self):
+        self.backend.get_user(self.user.pk)
+
+        snapshot = cache.get(get_user_cache_key(self.user.pk))
+        self.assertEqual("user1", snapshot["user"]["username"])
+        self.assertEqual("test_id", snapshot["microsoft_account"]["microsoft_id"])
+        self.assertIsNone(snapshot["xbox_live_account"])
+
+        with self.assertNumQueries(0):
+            user = self.backend.get_user(self.user.pk)
+            self.assertFalse(user._state.adding)
+            self.assertEqual(user, user.microsoft_account.user)
+            with self.assertRaises(ObjectDoesNotExist):
+                user.xbox_live_account
+
+    def test_get_user_old_snapshot(self):
+        self.backend.get_user(self.user.pk)
+        # cached before the field existed
+        key = get_user_cache_key(self.user.pk)
+        snapshot = cache.get(key)
+        del snapshot["user"]["email"]
+        cache.set(key, snapshot)
+
+        user = self.backend.get_user(self.user.pk)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(EMAIL, user.email)
+
+    def test_aget_user_cached(self):
+        self.backend.get_user(self.user.pk)
+
+        with self.assertNumQueries(0):
+            user = async_to_sync(self.backend.aget_user)(self.user.pk)
+        self.assertEqual(self.user, user)
+
+    @override_settings(MICROSOFT_AUTH_USER_CACHE_TIMEOUT=0)
+    def test_get_user_disabled(self):
+        self.backend.get_user(self.user.pk)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.user, self.backend.get_user(self.user.pk))
+
+    def test_get_user_missing(self):
+        self.assertIsNone(self.backend.get_user(0))
+
+    def test_get_user_inactive(self):
+        self.user.is_active = False
+        self.user.save()
+
+        self.assertIsNone(self.backend.get_user(self.user.pk))
+
+    def test_user_saved(self):
+        self.backend.get_user(self.user.pk)
+
+        self.user.first_name = FIRST
+        self.user.save()
+
+        self.assertEqual(FIRST, self.backend.get_user(self.user.pk).first_name)
+
+    def test_user_deleted(self):
+        self.backend.get_user(self.user.pk)
+
+        self.user.delete()
+
+        self.assertIsNone(self.backend.get_user(self.user.pk))
+
+    def test_account_unlinked(self):
+        self.backend.get_user(self.user.pk)
+
+        account = MicrosoftAccount.objects.get(pk=self.account.pk)
+        account.user = None
+        account.save()
+
+        user = self.backend.get_user(self.user.pk)
+        with self.assertRaises(MicrosoftAccount.DoesNotExist):
+            user.microsoft_account
+
+    def test_account_linked(self):
+        User = get_user_model()
+        other = User.objects.create(username="user2", email=EMAIL2)
+        self.backend.get_user(other.pk)
+
+        MicrosoftAccount.objects.create(microsoft_id="other_id", user=other)
+
+        self.assertEqual(
+            "other_id", self.backend.get_user(other.pk).microsoft_account.microsoft_id
+        )
@@ -1,12 +1,13 @@
-from unittest.mock import Mock, patch
+from unittest.mock import AsyncMock, Mock, patch
 
 from django.contrib.auth import authenticate, get_user_model
 from django.test import RequestFactory, override_settings
 
+from microsoft_auth.backends import MicrosoftAuthenticationBackend
 from microsoft_auth.conf import LOGIN_TYPE_XBL
 from microsoft_auth.models import XboxLiveAccount
 
-from .. import TestCase
+from .. import TestCase, TransactionTestCase
 
 CODE = "test_code"
 TOKEN = {"access_token": "test_token", "scope": ["test"]}
@@ -70,6 +71,45 @@ class XboxLiveBackendsTests(TestCase):
         self.assertIsNot(user, None)
         self.assertEqual(user.id, self.linked_account.user.id)
 
+    @patch("microsoft_auth.backends.AsyncMicrosoftClient")
+    async def test_aauthenticate_existing_user(self, mock_client):
+        mock_auth = Mock()
+        mock_auth.afetch_token = AsyncMock(return_value=TOKEN)
+        mock_auth.afetch_xbox_token = AsyncMock(return_value=XBOX_TOKEN)
+        mock_auth.valid_scopes.return_value = True
+        mock_auth.aget_xbox_profile = AsyncMock(
+            return_value={
+                "xid": self.linked_account.xbox_id,
+                "gtg": self.linked_account.gamertag,
+            }
+        )
+
+        mock_client.return_value = mock_auth
+
+        user = await MicrosoftAuthenticationBackend().aauthenticate(
+            self.request, code=CODE
+        )
+
+        self.assertIsNot(user, None)
+        self.assertEqual(user.id, self.linked_account.user_id)
+
+    @patch("microsoft_auth.backends.AsyncMicrosoftClient")
+    async def test_aauthenticate_bad_xbox_token(self, mock_client):
+        mock_auth = Mock()
+        mock_auth.afetch_token = AsyncMock(return_value=TOKEN)
+        mock_auth.afetch_xbox_token = AsyncMock(return_value={})
+        mock_auth.valid_scopes.return_value = True
+        mock_auth.aget_xbox_profile = AsyncMock()
+
+        mock_client.return_value = mock_auth
+
+        user = await MicrosoftAuthenticationBackend().aauthenticate(
+            self.request, code=CODE
+        )
+
+        self.assertIs(user, None)
+        mock_auth.aget_xbox_profile.assert_not_awaited()
+
     @patch("microsoft_auth.backends.MicrosoftClient")
     def test_authenticate_existing_user_new_gamertag(self, mock_client):
         mock_auth = Mock()
@@ -173,10 +213,10 @@ class XboxLiveBackendsTests(TestCase):
         MICROSOFT_AUTH_AUTHENTICATE_HOOK="tests.test_backends.test_xbox.hook_callback"  # noqa
     )
     @patch("microsoft_auth.backends.MicrosoftClient")
-    @patch("microsoft_auth.backends.get_hook")
-    def test_authenticate_hook(self, mock_get_hook, mock_client):
+    @patch("microsoft_auth.backends.get_hooks")
+    def test_authenticate_hook(self, mock_get_hooks, mock_client):
         mock_hook = Mock()
-        mock_get_hook.return_value = mock_hook
+        mock_get_hooks.return_value = (mock_hook,)
 
         mock_auth = Mock()
         mock_auth.fetch_token.return_value = TOKEN
@@ -193,3 +233,56 @@ class XboxLiveBackendsTests(TestCase):
         user = authenticate(self.request, code=CODE)
 
         mock_hook.assert_called_with(user, XBOX_TOKEN)
+
+
+@override_settings(
+    AUTHENTICATION_BACKENDS=["microsoft_auth.backends.MicrosoftAuthenticationBackend"],
+    MICROSOFT_AUTH_LOGIN_TYPE=LOGIN_TYPE_XBL,
+)
+class XboxLiveBackendsQueryTests(TransactionTestCase):
+    """Query budget of a login, see docs/usage.rst
+
+    The BEGIN and COMMIT of the login's transaction are counted as well
+    (+ 2)
+    """
+
+    def setUp(self):
+        super().setUp()
+
+        User = get_user_model()
+
+        self.request = RequestFactory().get("/")
+        self.user = User.objects.create(username="user1")
+        XboxLiveAccount.objects.create(
+            xbox_id="test_id", gamertag=GAMERTAG, user=self.user
+        )
+
+        self.mock_auth = Mock()
+        self.mock_auth.fetch_token.return_value = TOKEN
+        self.mock_auth.fetch_xbox_token.return_value = XBOX_TOKEN
+        self.mock_auth.valid_scopes.return_value = True
+        self.mock_auth.get_xbox_profile.return_value = {
+            "xid": "test_id",
+            "gtg": GAMERTAG,
+        }
+
+        patcher = patch(
+            "microsoft_auth.backends.MicrosoftClient", return_value=self.mock_auth
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_returning_user(self):
+        with self.assertNumQueries(1 + 2):
+            user = authenticate(self.request, code=CODE)
+        self.assertEqual(self.user, user)
+
+    def test_new_user(self):
+        self.mock_auth.get_xbox_profile.return_value = {
+            "xid": MISSING_ID,
+            "gtg": "new_gamertag",
+        }
+
+        with self.assertNumQueries(3 + 2):
+            user = authenticate(self.request, code=CODE)
+        self.assertEqual(MISSING_ID, user.xbox_live_account.xbox_id)
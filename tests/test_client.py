@@ -1,15 +1,54 @@
+from concurrent.futures import ProcessPoolExecutor
 import json
+import os
+import tempfile
+import time
+import unittest
 from unittest.mock import Mock, patch
 import urllib.parse
 from urllib.parse import parse_qs, urlparse
 
+from cryptography.hazmat.primitives.asymmetric import rsa
 from django.contrib.sites.models import Site
+from django.core.cache import cache
 from django.test import RequestFactory, override_settings
+import jwt
+from jwt.algorithms import RSAAlgorithm
 
-from microsoft_auth.client import MicrosoftClient
-from microsoft_auth.conf import LOGIN_TYPE_XBL
+from microsoft_auth import client as client_module, metadata
+from microsoft_auth.client import (
+    AsyncMicrosoftClient,
+    AuthorizationUrlBuilder,
+    ClaimsCache,
+    MicrosoftClient,
+    PublicKeyCache,
+    build_authorization_url,
+    claims_cache,
+    export_metadata_snapshot,
+    get_cache_key,
+    get_namespace,
+    get_redirect_uri,
+    get_scopes,
+    load_metadata_snapshot,
+    public_key_cache,
+    setup_metadata,
+    start_metadata_refresher,
+    validate_id_tokens,
+)
+from microsoft_auth.conf import (
+    CACHE_KEY_JWKS,
+    CACHE_KEY_JWKS_REFRESH,
+    CACHE_KEY_OPENID,
+    LOGIN_TYPE_XBL,
+)
+from microsoft_auth.metadata import get_entry, set_metadata, stats
 
-from . import TestCase
+from . import TestCase, get_response
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover
+    httpx = None
 
 STATE = "test_state"
 CLIENT_ID = "test_client_id"
@@ -17,6 +56,26 @@ REDIRECT_URI = "https://testserver/microsoft/auth-callback/"
 ACCESS_TOKEN = "test_access_token"
 XBOX_TOKEN = "test_xbox_token"
 XBOX_PROFILE = "test_profile"
+KID = "test_kid"
+OPENID_CONFIG = {
+    "authorization_endpoint": "https://login.microsoftonline.com/common/oauth2/v2.0/authorize",  # noqa
+    "token_endpoint": "https://login.microsoftonline.com/common/oauth2/v2.0/token",  # noqa
+    "jwks_uri": "https://login.microsoftonline.com/common/discovery/v2.0/keys",
+}
+
+PRIVATE_KEY = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+def get_jwk(kid=KID):
+    jwk = json.loads(RSAAlgorithm.to_jwk(PRIVATE_KEY.public_key()))
+    jwk["kid"] = kid
+    return jwk
+
+
+def get_id_token(kid=KID, **claims):
+    payload = {"sub": "test_sub", "aud": CLIENT_ID}
+    payload.update(claims)
+    return jwt.encode(payload, PRIVATE_KEY, algorithm="RS256", headers={"kid": kid})
 
 
 @override_settings(SITE_ID=1)
@@ -30,6 +89,17 @@ class ClientTests(TestCase):
 
         self.factory = RequestFactory()
 
+        cache.clear()
+        public_key_cache.clear()
+        claims_cache.clear()
+
+    def _set_metadata(self, jwks=None):
+        if jwks is None:
+            jwks = [get_jwk()]
+
+        set_metadata(get_cache_key(CACHE_KEY_OPENID), OPENID_CONFIG)
+        set_metadata(get_cache_key(CACHE_KEY_JWKS), jwks)
+
     def _get_auth_url(
         self, base_url, scopes=MicrosoftClient.SCOPE_MICROSOFT, extra_args=None
     ):
@@ -114,12 +184,12 @@ class ClientTests(TestCase):
         auth_client = MicrosoftClient(state=STATE)
         self.assertEqual(auth_client.proxies, {"all": "http://1.2.3.4:8080"})
 
-    @patch("microsoft_auth.client.requests")
-    def test_fetch_xbox_token(self, mock_requests):
+    @patch("microsoft_auth.client.MicrosoftClient.post")
+    def test_fetch_xbox_token(self, mock_post):
         mock_response = Mock()
         mock_response.status_code = 200
         mock_response.json.return_value = XBOX_TOKEN
-        mock_requests.post.return_value = mock_response
+        mock_post.return_value = mock_response
 
         auth_client = MicrosoftClient()
         auth_client.token = {"access_token": ACCESS_TOKEN}
@@ -128,8 +198,8 @@ class ClientTests(TestCase):
         self.assertEqual(XBOX_TOKEN, xbox_token)
         self.assertEqual(XBOX_TOKEN, auth_client.xbox_token)
 
-    @patch("microsoft_auth.client.requests")
-    def test_fetch_xbox_token_params(self, mock_requests):
+    @patch("microsoft_auth.client.MicrosoftClient.post")
+    def test_fetch_xbox_token_params(self, mock_post):
         expected_headers = {
             "Content-type": "application/json",
             "Accept": "application/json",
@@ -150,17 +220,18 @@ class ClientTests(TestCase):
         auth_client.token = {"access_token": ACCESS_TOKEN}
         auth_client.fetch_xbox_token()
 
-        mock_requests.post.assert_called_with(
+        mock_post.assert_called_with(
             MicrosoftClient._xbox_token_url,
             data=expected_data,
             headers=expected_headers,
+            withhold_token=True,
         )
 
-    @patch("microsoft_auth.client.requests")
-    def test_fetch_xbox_token_bad_response(self, mock_requests):
+    @patch("microsoft_auth.client.MicrosoftClient.post")
+    def test_fetch_xbox_token_bad_response(self, mock_post):
         mock_response = Mock()
         mock_response.status_code = 400
-        mock_requests.post.return_value = mock_response
+        mock_post.return_value = mock_response
 
         auth_client = MicrosoftClient()
         auth_client.token = {"access_token": ACCESS_TOKEN}
@@ -169,12 +240,12 @@ class ClientTests(TestCase):
         self.assertEqual({}, xbox_token)
         self.assertEqual({}, auth_client.xbox_token)
 
-    @patch("microsoft_auth.client.requests")
-    def test_get_xbox_profile(self, mock_requests):
+    @patch("microsoft_auth.client.MicrosoftClient.post")
+    def test_get_xbox_profile(self, mock_post):
         mock_response = Mock()
         mock_response.status_code = 200
         mock_response.json.return_value = {"DisplayClaims": {"xui": [XBOX_PROFILE]}}
-        mock_requests.post.return_value = mock_response
+        mock_post.return_value = mock_response
 
         auth_client = MicrosoftClient()
         auth_client.xbox_token = {"Token": XBOX_TOKEN}
@@ -182,8 +253,8 @@ class ClientTests(TestCase):
 
         self.assertEqual(XBOX_PROFILE, xbox_profile)
 
-    @patch("microsoft_auth.client.requests")
-    def test_get_xbox_profile_params(self, mock_requests):
+    @patch("microsoft_auth.client.MicrosoftClient.post")
+    def test_get_xbox_profile_params(self, mock_post):
         expected_headers = {
             "Content-type": "application/json",
             "Accept": "application/json",
@@ -203,17 +274,18 @@ class ClientTests(TestCase):
         auth_client.xbox_token = {"Token": XBOX_TOKEN}
         auth_client.get_xbox_profile()
 
-        mock_requests.post.assert_called_with(
+        mock_post.assert_called_with(
             MicrosoftClient._profile_url,
             data=expected_data,
             headers=expected_headers,
+            withhold_token=True,
         )
 
-    @patch("microsoft_auth.client.requests")
-    def test_get_xbox_profile_bad_response(self, mock_requests):
+    @patch("microsoft_auth.client.MicrosoftClient.post")
+    def test_get_xbox_profile_bad_response(self, mock_post):
         mock_response = Mock()
         mock_response.status_code = 400
-        mock_requests.post.return_value = mock_response
+        mock_post.return_value = mock_response
 
         auth_client = MicrosoftClient()
         auth_client.xbox_token = {"Token": XBOX_TOKEN}
@@ -277,3 +349,852 @@ class ClientTests(TestCase):
         auth_client = MicrosoftClient(state=STATE)
         base_url = auth_client.openid_config["authorization_endpoint"]
         self.assertRaises(TypeError, self._get_auth_url(base_url, extra_args=[]))
+
+    @override_settings(MICROSOFT_AUTH_CLIENT_ID=CLIENT_ID)
+    def test_get_claims(self):
+        self._set_metadata()
+
+        auth_client = MicrosoftClient()
+        auth_client.token = {"id_token": get_id_token()}
+
+        self.assertEqual(
+            {"sub": "test_sub", "aud": CLIENT_ID}, auth_client.get_claims()
+        )
+
+    @override_settings(MICROSOFT_AUTH_CLIENT_ID=CLIENT_ID)
+    def test_get_claims_bad_audience(self):
+        self._set_metadata()
+
+        auth_client = MicrosoftClient()
+        auth_client.token = {"id_token": get_id_token(aud="other_client_id")}
+
+        self.assertIsNone(auth_client.get_claims())
+
+    @override_settings(MICROSOFT_AUTH_CLIENT_ID=CLIENT_ID)
+    @patch("microsoft_auth.client.RSAAlgorithm.from_jwk", wraps=RSAAlgorithm.from_jwk)
+    def test_get_claims_caches_public_key(self, mock_from_jwk):
+        self._set_metadata()
+
+        auth_client = MicrosoftClient()
+        auth_client.token = {"id_token": get_id_token()}
+        auth_client.get_claims()
+
+        # JWKS cache entry is not needed once the key has been parsed
+        cache.delete(get_cache_key(CACHE_KEY_JWKS))
+        claims = auth_client.get_claims()
+
+        self.assertEqual("test_sub", claims["sub"])
+        mock_from_jwk.assert_called_once()
+        self.assertIsNotNone(public_key_cache.get(get_namespace(), KID))
+
+    @override_settings(
+        MICROSOFT_AUTH_CLIENT_ID=CLIENT_ID, MICROSOFT_AUTH_CLAIMS_CACHE_SIZE=10
+    )
+    @patch("microsoft_auth.client.jwt.decode", wraps=jwt.decode)
+    def test_get_claims_cached(self, mock_decode):
+        self._set_metadata()
+
+        auth_client = MicrosoftClient()
+        auth_client.token = {"id_token": get_id_token(exp=int(time.time()) + 60)}
+        claims = auth_client.get_claims()
+        claims["sub"] = "changed"
+
+        self.assertEqual("test_sub", auth_client.get_claims()["sub"])
+        mock_decode.assert_called_once()
+
+    @override_settings(MICROSOFT_AUTH_CLIENT_ID=CLIENT_ID)
+    @patch("microsoft_auth.client.jwt.decode", wraps=jwt.decode)
+    def test_get_claims_cache_disabled(self, mock_decode):
+        self._set_metadata()
+
+        auth_client = MicrosoftClient()
+        auth_client.token = {"id_token": get_id_token(exp=int(time.time()) + 60)}
+        auth_client.get_claims()
+        auth_client.get_claims()
+
+        self.assertEqual(2, mock_decode.call_count)
+        self.assertEqual(0, len(claims_cache))
+
+    @override_settings(
+        MICROSOFT_AUTH_CLIENT_ID=CLIENT_ID, MICROSOFT_AUTH_CLAIMS_CACHE_SIZE=10
+    )
+    def test_get_claims_cache_per_client(self):
+        self._set_metadata()
+
+        auth_client = MicrosoftClient()
+        auth_client.token = {"id_token": get_id_token(exp=int(time.time()) + 60)}
+        auth_client.get_claims()
+
+        with override_settings(MICROSOFT_AUTH_CLIENT_ID="other_client_id"):
+            self.assertIsNone(auth_client.get_claims())
+
+    @override_settings(MICROSOFT_AUTH_CLIENT_ID=CLIENT_ID)
+    @patch("microsoft_auth.client.MicrosoftClient.get")
+    def test_get_claims_unknown_kid_clears_public_keys(self, mock_get):
+        mock_get.return_value = get_response({"keys": [get_jwk(), get_jwk("kid2")]})
+        public_key_cache.set(get_namespace(), "old_kid", Mock())
+        self._set_metadata()
+
+        auth_client = MicrosoftClient()
+        auth_client.token = {"id_token": get_id_token(kid="new_kid")}
+
+        self.assertIsNone(auth_client.get_claims())
+        mock_get.assert_called_once_with(OPENID_CONFIG["jwks_uri"])
+        self.assertIsNone(public_key_cache.get(get_namespace(), "old_kid"))
+
+    @override_settings(MICROSOFT_AUTH_CLIENT_ID=CLIENT_ID)
+    @patch("microsoft_auth.client.MicrosoftClient.get")
+    def test_get_claims_unknown_kid_refreshed(self, mock_get):
+        mock_get.return_value = get_response({"keys": [get_jwk("new_kid")]})
+        self._set_metadata()
+
+        auth_client = MicrosoftClient()
+        auth_client.token = {"id_token": get_id_token(kid="new_kid")}
+
+        self.assertEqual("test_sub", auth_client.get_claims()["sub"])
+        mock_get.assert_called_once()
+
+    @override_settings(MICROSOFT_AUTH_CLIENT_ID=CLIENT_ID)
+    @patch("microsoft_auth.client.MicrosoftClient.get")
+    def test_get_claims_unknown_kid_no_refresh(self, mock_get):
+        self._set_metadata()
+
+        auth_client = MicrosoftClient()
+        auth_client.token = {"id_token": get_id_token(kid="new_kid")}
+
+        self.assertIsNone(auth_client.get_claims(allow_refresh=False))
+        mock_get.assert_not_called()
+
+    @override_settings(MICROSOFT_AUTH_CLIENT_ID=CLIENT_ID)
+    @patch("microsoft_auth.client.MicrosoftClient.get")
+    def test_get_claims_unknown_kid_negative_cache(self, mock_get):
+        mock_get.return_value = get_response({"keys": [get_jwk()]})
+        self._set_metadata()
+
+        auth_client = MicrosoftClient()
+        auth_client.token = {"id_token": get_id_token(kid="forged_kid")}
+        auth_client.get_claims()
+
+        # allow another forced refresh, the kid itself is already known bad
+        cache.delete(get_cache_key(CACHE_KEY_JWKS_REFRESH))
+        rejected = stats["unknown_kid_rejected"]
+
+        self.assertIsNone(auth_client.get_claims())
+        mock_get.assert_called_once()
+        self.assertEqual(rejected + 1, stats["unknown_kid_rejected"])
+
+    @override_settings(MICROSOFT_AUTH_CLIENT_ID=CLIENT_ID)
+    @patch("microsoft_auth.client.MicrosoftClient.get")
+    def test_get_claims_unknown_kid_throttled(self, mock_get):
+        mock_get.return_value = get_response({"keys": [get_jwk()]})
+        self._set_metadata()
+
+        auth_client = MicrosoftClient()
+        for kid in ("forged_kid1", "forged_kid2", "forged_kid3"):
+            auth_client.token = {"id_token": get_id_token(kid=kid)}
+            self.assertIsNone(auth_client.get_claims())
+
+        mock_get.assert_called_once()
+        self.assertEqual(
+            KID, cache.get(get_cache_key(CACHE_KEY_JWKS))["value"][0]["kid"]
+        )
+
+    @override_settings(MICROSOFT_AUTH_CLIENT_ID=CLIENT_ID)
+    @patch("microsoft_auth.client.MicrosoftClient.get")
+    def test_get_claims_unknown_kid_not_modified(self, mock_get):
+        mock_get.return_value = get_response(status_code=304)
+        public_key_cache.set(get_namespace(), KID, Mock())
+        set_metadata(get_cache_key(CACHE_KEY_OPENID), OPENID_CONFIG)
+        set_metadata(get_cache_key(CACHE_KEY_JWKS), [get_jwk()], etag='"v1"')
+
+        auth_client = MicrosoftClient()
+        auth_client.token = {"id_token": get_id_token(kid="new_kid")}
+
+        self.assertIsNone(auth_client.get_claims())
+        mock_get.assert_called_once_with(
+            OPENID_CONFIG["jwks_uri"], headers={"If-None-Match": '"v1"'}
+        )
+        # unchanged keys stay parsed
+        self.assertIsNotNone(public_key_cache.get(get_namespace(), KID))
+
+    def test_get_claims_malformed_token(self):
+        auth_client = MicrosoftClient()
+        auth_client.token = {"id_token": "not.a.token"}
+
+        self.assertIsNone(auth_client.get_claims())
+
+
+class MetadataRefresherTests(TestCase):
+    def tearDown(self):
+        if client_module.metadata_refresher is not None:
+            client_module.metadata_refresher.stop()
+            client_module.metadata_refresher = None
+
+        super().tearDown()
+
+    @patch("microsoft_auth.client.refresh_metadata")
+    def test_start_metadata_refresher(self, mock_refresh):
+        refresher = start_metadata_refresher(3600)
+
+        self.assertTrue(refresher.is_alive())
+        self.assertIs(refresher, start_metadata_refresher(3600))
+
+    @patch("microsoft_auth.client.refresh_metadata")
+    def test_start_metadata_refresher_after_fork(self, mock_refresh):
+        refresher = start_metadata_refresher(3600)
+        refresher.pid = -1
+
+        self.assertIsNot(refresher, start_metadata_refresher(3600))
+        refresher.stop()
+
+
+class SetupMetadataTests(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        client_module._metadata_pid = None
+        self.addCleanup(setattr, client_module, "_metadata_pid", None)
+
+    @override_settings(SITE_ID=1, MICROSOFT_AUTH_METADATA_REFRESH_INTERVAL=60)
+    @patch("microsoft_auth.client.start_metadata_refresher")
+    def test_refresher(self, mock_start):
+        MicrosoftClient()
+        MicrosoftClient()
+
+        mock_start.assert_called_once_with(60)
+
+    @override_settings(MICROSOFT_AUTH_METADATA_REFRESH_INTERVAL=60)
+    @patch("microsoft_auth.client.start_metadata_refresher")
+    def test_refresher_after_fork(self, mock_start):
+        setup_metadata()
+        client_module._metadata_pid = -1
+        setup_metadata()
+
+        self.assertEqual(2, mock_start.call_count)
+
+    @patch("microsoft_auth.client.start_metadata_refresher")
+    def test_no_refresher(self, mock_start):
+        setup_metadata()
+
+        mock_start.assert_not_called()
+
+    @override_settings(MICROSOFT_AUTH_METADATA_SNAPSHOT="/does/not/exist.json")
+    @patch("microsoft_auth.client.load_metadata_snapshot")
+    def test_snapshot(self, mock_load):
+        setup_metadata()
+        setup_metadata()
+
+        mock_load.assert_called_once_with("/does/not/exist.json")
+
+    @override_settings(MICROSOFT_AUTH_METADATA_SNAPSHOT="/does/not/exist.json")
+    def test_snapshot_missing(self):
+        with self.assertLogs("django", level="WARNING"):
+            setup_metadata()
+
+
+@override_settings(SITE_ID=1, MICROSOFT_AUTH_CLIENT_ID=CLIENT_ID)
+class MetadataSnapshotTests(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        cache.clear()
+        public_key_cache.clear()
+        self.addCleanup(metadata._defaults.clear)
+
+        set_metadata(get_cache_key(CACHE_KEY_OPENID), OPENID_CONFIG)
+        set_metadata(get_cache_key(CACHE_KEY_JWKS), [get_jwk()])
+        self.snapshot = export_metadata_snapshot()
+        cache.clear()
+
+    def _write_snapshot(self, snapshot):
+        fd, path = tempfile.mkstemp(suffix=".json")
+        with os.fdopen(fd, "w") as snapshot_file:
+            json.dump(snapshot, snapshot_file)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_export(self):
+        self.assertEqual(1, self.snapshot["version"])
+        self.assertEqual(
+            [
+                {
+                    "authority": "https://login.microsoftonline.com",
+                    "tenant": "common",
+                    "openid_config": OPENID_CONFIG,
+                    "jwks": [get_jwk()],
+                }
+            ],
+            self.snapshot["tenants"],
+        )
+
+    def test_export_failed(self):
+        session = Mock()
+        session.get.return_value = get_response(status_code=500)
+
+        with self.assertRaises(ValueError):
+            export_metadata_snapshot(session=session)
+
+    def test_load(self):
+        load_metadata_snapshot(self._write_snapshot(self.snapshot))
+
+        # full validation path without network access or mocks
+        auth_client = MicrosoftClient()
+        auth_client.token = {"id_token": get_id_token()}
+
+        self.assertEqual("test_sub", auth_client.get_claims()["sub"])
+        self.assertEqual(
+            OPENID_CONFIG["authorization_endpoint"],
+            auth_client.openid_config["authorization_endpoint"],
+        )
+
+    def test_load_keeps_cached(self):
+        set_metadata(get_cache_key(CACHE_KEY_JWKS), [get_jwk("other_kid")])
+
+        load_metadata_snapshot(self._write_snapshot(self.snapshot))
+
+        self.assertEqual(
+            "other_kid", get_entry(get_cache_key(CACHE_KEY_JWKS))["value"][0]["kid"]
+        )
+
+    @patch("microsoft_auth.metadata.refresh_in_background")
+    def test_load_default(self, mock_refresh):
+        load_metadata_snapshot(self._write_snapshot(self.snapshot))
+        cache.clear()
+
+        self.assertEqual(OPENID_CONFIG, MicrosoftClient().openid_config)
+        mock_refresh.assert_called_once()
+
+    def test_load_bad_version(self):
+        self.snapshot["version"] = 2
+
+        with self.assertRaises(ValueError):
+            load_metadata_snapshot(self._write_snapshot(self.snapshot))
+
+
+class PublicKeyCacheTests(TestCase):
+    NAMESPACE = "test_namespace"
+
+    def test_get_missing(self):
+        self.assertIsNone(PublicKeyCache().get(self.NAMESPACE, KID))
+
+    def test_set_get(self):
+        key_cache = PublicKeyCache()
+        key = Mock()
+        key_cache.set(self.NAMESPACE, KID, key)
+
+        self.assertIs(key, key_cache.get(self.NAMESPACE, KID))
+        self.assertIsNone(key_cache.get("other_namespace", KID))
+
+    @patch("microsoft_auth.client.time.monotonic")
+    def test_expires(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        key_cache = PublicKeyCache(timeout=10)
+        key_cache.set(self.NAMESPACE, KID, Mock())
+
+        mock_monotonic.return_value = 110
+        self.assertIsNone(key_cache.get(self.NAMESPACE, KID))
+        self.assertEqual(0, len(key_cache))
+
+    def test_evicts_least_recently_used(self):
+        key_cache = PublicKeyCache(max_size=2)
+        key_cache.set(self.NAMESPACE, "kid1", Mock())
+        key_cache.set(self.NAMESPACE, "kid2", Mock())
+        key_cache.get(self.NAMESPACE, "kid1")
+        key_cache.set(self.NAMESPACE, "kid3", Mock())
+
+        self.assertIsNotNone(key_cache.get(self.NAMESPACE, "kid1"))
+        self.assertIsNone(key_cache.get(self.NAMESPACE, "kid2"))
+        self.assertIsNotNone(key_cache.get(self.NAMESPACE, "kid3"))
+
+    def test_clear_namespace(self):
+        key_cache = PublicKeyCache()
+        key_cache.set(self.NAMESPACE, KID, Mock())
+        key_cache.set("other_namespace", KID, Mock())
+        key_cache.clear(self.NAMESPACE)
+
+        self.assertIsNone(key_cache.get(self.NAMESPACE, KID))
+        self.assertIsNotNone(key_cache.get("other_namespace", KID))
+
+
+@unittest.skipIf(httpx is None, "httpx is not installed")
+@override_settings(SITE_ID=1, MICROSOFT_AUTH_CLIENT_ID=CLIENT_ID)
+class AsyncClientTests(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        cache.clear()
+        public_key_cache.clear()
+        set_metadata(get_cache_key(CACHE_KEY_OPENID), OPENID_CONFIG)
+        set_metadata(get_cache_key(CACHE_KEY_JWKS), [get_jwk()])
+
+        self.requests = []
+        self.responses = []
+
+        def handler(request):
+            self.requests.append(request)
+            return self.responses.pop(0)
+
+        patcher = patch(
+            "microsoft_auth.transport.get_async_client",
+            side_effect=lambda: httpx.AsyncClient(
+                transport=httpx.MockTransport(handler)
+            ),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.auth_client = AsyncMicrosoftClient()
+
+    @override_settings(MICROSOFT_AUTH_CLIENT_SECRET="test_client_secret")
+    async def test_afetch_token(self):
+        self.responses.append(
+            httpx.Response(
+                200,
+                json={
+                    "access_token": ACCESS_TOKEN,
+                    "token_type": "Bearer",
+                    "scope": MicrosoftClient.SCOPE_MICROSOFT,
+                },
+            )
+        )
+
+        token = await self.auth_client.afetch_token(code="test_code")
+
+        self.assertEqual(ACCESS_TOKEN, token["access_token"])
+        self.assertEqual(token, self.auth_client.token)
+
+        request = self.requests[0]
+        body = parse_qs(request.content.decode("utf8"))
+        self.assertEqual(OPENID_CONFIG["token_endpoint"], str(request.url))
+        self.assertEqual(["test_code"], body["code"])
+        self.assertEqual([CLIENT_ID], body["client_id"])
+        self.assertEqual(["test_client_secret"], body["client_secret"])
+        self.assertEqual([REDIRECT_URI], body["redirect_uri"])
+
+    async def test_aget_claims(self):
+        self.auth_client.token = {"id_token": get_id_token()}
+
+        claims = await self.auth_client.aget_claims()
+
+        self.assertEqual("test_sub", claims["sub"])
+
+    @patch("microsoft_auth.client.get_metadata")
+    async def test_aget_claims_uses_ajwks(self, mock_get_metadata):
+        self.auth_client.token = {"id_token": get_id_token()}
+
+        claims = await self.auth_client.aget_claims()
+
+        self.assertEqual("test_sub", claims["sub"])
+        # the sync lookup could block the event loop on a refresh
+        mock_get_metadata.assert_not_called()
+
+    @patch("microsoft_auth.client.get_json")
+    async def test_aget_claims_unknown_kid(self, mock_get_json):
+        mock_get_json.return_value = metadata.MetadataResponse(
+            [get_jwk("new_kid")], None, None, None
+        )
+        self.auth_client.token = {"id_token": get_id_token("new_kid")}
+
+        claims = await self.auth_client.aget_claims()
+
+        self.assertEqual("test_sub", claims["sub"])
+        mock_get_json.assert_called_once()
+
+    async def test_afetch_xbox_token(self):
+        self.responses.append(httpx.Response(200, json={"Token": XBOX_TOKEN}))
+        self.auth_client.token = {"access_token": ACCESS_TOKEN}
+
+        xbox_token = await self.auth_client.afetch_xbox_token()
+
+        self.assertEqual({"Token": XBOX_TOKEN}, xbox_token)
+        self.assertEqual(MicrosoftClient._xbox_token_url, str(self.requests[0].url))
+        self.assertEqual(
+            "d={}".format(ACCESS_TOKEN),
+            json.loads(self.requests[0].content)["Properties"]["RpsTicket"],
+        )
+
+    async def test_afetch_xbox_token_bad_response(self):
+        self.responses.append(httpx.Response(400))
+        self.auth_client.token = {"access_token": ACCESS_TOKEN}
+        self.auth_client.xbox_token = {}
+
+        self.assertEqual({}, await self.auth_client.afetch_xbox_token())
+
+    async def test_aget_xbox_profile(self):
+        self.responses.append(
+            httpx.Response(200, json={"DisplayClaims": {"xui": [XBOX_PROFILE]}})
+        )
+        self.auth_client.xbox_token = {"Token": XBOX_TOKEN}
+
+        self.assertEqual(XBOX_PROFILE, await self.auth_client.aget_xbox_profile())
+        self.assertEqual(MicrosoftClient._profile_url, str(self.requests[0].url))
+
+    async def test_aget_xbox_profile_no_token(self):
+        self.auth_client.xbox_token = {}
+
+        self.assertEqual({}, await self.auth_client.aget_xbox_profile())
+        self.assertEqual([], self.requests)
+
+
+@override_settings(SITE_ID=1, MICROSOFT_AUTH_CLIENT_ID=CLIENT_ID)
+class AuthorizationUrlBuilderTests(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        cache.clear()
+        set_metadata(get_cache_key(CACHE_KEY_OPENID), OPENID_CONFIG)
+
+        self.factory = RequestFactory()
+
+    def _assert_same_url(self, expected, actual):
+        expected, actual = urlparse(expected), urlparse(actual)
+
+        self.assertEqual(expected._replace(query=""), actual._replace(query=""))
+        self.assertEqual(parse_qs(expected.query), parse_qs(actual.query))
+
+    def test_build(self):
+        url = AuthorizationUrlBuilder().build(STATE)
+
+        self._assert_same_url(MicrosoftClient(state=STATE).authorization_url()[0], url)
+
+    @override_settings(MICROSOFT_AUTH_LOGIN_TYPE=LOGIN_TYPE_XBL)
+    def test_build_xbl(self):
+        url = AuthorizationUrlBuilder().build(STATE)
+
+        self.assertTrue(url.startswith(MicrosoftClient._xbox_authorization_url))
+        self._assert_same_url(MicrosoftClient(state=STATE).authorization_url()[0], url)
+
+    @override_settings(MICROSOFT_AUTH_EXTRA_PARAMETERS={"prompt": "select_account"})
+    def test_build_extra_parameters(self):
+        url = AuthorizationUrlBuilder().build(STATE)
+
+        query = parse_qs(urlparse(url).query)
+        self.assertEqual(["select_account"], query["prompt"])
+        self.assertEqual(["form_post"], query["response_mode"])
+        self.assertEqual(
+            {"prompt": "select_account"},
+            client_module.config.MICROSOFT_AUTH_EXTRA_PARAMETERS,
+        )
+
+    def test_build_redirect(self):
+        request = self.factory.get("/microsoft/to-auth-redirect/")
+
+        url = AuthorizationUrlBuilder().build(STATE, request)
+
+        self.assertEqual(
+            ["https://testserver/microsoft/from-auth-redirect/"],
+            parse_qs(urlparse(url).query)["redirect_uri"],
+        )
+
+    def test_build_state(self):
+        builder = AuthorizationUrlBuilder()
+
+        url1 = builder.build(STATE)
+        url2 = builder.build("other:state")
+
+        self.assertEqual([STATE], parse_qs(urlparse(url1).query)["state"])
+        self.assertEqual(["other:state"], parse_qs(urlparse(url2).query)["state"])
+
+    @patch(
+        "microsoft_auth.client.get_openid_config",
+        wraps=client_module.get_openid_config,
+    )
+    def test_build_cached(self, mock_openid_config):
+        builder = AuthorizationUrlBuilder()
+
+        builder.build(STATE)
+        builder.build(STATE)
+        mock_openid_config.assert_called_once()
+
+        with override_settings(MICROSOFT_AUTH_CLIENT_ID="other_client_id"):
+            url = builder.build(STATE)
+        self.assertEqual(2, mock_openid_config.call_count)
+        self.assertEqual(
+            ["other_client_id"], parse_qs(urlparse(url).query)["client_id"]
+        )
+
+    @patch("microsoft_auth.client.time.monotonic")
+    def test_build_expires(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        builder = AuthorizationUrlBuilder(timeout=10)
+        builder.build(STATE)
+
+        mock_monotonic.return_value = 110
+        with patch("microsoft_auth.client.get_openid_config") as mock_openid_config:
+            mock_openid_config.return_value = OPENID_CONFIG
+            builder.build(STATE)
+
+        mock_openid_config.assert_called_once()
+
+    def test_build_authorization_url(self):
+        self.assertEqual(
+            AuthorizationUrlBuilder().build(STATE), build_authorization_url(STATE)
+        )
+
+
+class ResolvedTests(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.factory = RequestFactory()
+
+    @override_settings(SITE_ID=1)
+    @patch("microsoft_auth.client.reverse", wraps=client_module.reverse)
+    def test_redirect_uri_resolved_once(self, mock_reverse):
+        self.assertEqual(REDIRECT_URI, get_redirect_uri())
+        self.assertEqual(REDIRECT_URI, get_redirect_uri())
+
+        mock_reverse.assert_called_once()
+
+    @override_settings(SITE_ID=1)
+    def test_redirect_uri_path(self):
+        request = self.factory.get("/microsoft/to-auth-redirect/")
+
+        self.assertEqual(
+            "https://testserver/microsoft/from-auth-redirect/",
+            get_redirect_uri(request),
+        )
+        self.assertEqual(REDIRECT_URI, get_redirect_uri(self.factory.get("/")))
+
+    @override_settings(SITE_ID=1)
+    def test_redirect_uri_site_saved(self):
+        get_redirect_uri()
+
+        self.site.domain = "example.com"
+        self.site.save()
+
+        self.assertEqual(
+            "https://example.com/microsoft/auth-callback/", get_redirect_uri()
+        )
+
+    def test_redirect_uri_per_site(self):
+        Site.objects.create(domain="example.com", name="example.com")
+
+        self.assertEqual(
+            "https://example.com/microsoft/auth-callback/",
+            get_redirect_uri(self.factory.get("/", HTTP_HOST="example.com")),
+        )
+        self.assertEqual(
+            REDIRECT_URI,
+            get_redirect_uri(self.factory.get("/", HTTP_HOST="testserver")),
+        )
+
+    def test_scopes(self):
+        self.assertEqual(" ".join(MicrosoftClient.SCOPE_MICROSOFT), get_scopes())
+
+        with override_settings(MICROSOFT_AUTH_EXTRA_SCOPES="Files.Read"):
+            self.assertTrue(get_scopes().endswith(" Files.Read"))
+
+        self.assertEqual(" ".join(MicrosoftClient.SCOPE_MICROSOFT), get_scopes())
+
+    def test_scopes_resolved_once(self):
+        get_scopes()
+
+        # any config lookup would raise AttributeError
+        with patch.object(client_module, "config", new=object()):
+            self.assertEqual(" ".join(MicrosoftClient.SCOPE_MICROSOFT), get_scopes())
+
+
+@override_settings(MICROSOFT_AUTH_CLIENT_ID=CLIENT_ID)
+class ValidateIdTokensTests(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        cache.clear()
+        public_key_cache.clear()
+
+        set_metadata(get_cache_key(CACHE_KEY_OPENID), OPENID_CONFIG)
+        set_metadata(get_cache_key(CACHE_KEY_JWKS), [get_jwk()])
+
+    def test_validate(self):
+        tokens = [get_id_token(sub="sub{}".format(i)) for i in range(5)]
+
+        results = list(validate_id_tokens(tokens, chunk_size=2, max_workers=2))
+
+        self.assertEqual(list(range(5)), [result.index for result in results])
+        self.assertEqual(tokens, [result.token for result in results])
+        self.assertEqual(
+            ["sub{}".format(i) for i in range(5)],
+            [result.claims["sub"] for result in results],
+        )
+        self.assertTrue(all(result.error is None for result in results))
+
+    def test_validate_is_lazy(self):
+        consumed = []
+
+        def get_tokens():
+            for i in range(4):
+                consumed.append(i)
+                yield get_id_token()
+
+        results = validate_id_tokens(get_tokens(), chunk_size=2)
+        next(results)
+
+        self.assertEqual([0, 1], consumed)
+        results.close()
+
+    def test_validate_errors(self):
+        results = list(
+            validate_id_tokens(
+                [
+                    "not.a.token",
+                    get_id_token(aud="other_client_id"),
+                    get_id_token(exp=1),
+                    get_id_token(),
+                ]
+            )
+        )
+
+        self.assertIsInstance(results[0].error, jwt.DecodeError)
+        self.assertIsInstance(results[1].error, jwt.InvalidAudienceError)
+        self.assertIsInstance(results[2].error, jwt.ExpiredSignatureError)
+        self.assertIsNone(results[3].error)
+        self.assertEqual("test_sub", results[3].claims["sub"])
+
+    def test_validate_options(self):
+        (result,) = validate_id_tokens(
+            [get_id_token(exp=1)], options={"verify_exp": False}
+        )
+
+        self.assertEqual("test_sub", result.claims["sub"])
+
+    def test_validate_jwks(self):
+        results = list(
+            validate_id_tokens(
+                [get_id_token("old_kid"), get_id_token()], jwks=[get_jwk("old_kid")]
+            )
+        )
+
+        self.assertEqual("test_sub", results[0].claims["sub"])
+        self.assertIsInstance(results[1].error, jwt.InvalidKeyError)
+
+    def test_validate_unknown_kid_refreshes_once(self):
+        session = Mock()
+        session.get.return_value = get_response({"keys": [get_jwk("new_kid")]})
+
+        results = list(
+            validate_id_tokens(
+                [get_id_token("new_kid"), get_id_token("other_kid")] * 2,
+                session=session,
+                chunk_size=1,
+            )
+        )
+
+        session.get.assert_called_once()
+        self.assertEqual(
+            ["test_sub", None, "test_sub", None],
+            [result.claims and result.claims["sub"] for result in results],
+        )
+
+    def test_validate_process_pool(self):
+        tokens = [get_id_token(), get_id_token(aud="other_client_id")]
+
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            results = list(
+                validate_id_tokens(tokens, jwks=[get_jwk()], executor=executor)
+            )
+
+        self.assertEqual("test_sub", results[0].claims["sub"])
+        self.assertIsInstance(results[1].error, jwt.InvalidAudienceError)
+
+
+@override_settings(MICROSOFT_AUTH_CLAIMS_CACHE_SIZE=2)
+class ClaimsCacheTests(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.exp = int(time.time()) + 60
+
+    def test_get_key(self):
+        key = ClaimsCache.get_key(CLIENT_ID, b"token")
+
+        self.assertEqual(key, ClaimsCache.get_key(CLIENT_ID, b"token"))
+        self.assertNotEqual(key, ClaimsCache.get_key(CLIENT_ID, b"token2"))
+        self.assertNotEqual(key, ClaimsCache.get_key("other_client_id", b"token"))
+
+    def test_set_get(self):
+        claims = ClaimsCache()
+        claims.set("key", {"sub": "test_sub", "exp": self.exp})
+
+        self.assertEqual({"sub": "test_sub", "exp": self.exp}, claims.get("key"))
+        self.assertIsNone(claims.get("other_key"))
+
+    def test_expires_with_token(self):
+        claims = ClaimsCache()
+        claims.set("key", {"sub": "test_sub", "exp": self.exp})
+
+        with patch("microsoft_auth.client.time.time", return_value=self.exp):
+            self.assertIsNone(claims.get("key"))
+        self.assertEqual(0, len(claims))
+
+    def test_no_exp(self):
+        claims = ClaimsCache()
+        claims.set("key", {"sub": "test_sub"})
+
+        self.assertIsNone(claims.get("key"))
+
+    @override_settings(MICROSOFT_AUTH_CLAIMS_CACHE_SIZE=0)
+    def test_disabled(self):
+        claims = ClaimsCache()
+        claims.set("key", {"sub": "test_sub", "exp": self.exp})
+
+        self.assertEqual(0, len(claims))
+
+    def test_evicts_least_recently_used(self):
+        claims = ClaimsCache()
+        claims.set("key1", {"exp": self.exp})
+        claims.set("key2", {"exp": self.exp})
+        claims.get("key1")
+        claims.set("key3", {"exp": self.exp})
+
+        self.assertIsNotNone(claims.get("key1"))
+        self.assertIsNone(claims.get("key2"))
+        self.assertIsNotNone(claims.get("key3"))
+
+
+@override_settings(SITE_ID=1)
+class TenantTests(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        cache.clear()
+
+    def test_get_namespace(self):
+        self.assertEqual(get_namespace(), get_namespace("common"))
+        self.assertNotEqual(get_namespace(), get_namespace("contoso"))
+        self.assertNotEqual(
+            get_namespace(), get_namespace(authority="https://login.microsoftonline.us")
+        )
+
+    def test_get_cache_key(self):
+        self.assertTrue(
+            get_cache_key(CACHE_KEY_OPENID).startswith("{}_".format(CACHE_KEY_OPENID))
+        )
+
+    @patch("microsoft_auth.client.MicrosoftClient.get")
+    def test_openid_config_per_tenant(self, mock_get):
+        mock_get.side_effect = lambda url: get_response({"url": url})
+
+        with override_settings(MICROSOFT_AUTH_TENANT_ID="tenant1"):
+            config1 = MicrosoftClient().openid_config
+        with override_settings(MICROSOFT_AUTH_TENANT_ID="tenant2"):
+            config2 = MicrosoftClient().openid_config
+        with override_settings(MICROSOFT_AUTH_TENANT_ID="tenant1"):
+            self.assertEqual(config1, MicrosoftClient().openid_config)
+
+        self.assertEqual(
+            "https://login.microsoftonline.com/tenant1/v2.0/.well-known/openid-configuration",  # noqa
+            config1["url"],
+        )
+        self.assertIn("/tenant2/", config2["url"])
+        self.assertEqual(2, mock_get.call_count)
+
+    @override_settings(MICROSOFT_AUTH_AUTHORITY="https://login.microsoftonline.us/")
+    @patch("microsoft_auth.client.MicrosoftClient.get")
+    def test_openid_config_authority(self, mock_get):
+        mock_get.side_effect = lambda url: get_response({"url": url})
+
+        self.assertEqual(
+            "https://login.microsoftonline.us/common/v2.0/.well-known/openid-configuration",  # noqa
+            MicrosoftClient().openid_config["url"],
+        )
@@ -0,0 +1,432 @@
+import csv
+from datetime import timedelta
+from io import StringIO
+import json
+import os
+import tempfile
+from unittest.mock import Mock, patch
+
+from django.contrib.auth import authenticate, get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import RequestFactory, override_settings
+from django.utils import timezone
+import requests
+
+from microsoft_auth.backends import get_user_cache_key
+from microsoft_auth.client import get_cache_key
+from microsoft_auth.conf import CACHE_KEY_JWKS, CACHE_KEY_OPENID
+from microsoft_auth.management.commands.microsoft_auth_dedupe_accounts import (
+    get_models,
+)
+from microsoft_auth.metadata import get_entry, set_metadata
+from microsoft_auth.models import MicrosoftAccount
+
+from . import TestCase, TransactionTestCase, get_response
+
+OPENID_CONFIG = {"jwks_uri": "https://example.com/keys"}
+JWKS = [{"kid": "test_kid"}]
+
+
+def _get(url, **kwargs):
+    if url == OPENID_CONFIG["jwks_uri"]:
+        return get_response({"keys": JWKS})
+    return get_response(OPENID_CONFIG)
+
+
+class RefreshMetadataCommandTests(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        cache.clear()
+
+        self.session = Mock()
+        self.session.get.side_effect = _get
+        patcher = patch(
+            "microsoft_auth.client._get_metadata_session", return_value=self.session
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_refresh_missing(self):
+        out = StringIO()
+        call_command("microsoft_auth_refresh_metadata", stdout=out)
+
+        self.assertEqual(
+            OPENID_CONFIG, get_entry(get_cache_key(CACHE_KEY_OPENID))["value"]
+        )
+        self.assertEqual(JWKS, get_entry(get_cache_key(CACHE_KEY_JWKS))["value"])
+        self.assertIn(
+            "Refreshed {}".format(get_cache_key(CACHE_KEY_JWKS)), out.getvalue()
+        )
+
+    def test_refresh_fresh(self):
+        set_metadata(get_cache_key(CACHE_KEY_OPENID), OPENID_CONFIG)
+        set_metadata(get_cache_key(CACHE_KEY_JWKS), JWKS)
+
+        out = StringIO()
+        call_command("microsoft_auth_refresh_metadata", stdout=out)
+
+        self.session.get.assert_not_called()
+        self.assertIn("Nothing refreshed", out.getvalue())
+
+    def test_refresh_ahead(self):
+        set_metadata(get_cache_key(CACHE_KEY_OPENID), OPENID_CONFIG)
+        set_metadata(get_cache_key(CACHE_KEY_JWKS), JWKS, timeout=60)
+
+        call_command("microsoft_auth_refresh_metadata", ahead=120, stdout=StringIO())
+
+        self.session.get.assert_called_once_with(OPENID_CONFIG["jwks_uri"])
+
+    def test_refresh_force(self):
+        set_metadata(get_cache_key(CACHE_KEY_OPENID), OPENID_CONFIG)
+        set_metadata(get_cache_key(CACHE_KEY_JWKS), JWKS)
+
+        call_command("microsoft_auth_refresh_metadata", force=True, stdout=StringIO())
+
+        self.assertEqual(2, self.session.get.call_count)
+
+    def test_refresh_error(self):
+        self.session.get.side_effect = requests.ConnectionError
+
+        with self.assertRaises(CommandError):
+            call_command("microsoft_auth_refresh_metadata", stdout=StringIO())
+
+    def test_refresh_tenants(self):
+        call_command(
+            "microsoft_auth_refresh_metadata",
+            tenant=["tenant1", "tenant2"],
+            stdout=StringIO(),
+        )
+
+        for tenant in ("tenant1", "tenant2"):
+            self.assertEqual(
+                JWKS, get_entry(get_cache_key(CACHE_KEY_JWKS, tenant))["value"]
+            )
+        self.assertIsNone(get_entry(get_cache_key(CACHE_KEY_JWKS)))
+
+
+class ExportMetadataCommandTests(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        cache.clear()
+
+        self.session = Mock()
+        self.session.get.side_effect = _get
+        patcher = patch(
+            "microsoft_auth.client._get_metadata_session", return_value=self.session
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_export(self):
+        fd, path = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+
+        call_command("microsoft_auth_export_metadata", path, stdout=StringIO())
+
+        with open(path) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+        self.assertEqual(OPENID_CONFIG, snapshot["tenants"][0]["openid_config"])
+        self.assertEqual(JWKS, snapshot["tenants"][0]["jwks"])
+
+    def test_export_stdout(self):
+        out = StringIO()
+        call_command("microsoft_auth_export_metadata", "-", tenant=["t1"], stdout=out)
+
+        snapshot = json.loads(out.getvalue())
+        self.assertEqual(1, snapshot["version"])
+        self.assertEqual("t1", snapshot["tenants"][0]["tenant"])
+
+    def test_export_error(self):
+        self.session.get.side_effect = requests.ConnectionError
+
+        with self.assertRaises(CommandError):
+            call_command("microsoft_auth_export_metadata", "-", stdout=StringIO())
+
+
+class DedupeAccountsCommandTests(TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+
+        # duplicates can only exist before the unique index
+        call_command("migrate", "microsoft_auth", "0003", verbosity=0)
+        self.addCleanup(call_command, "migrate", "microsoft_auth", verbosity=0)
+        # the models as they are at 0003, without the fields and tables that
+        # do not exist yet
+        self.MicrosoftAccount, User = get_models()
+        self.addCleanup(self.MicrosoftAccount.objects.all().delete)
+
+        self.old_user = User.objects.create(
+            username="old", last_login=timezone.now() - timedelta(days=1)
+        )
+        self.new_user = User.objects.create(username="new", last_login=timezone.now())
+
+        self.unlinked = self.MicrosoftAccount.objects.create(microsoft_id="duplicate")
+        self.new = self.MicrosoftAccount.objects.create(
+            microsoft_id="duplicate", user=self.new_user
+        )
+        self.old = self.MicrosoftAccount.objects.create(
+            microsoft_id="duplicate", user=self.old_user
+        )
+        self.MicrosoftAccount.objects.create(microsoft_id="other")
+        self.other = self.MicrosoftAccount.objects.create(microsoft_id="other")
+        self.single = self.MicrosoftAccount.objects.create(microsoft_id="single")
+
+    def test_dedupe(self):
+        out = StringIO()
+        call_command("microsoft_auth_dedupe_accounts", batch_size=1, stdout=out)
+
+        self.assertEqual(
+            [self.new.pk, self.other.pk, self.single.pk],
+            list(
+                self.MicrosoftAccount.objects.order_by("pk").values_list(
+                    "pk", flat=True
+                )
+            ),
+        )
+        self.assertIn("Merged 2 duplicated microsoft_id(s)", out.getvalue())
+        self.assertIn("removed 3 account(s)", out.getvalue())
+        self.assertIn(
+            "User {} is no longer linked".format(self.old_user.pk), out.getvalue()
+        )
+
+        # now the unique index can be added
+        call_command("migrate", "microsoft_auth", verbosity=0)
+
+    @override_settings(MICROSOFT_AUTH_USER_CACHE_TIMEOUT=300)
+    def test_dedupe_clears_cached_user(self):
+        cache.set(get_user_cache_key(self.old_user.pk), "cached")
+        cache.set(get_user_cache_key(self.new_user.pk), "cached")
+
+        call_command("microsoft_auth_dedupe_accounts", stdout=StringIO())
+
+        self.assertIsNone(cache.get(get_user_cache_key(self.old_user.pk)))
+        self.assertEqual("cached", cache.get(get_user_cache_key(self.new_user.pk)))
+
+    def test_dedupe_dry_run(self):
+        out = StringIO()
+        call_command("microsoft_auth_dedupe_accounts", dry_run=True, stdout=out)
+
+        self.assertEqual(6, self.MicrosoftAccount.objects.count())
+        self.assertIn("Found 2 duplicated microsoft_id(s)", out.getvalue())
+        self.assertIn("3 account(s) would be removed", out.getvalue())
+
+    def test_migrate_with_duplicates(self):
+        with self.assertRaisesMessage(RuntimeError, "microsoft_auth_dedupe_accounts"):
+            call_command("migrate", "microsoft_auth", verbosity=0)
+
+
+class ImportUsersCommandTests(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.User = get_user_model()
+
+    def _write(self, rows, suffix=".csv"):
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        self.addCleanup(os.remove, path)
+
+        with os.fdopen(fd, "w", newline="") as import_file:
+            if suffix == ".csv":
+                writer = csv.DictWriter(
+                    import_file, fieldnames=["oid", "email", "name", "upn"]
+                )
+                writer.writeheader()
+                writer.writerows(rows)
+            else:
+                for row in rows:
+                    import_file.write(json.dumps(row) + "\n")
+        return path
+
+    def _import(self, path, **options):
+        out = StringIO()
+        call_command("microsoft_auth_import_users", path, stdout=out, **options)
+        return out.getvalue()
+
+    def _rows(self, count, start=0):
+        return [
+            {
+                "oid": "id{}".format(i),
+                "email": "user{}@example.com".format(i),
+                "name": "First{} Last".format(i),
+                "upn": "user{}@example.com".format(i),
+            }
+            for i in range(start, start + count)
+        ]
+
+    def test_import_csv(self):
+        out = self._import(self._write(self._rows(3)))
+
+        account = MicrosoftAccount.objects.get(object_id="id1")
+        # the sub is only known after the first login
+        self.assertIsNone(account.microsoft_id)
+        user = account.user
+        self.assertEqual("user1@example.com", user.username)
+        self.assertEqual("user1@example.com", user.email)
+        self.assertEqual("First1", user.first_name)
+        self.assertEqual("Last", user.last_name)
+        self.assertEqual(3, MicrosoftAccount.objects.count())
+        self.assertIn("Imported 3 rows: 3 users created, 3 accounts linked", out)
+
+    def test_import_jsonl(self):
+        rows = [
+            {"sub": "id1", "email": "user1@example.com", "name": "Last, First"},
+            {"sub": "id2", "mail": "user2@example.com", "preferred_username": "u2"},
+        ]
+        self._import(self._write(rows, suffix=".jsonl"))
+
+        user = MicrosoftAccount.objects.get(microsoft_id="id1").user
+        self.assertEqual(("First", "Last"), (user.first_name, user.last_name))
+        # falls back to the email like a missing UPN would on login
+        self.assertEqual("user1@example.com", user.username)
+        self.assertEqual(
+            "u2", MicrosoftAccount.objects.get(microsoft_id="id2").user.username
+        )
+
+    @override_settings(
+        AUTHENTICATION_BACKENDS=[
+            "microsoft_auth.backends.MicrosoftAuthenticationBackend"
+        ]
+    )
+    @patch("microsoft_auth.backends.MicrosoftClient")
+    def test_import_then_login(self, mock_client):
+        self._import(self._write(self._rows(1)))
+        imported = MicrosoftAccount.objects.get()
+
+        mock_auth = Mock()
+        mock_auth.fetch_token.return_value = {
+            "access_token": "test_token",
+            "scope": ["User.Read"],
+        }
+        mock_auth.valid_scopes.return_value = True
+        mock_auth.get_claims.return_value = {
+            "sub": "sub0",
+            "oid": "id0",
+            "email": "user0@example.com",
+            "preferred_username": "user0@example.com",
+        }
+        mock_client.return_value = mock_auth
+
+        user = authenticate(RequestFactory().get("/"), code="test_code")
+
+        self.assertEqual(imported.user, user)
+        account = MicrosoftAccount.objects.get()
+        self.assertEqual(imported.pk, account.pk)
+        self.assertEqual("sub0", account.microsoft_id)
+
+        # later logins find the account by its sub
+        mock_auth.get_claims.return_value = {"sub": "sub0"}
+        self.assertEqual(user, authenticate(RequestFactory().get("/"), code="code"))
+        self.assertEqual(1, MicrosoftAccount.objects.count())
+
+    def test_import_existing(self):
+        linked = self.User.objects.create(username="linked", email="user0@example.com")
+        MicrosoftAccount.objects.create(object_id="id0", user=linked)
+        unlinked = self.User.objects.create(
+            username="unlinked", email="user1@example.com"
+        )
+        MicrosoftAccount.objects.create(object_id="id2")
+
+        self._import(self._write(self._rows(3)))
+
+        self.assertEqual(linked, MicrosoftAccount.objects.get(object_id="id0").user)
+        unlinked.refresh_from_db()
+        self.assertEqual("First1", unlinked.first_name)
+        self.assertEqual(unlinked, MicrosoftAccount.objects.get(object_id="id1").user)
+        self.assertEqual(
+            "user2@example.com",
+            MicrosoftAccount.objects.get(object_id="id2").user.email,
+        )
+        self.assertEqual(3, self.User.objects.count())
+
+    def test_import_already_linked(self):
+        user = self.User.objects.create(username="user", email="user0@example.com")
+        MicrosoftAccount.objects.create(microsoft_id="old_id", user=user)
+
+        out = self._import(self._write(self._rows(1)))
+
+        self.assertFalse(MicrosoftAccount.objects.filter(object_id="id0").exists())
+        self.assertIn("1 rows skipped", out)
+
+        with override_settings(MICROSOFT_AUTH_AUTO_REPLACE_ACCOUNTS=True):
+            self._import(self._write(self._rows(1)))
+
+        self.assertEqual(user, MicrosoftAccount.objects.get(object_id="id0").user)
+        self.assertIsNone(MicrosoftAccount.objects.get(microsoft_id="old_id").user)
+
+    def test_import_username_taken(self):
+        self.User.objects.create(
+            username="user0@example.com", email="other@example.com"
+        )
+
+        out = self._import(self._write(self._rows(2)), verbosity=2)
+
+        self.assertFalse(MicrosoftAccount.objects.filter(object_id="id0").exists())
+        self.assertTrue(MicrosoftAccount.objects.filter(object_id="id1").exists())
+        self.assertIn("Skipped id0: username user0@example.com is taken", out)
+
+    def test_import_invalid_rows(self):
+        rows = self._rows(2) + [{"oid": "", "email": "x@example.com"}]
+        rows[1]["email"] = rows[0]["email"]
+
+        out = self._import(self._write(rows))
+
+        self.assertEqual(1, MicrosoftAccount.objects.count())
+        self.assertIn("2 rows skipped", out)
+
+    def test_import_again(self):
+        path = self._write(self._rows(3))
+        self._import(path)
+
+        out = self._import(path)
+
+        self.assertEqual(3, self.User.objects.count())
+        self.assertIn("0 users created, 0 accounts linked", out)
+
+    def test_import_chunks(self):
+        path = self._write(self._rows(10))
+
+        # 6 queries per chunk whatever its size, plus its savepoint
+        with self.assertNumQueries(3 * 8):
+            out = self._import(path, chunk_size=4)
+
+        self.assertEqual(10, MicrosoftAccount.objects.count())
+        self.assertIn("Imported 4 rows", out)
+        self.assertIn("Imported 8 rows", out)
+
+    def test_import_resume(self):
+        fd, state_file = tempfile.mkstemp(suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"rows": 2}, f)
+        self.addCleanup(lambda: os.path.exists(state_file) and os.remove(state_file))
+
+        out = self._import(self._write(self._rows(5)), state_file=state_file)
+
+        self.assertIn("Resuming after row 2", out)
+        self.assertEqual(
+            ["id2", "id3", "id4"],
+            sorted(MicrosoftAccount.objects.values_list("object_id", flat=True)),
+        )
+        self.assertFalse(os.path.exists(state_file))
+
+    def test_import_state_written(self):
+        state_file = os.path.join(tempfile.mkdtemp(), "state.json")
+        self.addCleanup(os.rmdir, os.path.dirname(state_file))
+
+        with patch(
+            "microsoft_auth.management.commands.microsoft_auth_import_users."
+            "Command._import_chunk",
+            side_effect=[None, KeyboardInterrupt],
+        ):
+            with self.assertRaises(KeyboardInterrupt):
+                self._import(
+                    self._write(self._rows(5)), chunk_size=2, state_file=state_file
+                )
+
+        with open(state_file) as f:
+            self.assertEqual({"rows": 2}, json.load(f))
+        os.remove(state_file)
@@ -2,11 +2,22 @@
 
 """
 
-from unittest.mock import patch
+import asyncio
+import time
+from unittest.mock import Mock, patch
 
+from django.core.cache import cache
 from django.test import override_settings
 
-from microsoft_auth.conf import DEFAULT_CONFIG, SimpleConfig
+from microsoft_auth.conf import (
+    CACHE_KEY_CONFIG_VERSION,
+    CONSTANCE_TIMEOUT,
+    DEFAULT_CONFIG,
+    SimpleConfig,
+    config_reloaded,
+    pinned_config,
+    pinned_snapshot,
+)
 
 from . import TransactionTestCase
 
@@ -93,3 +104,146 @@ class ConfTests(TransactionTestCase):
         with patch("tests.test_conf.SimpleTestNoDefaultConfig") as mockClass:
             init_config()
             mockClass.assert_called_once()
+
+
+class SnapshotTests(TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.config = SimpleConfig(DEFAULT_CONFIG)
+
+    def test_snapshot(self):
+        snapshot = self.config.get_snapshot()
+
+        self.assertEqual(set(DEFAULT_CONFIG["defaults"]), set(snapshot))
+        with self.assertRaises(TypeError):
+            snapshot["MICROSOFT_AUTH_CLIENT_ID"] = "test"
+
+    def test_snapshot_reused(self):
+        snapshot = self.config.get_snapshot()
+
+        with patch.object(self.config, "_resolve") as mock_resolve:
+            self.assertEqual(
+                snapshot["MICROSOFT_AUTH_CLIENT_ID"],
+                self.config.MICROSOFT_AUTH_CLIENT_ID,
+            )
+            mock_resolve.assert_not_called()
+        self.assertIs(snapshot, self.config.get_snapshot())
+
+    def test_setting_changed(self):
+        snapshot = self.config.get_snapshot()
+
+        with override_settings(MICROSOFT_AUTH_CLIENT_ID="test"):
+            self.assertEqual("test", self.config.MICROSOFT_AUTH_CLIENT_ID)
+            self.assertIsNot(snapshot, self.config.get_snapshot())
+
+        self.assertEqual("", self.config.MICROSOFT_AUTH_CLIENT_ID)
+
+    def test_other_setting_changed(self):
+        snapshot = self.config.get_snapshot()
+
+        with override_settings(DEBUG=True):
+            self.assertIs(snapshot, self.config.get_snapshot())
+            self.assertTrue(self.config.DEBUG)
+
+    def test_not_a_setting(self):
+        with self.assertRaises(AttributeError):
+            self.config.MICROSOFT_AUTH_NOT_A_SETTING
+
+        with self.assertRaises(AttributeError):
+            self.config._not_a_setting
+
+    def test_config_reloaded(self):
+        handler = Mock()
+        config_reloaded.connect(handler)
+        self.addCleanup(config_reloaded.disconnect, handler)
+
+        with override_settings(MICROSOFT_AUTH_CLIENT_ID="test"):
+            handler.assert_called_once()
+            self.assertEqual("MICROSOFT_AUTH_CLIENT_ID", handler.call_args[1]["key"])
+
+    @patch.object(SimpleConfig, "_get_constance_values", return_value=None)
+    @patch("microsoft_auth.conf.constance_config")
+    def test_cache_version_changed(self, mock_constance, mock_values):
+        mock_constance.MICROSOFT_AUTH_CLIENT_ID = "test"
+        snapshot = self.config.get_snapshot()
+        self.assertEqual("test", self.config.MICROSOFT_AUTH_CLIENT_ID)
+
+        mock_constance.MICROSOFT_AUTH_CLIENT_ID = "changed"
+        self.config._cache_checked = 0
+        # not changed on another node
+        self.assertIs(snapshot, self.config.get_snapshot())
+
+        cache.set(CACHE_KEY_CONFIG_VERSION, "changed")
+        self.addCleanup(cache.delete, CACHE_KEY_CONFIG_VERSION)
+        self.config._cache_checked = 0
+        self.assertEqual("changed", self.config.MICROSOFT_AUTH_CLIENT_ID)
+
+    @patch.object(SimpleConfig, "_get_constance_values", return_value=None)
+    @patch("microsoft_auth.conf.constance_config")
+    def test_cache_version_throttled(self, mock_constance, mock_values):
+        self.config.get_snapshot()
+
+        with patch("microsoft_auth.conf.get_cache_version") as mock_version:
+            self.config.get_snapshot()
+            mock_version.assert_not_called()
+
+    @patch.object(SimpleConfig, "_get_constance_values")
+    @patch("microsoft_auth.conf.constance_config")
+    def test_constance_values(self, mock_constance, mock_values):
+        mock_values.return_value = {"MICROSOFT_AUTH_CLIENT_ID": "test"}
+        mock_constance.MICROSOFT_AUTH_CLIENT_ID = "not used"
+
+        self.assertEqual("test", self.config.MICROSOFT_AUTH_CLIENT_ID)
+        self.assertEqual("", self.config.MICROSOFT_AUTH_CLIENT_SECRET)
+        self.config.MICROSOFT_AUTH_TENANT_ID
+        mock_values.assert_called_once()
+
+    @patch.object(SimpleConfig, "_get_constance_values")
+    @patch("microsoft_auth.conf.constance_config")
+    def test_constance_values_expire(self, mock_constance, mock_values):
+        mock_values.return_value = {"MICROSOFT_AUTH_CLIENT_ID": "test"}
+        self.config.get_snapshot()
+
+        mock_values.return_value = {"MICROSOFT_AUTH_CLIENT_ID": "changed"}
+        later = time.monotonic() + CONSTANCE_TIMEOUT
+        with patch("microsoft_auth.conf.time.monotonic", return_value=later):
+            self.assertEqual("changed", self.config.MICROSOFT_AUTH_CLIENT_ID)
+        self.assertEqual(2, mock_values.call_count)
+
+    @override_settings(MICROSOFT_AUTH_CONSTANCE_TIMEOUT=None)
+    @patch.object(SimpleConfig, "_get_constance_values")
+    @patch("microsoft_auth.conf.constance_config")
+    def test_constance_values_no_timeout(self, mock_constance, mock_values):
+        mock_values.return_value = {}
+        self.config.get_snapshot()
+
+        later = time.monotonic() + CONSTANCE_TIMEOUT
+        with patch("microsoft_auth.conf.time.monotonic", return_value=later):
+            self.config.get_snapshot()
+        mock_values.assert_called_once()
+
+    @patch.object(SimpleConfig, "_get_constance_values")
+    @patch("microsoft_auth.conf.constance_config")
+    async def test_pinned_config(self, mock_constance, mock_values):
+        def get_values():
+            # constance is queried in a thread, not on the event loop
+            with self.assertRaises(RuntimeError):
+                asyncio.get_running_loop()
+            return {"MICROSOFT_AUTH_CLIENT_ID": "test"}
+
+        mock_values.side_effect = get_values
+
+        later = time.monotonic() + CONSTANCE_TIMEOUT
+        with patch("microsoft_auth.conf.config", self.config):
+            async with pinned_config():
+                with patch("microsoft_auth.conf.time.monotonic", return_value=later):
+                    self.assertEqual("test", self.config.MICROSOFT_AUTH_CLIENT_ID)
+
+        mock_values.assert_called_once()
+        self.assertIsNone(pinned_snapshot.get())
+
+    async def test_pinned_config_custom_config_class(self):
+        with patch("microsoft_auth.conf.config", no_default_test_conf):
+            async with pinned_config():
+                self.assertIsNone(pinned_snapshot.get())
@@ -1,9 +1,10 @@
 """ isort:skip_file """
 
-from unittest.mock import Mock, patch
+from unittest.mock import patch
 
 import pytest
 from django.core.signing import loads
+from django.template import Context, Template
 from django.test import RequestFactory, override_settings
 
 from microsoft_auth.conf import LOGIN_TYPE_XBL
@@ -25,27 +26,25 @@ class ContextProcessorsTests(TestCase):
 
         self.factory = RequestFactory()
 
-    @patch("microsoft_auth.context_processors.MicrosoftClient")
-    def test_microsoft_login_enabled(self, mock_client):
+    @patch("microsoft_auth.context_processors.build_authorization_url")
+    def test_microsoft_login_enabled(self, mock_build):
         request = self.factory.get("/")
         context = microsoft(request)
 
         self.assertTrue(context.get("microsoft_login_enabled"))
 
     @override_settings(MICROSOFT_AUTH_LOGIN_ENABLED=False)
-    @patch("microsoft_auth.context_processors.MicrosoftClient")
-    def test_microsoft_login_enabled_disabled(self, mock_client):
+    @patch("microsoft_auth.context_processors.build_authorization_url")
+    def test_microsoft_login_enabled_disabled(self, mock_build):
         request = self.factory.get("/")
         context = microsoft(request)
 
         self.assertFalse(context.get("microsoft_login_enabled"))
 
-    @patch("microsoft_auth.context_processors.MicrosoftClient")
+    @patch("microsoft_auth.context_processors.build_authorization_url")
     @patch("microsoft_auth.context_processors.mark_safe")
-    def test_microsoft_authorization_url(self, mock_safe, mock_client):
-        mock_client_i = Mock()
-        mock_client_i.authorization_url.return_value = [URL]
-        mock_client.return_value = mock_client_i
+    def test_microsoft_authorization_url(self, mock_safe, mock_build):
+        mock_build.return_value = URL
         mock_safe.side_effect = lambda value: value
 
         request = self.factory.get("/")
@@ -53,8 +52,8 @@ class ContextProcessorsTests(TestCase):
 
         self.assertEqual(URL, context.get("microsoft_authorization_url"))
 
-    @patch("microsoft_auth.context_processors.MicrosoftClient")
-    def test_microsoft_login_type_text(self, mock_client):
+    @patch("microsoft_auth.context_processors.build_authorization_url")
+    def test_microsoft_login_type_text(self, mock_build):
 
         request = self.factory.get("/")
         context = microsoft(request)
@@ -62,8 +61,8 @@ class ContextProcessorsTests(TestCase):
         self.assertEqual("Microsoft", context.get("microsoft_login_type_text"))
 
     @override_settings(MICROSOFT_AUTH_LOGIN_TYPE=LOGIN_TYPE_XBL)
-    @patch("microsoft_auth.context_processors.MicrosoftClient")
-    def test_microsoft_login_type_text_xbl(self, mock_client):
+    @patch("microsoft_auth.context_processors.build_authorization_url")
+    def test_microsoft_login_type_text_xbl(self, mock_build):
 
         request = self.factory.get("/")
         context = microsoft(request)
@@ -75,7 +74,7 @@ class ContextProcessorsTests(TestCase):
         self.site.save()
 
         request = self.factory.get("/")
-        microsoft(request)
+        str(microsoft(request)["microsoft_authorization_url"])
 
         message_found = False
         for record in self._caplog.records:
@@ -84,16 +83,44 @@ class ContextProcessorsTests(TestCase):
 
         self.assertTrue(message_found)
 
-    @patch("microsoft_auth.context_processors.MicrosoftClient")
-    def test_microsoft_next_state(self, mock_client):
+    @patch("microsoft_auth.context_processors.get_token")
+    @patch("microsoft_auth.context_processors.build_authorization_url")
+    def test_microsoft_authorization_url_lazy(self, mock_build, mock_get_token):
+        mock_build.return_value = URL
+        mock_get_token.return_value = "test_token"
+
+        request = self.factory.get("/")
+        context = microsoft(request)
+
+        mock_build.assert_not_called()
+        mock_get_token.assert_not_called()
+
+        self.assertEqual(URL, str(context["microsoft_authorization_url"]))
+        mock_build.assert_called_once()
+        mock_get_token.assert_called_once_with(request)
+
+    @patch("microsoft_auth.context_processors.build_authorization_url")
+    def test_microsoft_authorization_url_not_escaped(self, mock_build):
+        mock_build.return_value = URL + "/?a=1&b=2"
+
+        request = self.factory.get("/")
+        rendered = Template("{{ microsoft_authorization_url }}").render(
+            Context(microsoft(request))
+        )
+
+        self.assertEqual(URL + "/?a=1&b=2", rendered)
+
+    @patch("microsoft_auth.context_processors.build_authorization_url")
+    def test_microsoft_next_state(self, mock_build):
+        mock_build.return_value = URL
         self.site.domain = "example.com"
         self.site.save()
 
         next_ = "/next/path"
         request = self.factory.get("/", {"next": next_})
-        microsoft(request)
+        str(microsoft(request)["microsoft_authorization_url"])
 
-        mock_calls = mock_client.call_args_list
+        mock_calls = mock_build.call_args_list
         self.assertEqual(len(mock_calls), 1)
-        state = loads(mock_calls[0][1].get("state"), salt="microsoft_auth")
+        state = loads(mock_calls[0][0][0], salt="microsoft_auth")
         self.assertEqual(state["next"], next_)
@@ -0,0 +1,314 @@
+import json
+from unittest.mock import Mock, call, patch
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test import override_settings
+import requests
+
+from microsoft_auth import transport
+from microsoft_auth.conf import GRAPH_MAX_RETRIES
+from microsoft_auth.graph import BatchResponse, GraphClient, get_retry_after
+
+from . import GraphServer, TestCase, get_response
+
+TOKEN = {"access_token": "test_token", "expires_in": 3600}
+
+
+@override_settings(MICROSOFT_AUTH_TENANT_ID="test_tenant")
+class GraphClientTests(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.session = Mock()
+        self.session.post.return_value = get_response(TOKEN)
+        self.session.request.return_value = get_response({"value": []})
+
+    def test_tenant_required(self):
+        for tenant in ("common", "organizations", "consumers"):
+            with self.assertRaises(ImproperlyConfigured):
+                GraphClient(tenant=tenant)
+
+    def test_token_url(self):
+        client = GraphClient(session=self.session)
+
+        self.assertEqual(
+            "https://login.microsoftonline.com/test_tenant/oauth2/v2.0/token",
+            client.token_url,
+        )
+        self.assertEqual("https://graph.microsoft.com/.default", client.scope)
+
+    @override_settings(
+        MICROSOFT_AUTH_AUTHORITY="https://login.microsoftonline.us",
+        MICROSOFT_AUTH_GRAPH_URL="https://graph.microsoft.us/v1.0",
+    )
+    def test_national_cloud(self):
+        client = GraphClient(session=self.session)
+
+        self.assertTrue(
+            client.token_url.startswith("https://login.microsoftonline.us/")
+        )
+        self.assertEqual("https://graph.microsoft.us/.default", client.scope)
+        self.assertEqual(
+            "https://graph.microsoft.us/v1.0/users", client.get_url("users")
+        )
+
+    def test_get_url(self):
+        client = GraphClient(session=self.session)
+        link = "https://graph.microsoft.com/v1.0/users/delta?$skiptoken=abc"
+
+        self.assertEqual(
+            "https://graph.microsoft.com/v1.0/users/delta",
+            client.get_url("users/delta"),
+        )
+        self.assertEqual(link, client.get_url(link))
+
+    def test_token_reused(self):
+        client = GraphClient(session=self.session)
+
+        client.get("users")
+        client.get("users")
+
+        self.session.post.assert_called_once()
+        self.assertEqual(
+            "Bearer test_token",
+            self.session.request.call_args[1]["headers"]["Authorization"],
+        )
+
+    def test_token_renewed(self):
+        client = GraphClient(session=self.session)
+        client.get("users")
+
+        with patch("microsoft_auth.graph.time.time", return_value=10**10):
+            client.get("users")
+
+        self.assertEqual(2, self.session.post.call_count)
+
+    def test_error(self):
+        client = GraphClient(session=self.session)
+        self.session.request.return_value.raise_for_status.side_effect = ValueError
+
+        with self.assertRaises(ValueError):
+            client.get("users")
+
+
+class GraphRequestTests(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.server = GraphServer()
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+        settings = override_settings(
+            MICROSOFT_AUTH_GRAPH_URL="{}/v1.0".format(self.server.url),
+            MICROSOFT_AUTH_HTTP_RETRIES=0,
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        transport.reset()
+        self.addCleanup(transport.reset)
+
+        patcher = patch("microsoft_auth.graph.time.sleep")
+        self.mock_sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # a user's token, as passed to MICROSOFT_AUTH_AUTHENTICATE_HOOK
+        self.client = GraphClient(token={"access_token": "user_token"})
+
+    def _get_batches(self):
+        return [
+            json.loads(body)["requests"]
+            for method, path, headers, body in self.server.requests
+            if path == "/v1.0/$batch"
+        ]
+
+    def test_user_token(self):
+        self.server.routes["GET /v1.0/me"] = {"id": "user_id"}
+
+        self.assertEqual({"id": "user_id"}, self.client.get("me"))
+        method, path, headers, body = self.server.requests[0]
+        self.assertEqual("Bearer user_token", headers["Authorization"])
+
+    def test_retry_after(self):
+        self.assertEqual(2, get_retry_after({"retry-after": "2"}))
+        self.assertEqual(5, get_retry_after({"Retry-After": "soon"}))
+        self.assertEqual(5, get_retry_after({}))
+        self.assertEqual(60, get_retry_after({"Retry-After": "3600"}))
+
+    def test_throttled(self):
+        self.server.routes["GET /v1.0/me"] = [
+            (429, {"error": {"code": "TooManyRequests"}}, {"Retry-After": "2"}),
+            {"id": "user_id"},
+        ]
+
+        self.assertEqual({"id": "user_id"}, self.client.get("me"))
+        self.mock_sleep.assert_called_once_with(2)
+
+    def test_throttled_too_often(self):
+        self.server.routes["GET /v1.0/me"] = (503, {}, {"Retry-After": "1"})
+
+        with self.assertRaises(requests.HTTPError):
+            self.client.get("me")
+        self.assertEqual(GRAPH_MAX_RETRIES + 1, len(self.server.requests))
+
+    def test_get_all(self):
+        self.server.routes["GET /v1.0/me/memberOf"] = {
+            "value": [{"id": "1"}, {"id": "2"}],
+            "@odata.nextLink": "{}/v1.0/me/memberOf?$skiptoken=2".format(
+                self.server.url
+            ),
+        }
+        self.server.routes["GET /v1.0/me/memberOf?$skiptoken=2"] = {
+            "value": [{"id": "3"}]
+        }
+
+        self.assertEqual(
+            ["1", "2", "3"],
+            [group["id"] for group in self.client.get_all("me/memberOf")],
+        )
+
+    def test_batch(self):
+        def _batch(body):
+            return {
+                "responses": [
+                    {"id": request["id"], "status": 200, "body": request}
+                    for request in reversed(json.loads(body)["requests"])
+                ]
+            }
+
+        self.server.routes["POST /v1.0/$batch"] = _batch
+
+        results = self.client.batch(
+            [
+                "/me",
+                "me/memberOf",
+                {"method": "PATCH", "url": "/me", "body": {"city": "Redmond"}},
+            ]
+        )
+
+        # one round trip, results in the order of the requests
+        self.assertEqual(1, len(self.server.requests))
+        self.assertEqual(
+            ["/me", "/me/memberOf", "/me"], [result.body["url"] for result in results]
+        )
+        self.assertEqual(
+            {
+                "id": "2",
+                "method": "PATCH",
+                "url": "/me",
+                "body": {"city": "Redmond"},
+                "headers": {"Content-Type": "application/json"},
+            },
+            results[2].body,
+        )
+        self.assertEqual(
+            "Bearer user_token", self.server.requests[0][2]["Authorization"]
+        )
+
+    def test_batch_size(self):
+        self.server.routes["POST /v1.0/$batch"] = lambda body: {
+            "responses": [
+                {"id": request["id"], "status": 200, "body": {}}
+                for request in json.loads(body)["requests"]
+            ]
+        }
+
+        results = self.client.batch(["/users/{}".format(i) for i in range(45)])
+
+        self.assertEqual(45, len(results))
+        self.assertEqual([20, 20, 5], [len(batch) for batch in self._get_batches()])
+
+    def test_batch_throttled(self):
+        attempts = []
+
+        def _batch(body):
+            responses = []
+            for request in json.loads(body)["requests"]:
+                if request["url"] == "/me/photo/$value" and not attempts:
+                    attempts.append(request)
+                    responses.append(
+                        {
+                            "id": request["id"],
+                            "status": 429,
+                            "headers": {"Retry-After": "3"},
+                        }
+                    )
+                else:
+                    responses.append(
+                        {"id": request["id"], "status": 200, "body": request["url"]}
+                    )
+            return {"responses": responses}
+
+        self.server.routes["POST /v1.0/$batch"] = _batch
+
+        results = self.client.batch(["/me", "/me/photo/$value"])
+
+        self.assertEqual(
+            [BatchResponse(200, {}, "/me"), BatchResponse(200, {}, "/me/photo/$value")],
+            results,
+        )
+        self.mock_sleep.assert_called_once_with(3)
+        # only the throttled request is sent again
+        self.assertEqual(
+            [["/me", "/me/photo/$value"], ["/me/photo/$value"]],
+            [[request["url"] for request in batch] for batch in self._get_batches()],
+        )
+
+    def test_batch_pages(self):
+        next_link = "{}/v1.0/me/memberOf?$skiptoken=2".format(self.server.url)
+        self.server.routes["POST /v1.0/$batch"] = [
+            {
+                "responses": [
+                    {"id": "0", "status": 200, "body": {"id": "user_id"}},
+                    {
+                        "id": "1",
+                        "status": 200,
+                        "body": {"value": [1, 2], "@odata.nextLink": next_link},
+                    },
+                ]
+            },
+            {"responses": [{"id": "0", "status": 200, "body": {"value": [3]}}]},
+        ]
+
+        results = self.client.batch(["/me", "/me/memberOf"])
+
+        self.assertEqual({"value": [1, 2, 3]}, results[1].body)
+        self.assertEqual("/me/memberOf?$skiptoken=2", self._get_batches()[1][0]["url"])
+
+        self.server.requests.clear()
+        self.server.routes["POST /v1.0/$batch"] = {
+            "responses": [
+                {
+                    "id": "0",
+                    "status": 200,
+                    "body": {"value": [1, 2], "@odata.nextLink": next_link},
+                },
+            ]
+        }
+        results = self.client.batch(["/me/memberOf"], follow_pages=False)
+
+        self.assertEqual(next_link, results[0].body["@odata.nextLink"])
+        self.assertEqual(1, len(self.server.requests))
+
+    def test_batch_errors(self):
+        self.server.routes["POST /v1.0/$batch"] = {
+            "responses": [
+                {"id": "0", "status": 404, "body": {"error": {"code": "NotFound"}}},
+            ]
+        }
+
+        results = self.client.batch(["/me/photo/$value"])
+
+        self.assertEqual(404, results[0].status)
+        self.mock_sleep.assert_not_called()
+
+    def test_batch_throttled_too_often(self):
+        self.server.routes["POST /v1.0/$batch"] = {
+            "responses": [{"id": "0", "status": 429, "headers": {"Retry-After": "1"}}]
+        }
+
+        results = self.client.batch(["/me"])
+
+        self.assertEqual(429, results[0].status)
+        self.assertEqual(GRAPH_MAX_RETRIES + 1, len(self.server.requests))
+        self.assertEqual([call(1)] * GRAPH_MAX_RETRIES, self.mock_sleep.call_args_list)
@@ -0,0 +1,320 @@
+import threading
+from unittest.mock import Mock, patch
+
+from django.core.cache import cache
+from django.test import override_settings
+import requests
+
+from microsoft_auth.metadata import (
+    MetadataRefresher,
+    MetadataResponse,
+    _refresh_threads,
+    get_entry,
+    get_json,
+    get_max_age,
+    get_metadata,
+    refresh,
+    set_metadata,
+)
+
+from . import TestCase, get_response
+
+KEY = "test_metadata"
+VALUE = {"value": 1}
+NEW_VALUE = {"value": 2}
+
+
+class MetadataTests(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        cache.clear()
+
+    def _set_stale(self, value=VALUE):
+        set_metadata(KEY, value, timeout=-1)
+
+    def _join_refresh(self):
+        _refresh_threads[KEY].join(5)
+
+    def test_get_metadata_missing(self):
+        fetch = Mock(return_value=VALUE)
+
+        self.assertEqual(VALUE, get_metadata(KEY, fetch))
+        self.assertEqual(VALUE, get_entry(KEY)["value"])
+        fetch.assert_called_once()
+
+    def test_get_metadata_fresh(self):
+        set_metadata(KEY, VALUE)
+        fetch = Mock(return_value=NEW_VALUE)
+
+        self.assertEqual(VALUE, get_metadata(KEY, fetch))
+        fetch.assert_not_called()
+
+    def test_get_metadata_stale(self):
+        self._set_stale()
+        fetch = Mock(return_value=NEW_VALUE)
+
+        self.assertEqual(VALUE, get_metadata(KEY, fetch))
+        self._join_refresh()
+
+        fetch.assert_called_once()
+        self.assertEqual(NEW_VALUE, get_metadata(KEY, fetch))
+
+    def test_get_metadata_stale_single_refresh(self):
+        self._set_stale()
+        started = threading.Event()
+        release = threading.Event()
+
+        def fetch(entry):
+            started.set()
+            release.wait(5)
+            return NEW_VALUE
+
+        fetch = Mock(side_effect=fetch)
+
+        get_metadata(KEY, fetch)
+        started.wait(5)
+        for _ in range(5):
+            self.assertEqual(VALUE, get_metadata(KEY, fetch))
+        release.set()
+        self._join_refresh()
+
+        fetch.assert_called_once()
+
+    def test_get_metadata_missing_single_flight(self):
+        release = threading.Event()
+        results = []
+
+        def fetch(entry):
+            release.wait(5)
+            return VALUE
+
+        fetch = Mock(side_effect=fetch)
+
+        def worker():
+            results.append(get_metadata(KEY, fetch))
+
+        threads = [threading.Thread(target=worker) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        fetch.assert_called_once()
+        self.assertEqual([VALUE] * 5, results)
+
+    def test_refresh_locked_by_other_node(self):
+        self._set_stale()
+        cache.add("{}_lock".format(KEY), True)
+        fetch = Mock(return_value=NEW_VALUE)
+
+        self.assertEqual(VALUE, refresh(KEY, fetch))
+        fetch.assert_not_called()
+
+    @patch("microsoft_auth.metadata.CACHE_LOCK_WAIT", 0.2)
+    def test_refresh_locked_by_other_node_missing(self):
+        cache.add("{}_lock".format(KEY), True)
+        fetch = Mock(return_value=NEW_VALUE)
+
+        self.assertEqual(NEW_VALUE, refresh(KEY, fetch))
+        fetch.assert_called_once()
+
+    def test_refresh_force(self):
+        set_metadata(KEY, VALUE)
+        fetch = Mock(return_value=NEW_VALUE)
+
+        self.assertEqual(NEW_VALUE, refresh(KEY, fetch, force=True))
+
+    def test_refresh_failed_keeps_stale(self):
+        self._set_stale()
+        fetch = Mock(return_value=None)
+
+        self.assertEqual(VALUE, refresh(KEY, fetch))
+        self.assertEqual(VALUE, get_entry(KEY)["value"])
+
+    def test_refresh_error_keeps_stale(self):
+        self._set_stale()
+        fetch = Mock(side_effect=requests.ConnectionError)
+
+        self.assertEqual(VALUE, refresh(KEY, fetch))
+        self.assertIsNone(cache.get("{}_lock".format(KEY)))
+
+    def test_refresh_failed_retry(self):
+        self._set_stale()
+        fetch = Mock(return_value=None)
+
+        refresh(KEY, fetch)
+
+        with patch("microsoft_auth.metadata.refresh_in_background") as mock_refresh:
+            self.assertEqual(VALUE, get_metadata(KEY, fetch))
+            mock_refresh.assert_not_called()
+
+    def test_refresh_error_missing(self):
+        fetch = Mock(side_effect=requests.ConnectionError)
+
+        with self.assertRaises(requests.ConnectionError):
+            refresh(KEY, fetch)
+        self.assertIsNone(cache.get("{}_lock".format(KEY)))
+
+    @override_settings(
+        MICROSOFT_AUTH_METADATA_MIN_TTL=60, MICROSOFT_AUTH_METADATA_MAX_TTL=600
+    )
+    def test_refresh_response_timeout(self):
+        for timeout, expected in ((10, 60), (300, 300), (6000, 600), (None, 600)):
+            fetch = Mock(return_value=MetadataResponse(VALUE, timeout, None, None))
+
+            with patch("microsoft_auth.metadata.time.time", return_value=1000):
+                refresh(KEY, fetch, force=True)
+                entry = get_entry(KEY)
+
+            self.assertEqual(1000 + expected, entry["expires"])
+
+    def test_refresh_passes_entry(self):
+        entry = set_metadata(KEY, VALUE, timeout=-1, etag='"v1"')
+        fetch = Mock(return_value=NEW_VALUE)
+
+        refresh(KEY, fetch)
+
+        fetch.assert_called_once_with(entry)
+
+
+class GetJsonTests(TestCase):
+    URL = "https://example.com/metadata"
+
+    def test_get_json(self):
+        session = Mock()
+        session.get.return_value = get_response(
+            VALUE,
+            headers={
+                "Cache-Control": "max-age=3600, private",
+                "ETag": '"v1"',
+                "Last-Modified": "Tue, 01 Sep 2026 00:00:00 GMT",
+            },
+        )
+
+        response = get_json(session, self.URL)
+
+        session.get.assert_called_once_with(self.URL)
+        self.assertEqual(
+            MetadataResponse(VALUE, 3600, '"v1"', "Tue, 01 Sep 2026 00:00:00 GMT"),
+            response,
+        )
+
+    def test_get_json_parse(self):
+        session = Mock()
+        session.get.return_value = get_response(VALUE)
+
+        response = get_json(session, self.URL, parse=lambda data: data["value"])
+
+        self.assertEqual(1, response.value)
+
+    def test_get_json_parse_none(self):
+        session = Mock()
+        session.get.return_value = get_response(VALUE)
+
+        self.assertIsNone(get_json(session, self.URL, parse=lambda data: None))
+
+    def test_get_json_error(self):
+        session = Mock()
+        session.get.return_value = get_response(status_code=500)
+
+        self.assertIsNone(get_json(session, self.URL))
+
+    def test_get_json_not_modified(self):
+        entry = {
+            "value": VALUE,
+            "expires": 0,
+            "etag": '"v1"',
+            "last_modified": "Tue, 01 Sep 2026 00:00:00 GMT",
+        }
+        session = Mock()
+        session.get.return_value = get_response(
+            status_code=304, headers={"Cache-Control": "max-age=600"}
+        )
+
+        response = get_json(session, self.URL, entry)
+
+        session.get.assert_called_once_with(
+            self.URL,
+            headers={
+                "If-None-Match": '"v1"',
+                "If-Modified-Since": "Tue, 01 Sep 2026 00:00:00 GMT",
+            },
+        )
+        self.assertEqual(
+            MetadataResponse(VALUE, 600, '"v1"', "Tue, 01 Sep 2026 00:00:00 GMT"),
+            response,
+        )
+        session.get.return_value.json.assert_not_called()
+
+
+class GetMaxAgeTests(TestCase):
+    def _get_max_age(self, headers):
+        return get_max_age(get_response(headers=headers))
+
+    def test_no_headers(self):
+        self.assertIsNone(self._get_max_age({}))
+
+    def test_max_age(self):
+        self.assertEqual(86400, self._get_max_age({"Cache-Control": "max-age=86400"}))
+
+    def test_s_maxage(self):
+        self.assertEqual(
+            60, self._get_max_age({"Cache-Control": "max-age=86400, s-maxage=60"})
+        )
+
+    def test_age(self):
+        self.assertEqual(
+            3000, self._get_max_age({"Cache-Control": "max-age=3600", "Age": "600"})
+        )
+
+    def test_no_store(self):
+        self.assertEqual(0, self._get_max_age({"Cache-Control": "no-store"}))
+
+    def test_invalid_max_age(self):
+        self.assertIsNone(self._get_max_age({"Cache-Control": "max-age=abc"}))
+
+    def test_expires(self):
+        self.assertEqual(
+            3600,
+            self._get_max_age(
+                {
+                    "Date": "Tue, 01 Sep 2026 00:00:00 GMT",
+                    "Expires": "Tue, 01 Sep 2026 01:00:00 GMT",
+                }
+            ),
+        )
+
+    def test_expires_invalid(self):
+        self.assertEqual(0, self._get_max_age({"Expires": "0"}))
+
+
+class MetadataRefresherTests(TestCase):
+    def test_refresh(self):
+        called = threading.Event()
+        refresh = Mock(side_effect=lambda: called.set())
+
+        refresher = MetadataRefresher(60, refresh)
+        refresher.start()
+        called.wait(5)
+        refresher.stop()
+        refresher.join(5)
+
+        self.assertFalse(refresher.is_alive())
+        refresh.assert_called_once()
+
+    def test_refresh_error(self):
+        called = threading.Event()
+
+        def refresh():
+            if called.is_set():
+                refresher.stop()
+            called.set()
+            raise Exception()
+
+        refresher = MetadataRefresher(0.01, refresh)
+        refresher.start()
+        refresher.join(5)
+
+        self.assertFalse(refresher.is_alive())
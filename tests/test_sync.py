@@ -0,0 +1,254 @@
+from collections import Counter
+from io import StringIO
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import override_settings
+import requests
+
+from microsoft_auth import transport
+from microsoft_auth.models import DirectorySyncState, MicrosoftAccount
+from microsoft_auth.sync import apply_page, get_delta_url, sync_users
+
+from . import GraphServer, TestCase
+
+TENANT = "test_tenant"
+TOKEN_ROUTE = "POST /{}/oauth2/v2.0/token".format(TENANT)
+DELTA_ROUTE = "GET /v1.0/{}".format(get_delta_url())
+PAGE2_ROUTE = "GET /v1.0/users/delta?$skiptoken=page2"
+CHANGES_ROUTE = "GET /v1.0/users/delta?$deltatoken=one"
+
+
+class SyncTests(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.server = GraphServer()
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+        settings = override_settings(
+            MICROSOFT_AUTH_AUTHORITY=self.server.url,
+            MICROSOFT_AUTH_GRAPH_URL="{}/v1.0".format(self.server.url),
+            MICROSOFT_AUTH_TENANT_ID=TENANT,
+            MICROSOFT_AUTH_CLIENT_ID="client_id",
+            MICROSOFT_AUTH_CLIENT_SECRET="client_secret",
+            MICROSOFT_AUTH_HTTP_RETRIES=0,
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        # the retry setting is read when the adapter is created
+        transport.reset()
+        self.addCleanup(transport.reset)
+
+        User = get_user_model()
+        self.by_id = User.objects.create(username="by_id", email="old@example.com")
+        MicrosoftAccount.objects.create(
+            microsoft_id="sub1", object_id="oid1", user=self.by_id
+        )
+        self.by_email = User.objects.create(
+            username="by_email", email="user2@example.com"
+        )
+        self.disabled = User.objects.create(
+            username="disabled", email="user3@example.com"
+        )
+
+        self.server.routes = {
+            TOKEN_ROUTE: {"access_token": "test_token", "expires_in": 3600},
+            DELTA_ROUTE: {
+                "value": [
+                    {
+                        "id": "oid1",
+                        "givenName": "First",
+                        "surname": "Last",
+                        "mail": "user1@example.com",
+                        "accountEnabled": True,
+                    },
+                    {
+                        "id": "oid2",
+                        "displayName": "Second User",
+                        "mail": "user2@example.com",
+                        "accountEnabled": True,
+                    },
+                ],
+                "@odata.nextLink": self._link(PAGE2_ROUTE),
+            },
+            PAGE2_ROUTE: {
+                "value": [
+                    {
+                        "id": "oid3",
+                        "mail": "user3@example.com",
+                        "accountEnabled": False,
+                    },
+                    {"id": "oid4", "mail": "unknown@example.com"},
+                ],
+                "@odata.deltaLink": self._link(CHANGES_ROUTE),
+            },
+            CHANGES_ROUTE: {
+                "value": [{"id": "oid1", "@removed": {"reason": "changed"}}],
+                "@odata.deltaLink": self._link(CHANGES_ROUTE),
+            },
+        }
+
+    def _link(self, route):
+        return "{}{}".format(self.server.url, route.split(" ", 1)[1])
+
+    def _get_paths(self):
+        return [path for method, path, headers, body in self.server.requests]
+
+    def test_initial_sync(self):
+        stats = sync_users()
+
+        self.assertEqual(Counter(pages=2, updated=2, deactivated=1, unmatched=1), stats)
+
+        self.by_id.refresh_from_db()
+        self.assertEqual(
+            ("First", "Last", "user1@example.com"),
+            (self.by_id.first_name, self.by_id.last_name, self.by_id.email),
+        )
+        self.by_email.refresh_from_db()
+        self.assertEqual("Second", self.by_email.first_name)
+        self.disabled.refresh_from_db()
+        self.assertFalse(self.disabled.is_active)
+
+        state = DirectorySyncState.objects.get(tenant_id=TENANT)
+        self.assertEqual(self._link(CHANGES_ROUTE), state.delta_link)
+        self.assertEqual("", state.next_link)
+        self.assertIsNotNone(state.last_sync)
+
+    def test_token(self):
+        sync_users()
+
+        method, path, headers, body = self.server.requests[0]
+        self.assertEqual("/{}/oauth2/v2.0/token".format(TENANT), path)
+        self.assertIn("grant_type=client_credentials", body)
+        self.assertIn("client_id=client_id", body)
+        # one token for every page
+        self.assertEqual(1, self._get_paths().count(path))
+        self.assertEqual(
+            "Bearer test_token", self.server.requests[1][2]["Authorization"]
+        )
+
+    def test_delta_sync(self):
+        sync_users()
+        self.server.requests.clear()
+
+        stats = sync_users()
+
+        self.assertEqual([CHANGES_ROUTE.split(" ", 1)[1]], self._get_paths()[1:])
+        self.assertEqual(1, stats["deactivated"])
+        self.by_id.refresh_from_db()
+        self.assertFalse(self.by_id.is_active)
+
+    def test_delta_sync_enabled(self):
+        sync_users()
+        self.server.routes[CHANGES_ROUTE] = [
+            {
+                "value": [{"id": "oid1", "accountEnabled": False}],
+                "@odata.deltaLink": self._link(CHANGES_ROUTE),
+            },
+            {
+                "value": [{"id": "oid1", "accountEnabled": True}],
+                "@odata.deltaLink": self._link(CHANGES_ROUTE),
+            },
+        ]
+
+        stats = sync_users()
+
+        self.assertEqual(1, stats["deactivated"])
+        self.by_id.refresh_from_db()
+        self.assertFalse(self.by_id.is_active)
+
+        stats = sync_users()
+
+        self.assertEqual(Counter(pages=1, reactivated=1), stats)
+        self.by_id.refresh_from_db()
+        self.assertTrue(self.by_id.is_active)
+        # the other properties did not change
+        self.assertEqual("First", self.by_id.first_name)
+
+    def test_full_sync(self):
+        sync_users()
+        self.server.requests.clear()
+
+        sync_users(full=True)
+
+        self.assertEqual(DELTA_ROUTE.split(" ", 1)[1], self._get_paths()[1])
+
+    def test_interrupted(self):
+        self.server.routes[PAGE2_ROUTE] = [
+            (500, {"error": {"code": "generalException"}}),
+            self.server.routes[PAGE2_ROUTE],
+        ]
+
+        with self.assertRaises(requests.HTTPError):
+            sync_users()
+
+        # the first page was applied and the sync continues after it
+        state = DirectorySyncState.objects.get(tenant_id=TENANT)
+        self.assertEqual(self._link(PAGE2_ROUTE), state.next_link)
+        self.assertEqual("", state.delta_link)
+        self.by_id.refresh_from_db()
+        self.assertEqual("First", self.by_id.first_name)
+
+        self.server.requests.clear()
+        stats = sync_users()
+
+        self.assertEqual(PAGE2_ROUTE.split(" ", 1)[1], self._get_paths()[1])
+        self.assertEqual(1, stats["pages"])
+        state.refresh_from_db()
+        self.assertEqual(self._link(CHANGES_ROUTE), state.delta_link)
+
+    def test_delta_token_expired(self):
+        sync_users()
+        self.server.routes[CHANGES_ROUTE] = (
+            410,
+            {"error": {"code": "syncStateNotFound"}},
+        )
+        self.server.requests.clear()
+
+        stats = sync_users()
+
+        self.assertEqual(
+            [
+                CHANGES_ROUTE.split(" ", 1)[1],
+                DELTA_ROUTE.split(" ", 1)[1],
+                PAGE2_ROUTE.split(" ", 1)[1],
+            ],
+            self._get_paths()[1:],
+        )
+        self.assertEqual(2, stats["pages"])
+
+    def test_page_size(self):
+        sync_users(page_size=500)
+
+        self.assertEqual("odata.maxpagesize=500", self.server.requests[1][2]["Prefer"])
+
+    def test_apply_page_queries(self):
+        entries = self.server.routes[DELTA_ROUTE]["value"]
+
+        # accounts, users by email and one update, however big the page
+        with self.assertNumQueries(3):
+            apply_page(entries, Counter())
+
+    def test_command(self):
+        out = StringIO()
+        call_command("microsoft_auth_sync_users", stdout=out)
+
+        self.assertIn(
+            "Synced 2 page(s): 2 users updated, 1 deactivated, 0 reactivated, "
+            "1 not found",
+            out.getvalue(),
+        )
+
+    def test_command_error(self):
+        self.server.routes[DELTA_ROUTE] = (403, {"error": {"code": "forbidden"}})
+
+        with self.assertRaises(CommandError):
+            call_command("microsoft_auth_sync_users", stdout=StringIO())
+
+    @override_settings(MICROSOFT_AUTH_TENANT_ID="common")
+    def test_command_no_tenant(self):
+        with self.assertRaises(CommandError):
+            call_command("microsoft_auth_sync_users", stdout=StringIO())
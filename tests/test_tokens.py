@@ -0,0 +1,243 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import threading
+import time
+from unittest.mock import MagicMock, Mock, patch
+
+from cryptography.fernet import Fernet
+from django.contrib.auth import authenticate, get_user_model
+from django.db import connection
+from django.test import RequestFactory, override_settings
+from django.utils import timezone
+import requests
+
+from microsoft_auth import tokens, transport
+from microsoft_auth.models import MicrosoftAccount, MicrosoftToken
+from microsoft_auth.tokens import decrypt, encrypt, get_valid_token, save_token
+
+from . import GraphServer, TestCase, TransactionTestCase
+
+TOKEN = {
+    "access_token": "access1",
+    "refresh_token": "refresh1",
+    "expires_in": 3600,
+    "scope": ["User.Read", "offline_access"],
+}
+REFRESHED = {
+    "access_token": "access2",
+    "refresh_token": "refresh2",
+    "expires_in": 3600,
+    "scope": "User.Read offline_access",
+}
+TOKEN_ROUTE = "POST /token"
+BACKENDS = ["microsoft_auth.backends.MicrosoftAuthenticationBackend"]
+
+
+class TokenStoreMixin:
+    def setUp(self):
+        super().setUp()
+
+        self.server = GraphServer()
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.server.routes[TOKEN_ROUTE] = REFRESHED
+
+        settings = override_settings(
+            MICROSOFT_AUTH_CLIENT_ID="client_id",
+            MICROSOFT_AUTH_CLIENT_SECRET="client_secret",
+            MICROSOFT_AUTH_HTTP_RETRIES=0,
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        transport.reset()
+        self.addCleanup(transport.reset)
+
+        patcher = patch(
+            "microsoft_auth.tokens.get_openid_config",
+            return_value={"token_endpoint": "{}/token".format(self.server.url)},
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        User = get_user_model()
+        self.user = User.objects.create(username="user1", email="user1@example.com")
+        self.account = MicrosoftAccount.objects.create(
+            microsoft_id="test_id", user=self.user
+        )
+
+    def _expire(self):
+        MicrosoftToken.objects.update(expires_at=timezone.now())
+
+
+class TokenStoreTests(TokenStoreMixin, TestCase):
+    def test_encrypted(self):
+        stored = save_token(self.account, TOKEN)
+
+        self.assertNotIn("access1", stored.access_token)
+        self.assertNotIn("refresh1", stored.refresh_token)
+        self.assertEqual("access1", decrypt(stored.access_token))
+        self.assertEqual("User.Read offline_access", stored.scope)
+
+    def test_key_rotation(self):
+        old_key, new_key = Fernet.generate_key(), Fernet.generate_key()
+        with override_settings(MICROSOFT_AUTH_TOKEN_KEYS=[old_key]):
+            value = encrypt("secret")
+
+        with override_settings(MICROSOFT_AUTH_TOKEN_KEYS=[new_key, old_key]):
+            self.assertEqual("secret", decrypt(value))
+
+        with override_settings(MICROSOFT_AUTH_TOKEN_KEYS=[new_key]):
+            save_token(self.account, TOKEN)
+        with override_settings(MICROSOFT_AUTH_TOKEN_KEYS=[old_key]):
+            self.assertIsNone(get_valid_token(self.user))
+
+    def test_save_replaces(self):
+        save_token(self.account, TOKEN)
+        save_token(self.account, {"access_token": "access3", "expires_in": 60})
+
+        stored = MicrosoftToken.objects.get()
+        self.assertEqual("access3", decrypt(stored.access_token))
+        # no new refresh token, the old one still works
+        self.assertEqual("refresh1", decrypt(stored.refresh_token))
+
+    def test_expires_at(self):
+        expires_at = int(time.time()) + 100
+        stored = save_token(self.account, dict(TOKEN, expires_at=expires_at))
+
+        self.assertEqual(expires_at, stored.expires_at.timestamp())
+
+    def test_no_token(self):
+        self.assertIsNone(get_valid_token(self.user))
+
+    def test_valid(self):
+        save_token(self.account, TOKEN)
+
+        with self.assertNumQueries(1):
+            self.assertEqual("access1", get_valid_token(self.user))
+        self.assertEqual([], self.server.requests)
+
+    def test_refresh(self):
+        save_token(self.account, TOKEN)
+        self._expire()
+
+        self.assertEqual("access2", get_valid_token(self.user))
+
+        method, path, headers, body = self.server.requests[0]
+        self.assertIn("grant_type=refresh_token", body)
+        self.assertIn("refresh_token=refresh1", body)
+        self.assertIn("client_secret=client_secret", body)
+
+        stored = MicrosoftToken.objects.get()
+        self.assertEqual("refresh2", decrypt(stored.refresh_token))
+        self.assertGreater(stored.expires_at, timezone.now() + timedelta(minutes=30))
+
+        # refreshed once
+        self.assertEqual("access2", get_valid_token(self.user))
+        self.assertEqual(1, len(self.server.requests))
+
+    def test_lock_released(self):
+        save_token(self.account, TOKEN)
+        self._expire()
+
+        get_valid_token(self.user)
+
+        self.assertEqual(0, len(tokens._locks))
+
+    def test_refreshed_while_waiting(self):
+        save_token(self.account, TOKEN)
+        self._expire()
+
+        # another worker refreshes the token while this one waits for the
+        # lock
+        def _refreshed_by_other(*args):
+            save_token(self.account, dict(REFRESHED, access_token="other"))
+            return MagicMock()
+
+        with patch("microsoft_auth.tokens._get_lock", side_effect=_refreshed_by_other):
+            self.assertEqual("other", get_valid_token(self.user))
+        self.assertEqual([], self.server.requests)
+
+    def test_refresh_revoked(self):
+        save_token(self.account, TOKEN)
+        self._expire()
+        self.server.routes[TOKEN_ROUTE] = (400, {"error": "invalid_grant"})
+
+        self.assertIsNone(get_valid_token(self.user))
+        self.assertFalse(MicrosoftToken.objects.exists())
+
+    def test_refresh_error(self):
+        save_token(self.account, TOKEN)
+        self._expire()
+        self.server.routes[TOKEN_ROUTE] = (400, {"error": "invalid_scope"})
+
+        with self.assertRaises(requests.HTTPError):
+            get_valid_token(self.user)
+        # the refresh token may still be good
+        self.assertEqual(
+            "refresh1", decrypt(MicrosoftToken.objects.get().refresh_token)
+        )
+
+    def test_no_refresh_token(self):
+        save_token(self.account, {"access_token": "access1", "expires_in": 3600})
+        self._expire()
+
+        self.assertIsNone(get_valid_token(self.user))
+        self.assertEqual([], self.server.requests)
+
+    @override_settings(
+        AUTHENTICATION_BACKENDS=BACKENDS, MICROSOFT_AUTH_STORE_TOKENS=True
+    )
+    @patch("microsoft_auth.backends.MicrosoftClient")
+    def test_stored_on_login(self, mock_client):
+        mock_auth = Mock()
+        mock_auth.fetch_token.return_value = TOKEN
+        mock_auth.token = TOKEN
+        mock_auth.valid_scopes.return_value = True
+        mock_auth.get_claims.return_value = {
+            "sub": "test_id",
+            "email": "user1@example.com",
+            "preferred_username": "user1",
+        }
+        mock_client.return_value = mock_auth
+
+        user = authenticate(RequestFactory().get("/"), code="test_code")
+
+        self.assertEqual(self.user, user)
+        self.assertEqual("access1", get_valid_token(user))
+
+    @override_settings(AUTHENTICATION_BACKENDS=BACKENDS)
+    @patch("microsoft_auth.backends.MicrosoftClient")
+    def test_not_stored(self, mock_client):
+        mock_auth = Mock()
+        mock_auth.fetch_token.return_value = TOKEN
+        mock_auth.token = TOKEN
+        mock_auth.valid_scopes.return_value = True
+        mock_auth.get_claims.return_value = {"sub": "test_id"}
+        mock_client.return_value = mock_auth
+
+        user = authenticate(RequestFactory().get("/"), code="test_code")
+
+        self.assertEqual(self.user, user)
+        self.assertFalse(MicrosoftToken.objects.exists())
+
+
+class TokenStoreConcurrencyTests(TokenStoreMixin, TransactionTestCase):
+    def test_concurrent_refresh(self):
+        save_token(self.account, TOKEN)
+        self._expire()
+        workers = 8
+        barrier = threading.Barrier(workers)
+
+        def _get_token():
+            try:
+                barrier.wait()
+                return get_valid_token(self.user)
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(workers) as executor:
+            futures = [executor.submit(_get_token) for _ in range(workers)]
+            tokens = {future.result() for future in futures}
+
+        self.assertEqual({"access2"}, tokens)
+        self.assertEqual(1, len(self.server.requests))
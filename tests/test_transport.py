@@ -0,0 +1,96 @@
+from unittest.mock import Mock, patch
+
+from django.test import override_settings
+import requests
+from requests.adapters import HTTPAdapter
+
+from microsoft_auth import transport
+from microsoft_auth.client import MicrosoftClient
+
+from . import TestCase
+
+
+class TransportTests(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        transport.reset()
+        self.addCleanup(transport.reset)
+
+    def test_adapter_shared(self):
+        session1 = transport.mount(requests.Session())
+        session2 = transport.mount(requests.Session())
+
+        self.assertIs(
+            session1.get_adapter("https://login.microsoftonline.com"),
+            session2.get_adapter("https://user.auth.xboxlive.com"),
+        )
+
+    @override_settings(SITE_ID=1)
+    def test_client_uses_adapter(self):
+        auth_client = MicrosoftClient()
+
+        self.assertIs(
+            transport.get_adapter(),
+            auth_client.get_adapter("https://login.microsoftonline.com"),
+        )
+
+    def test_session_shared(self):
+        session = transport.get_session()
+
+        self.assertIs(session, transport.get_session())
+        self.assertIs(transport.get_adapter(), session.get_adapter("https://"))
+
+    @override_settings(MICROSOFT_AUTH_PROXIES={"all": "http://1.2.3.4:8080"})
+    def test_session_proxies(self):
+        self.assertEqual(
+            {"all": "http://1.2.3.4:8080"}, transport.get_session().proxies
+        )
+
+    def test_new_adapter_after_fork(self):
+        adapter = transport.get_adapter()
+        session = transport.get_session()
+
+        with patch("microsoft_auth.transport.os.getpid", return_value=-1):
+            self.assertIsNot(adapter, transport.get_adapter())
+            self.assertIsNot(session, transport.get_session())
+
+    @override_settings(
+        MICROSOFT_AUTH_HTTP_POOL_MAXSIZE=20,
+        MICROSOFT_AUTH_HTTP_CONNECT_TIMEOUT=1.0,
+        MICROSOFT_AUTH_HTTP_READ_TIMEOUT=2.0,
+        MICROSOFT_AUTH_HTTP_RETRIES=5,
+    )
+    def test_settings(self):
+        adapter = transport.get_adapter()
+
+        self.assertEqual(20, adapter._pool_maxsize)
+        self.assertEqual((1.0, 2.0), adapter.timeout)
+        self.assertEqual(5, adapter.max_retries.total)
+
+    def test_retry_idempotent_only(self):
+        retry = transport.get_adapter().max_retries
+
+        self.assertTrue(retry.is_retry("GET", 503))
+        self.assertTrue(retry.is_retry("GET", 429))
+        self.assertFalse(retry.is_retry("POST", 503))
+        self.assertFalse(retry.is_retry("GET", 404))
+
+    @patch.object(HTTPAdapter, "send")
+    def test_default_timeout(self, mock_send):
+        mock_send.return_value = Mock()
+        adapter = transport.get_adapter()
+
+        adapter.send(Mock())
+        self.assertEqual(adapter.timeout, mock_send.call_args[1]["timeout"])
+
+        adapter.send(Mock(), timeout=30)
+        self.assertEqual(30, mock_send.call_args[1]["timeout"])
+
+    def test_close_session_keeps_pools(self):
+        adapter = transport.get_adapter()
+        adapter.poolmanager.connection_from_url("https://login.microsoftonline.com")
+
+        transport.mount(requests.Session()).close()
+
+        self.assertEqual(1, len(adapter.poolmanager.pools))
@@ -1,9 +1,10 @@
+import importlib
 from unittest.mock import Mock, patch
 
 from django.test import RequestFactory, override_settings
 
 from microsoft_auth.conf import config
-from microsoft_auth.utils import get_hook, get_scheme
+from microsoft_auth.utils import get_hook, get_hooks, get_scheme
 
 from . import TestCase
 
@@ -53,3 +54,59 @@ class UtilsTests(TestCase):
         function = get_hook("MICROSOFT_AUTH_AUTHENTICATE_HOOK")
 
         self.assertEqual(function, mock_module.hook_callback)
+
+    @override_settings(
+        MICROSOFT_AUTH_CALLBACK_HOOK=(
+            "tests.test_utils.hook_callback, tests.test_utils.other_hook_callback"
+        )
+    )
+    def test_get_hooks_multiple(self):
+        self.assertEqual(
+            (hook_callback, other_hook_callback),
+            get_hooks("MICROSOFT_AUTH_CALLBACK_HOOK"),
+        )
+        self.assertEqual(hook_callback, get_hook("MICROSOFT_AUTH_CALLBACK_HOOK"))
+
+    def test_get_hooks_empty(self):
+        self.assertEqual((), get_hooks("MICROSOFT_AUTH_CALLBACK_HOOK"))
+        self.assertEqual((), get_hooks("NOT_A_REAL_HOOK"))
+
+    @override_settings(
+        MICROSOFT_AUTH_CALLBACK_HOOK=[
+            "tests.test_utils.hook_callback",
+            "tests.test_utils.other_hook_callback",
+        ]
+    )
+    def test_get_hooks_list(self):
+        self.assertEqual(
+            (hook_callback, other_hook_callback),
+            get_hooks("MICROSOFT_AUTH_CALLBACK_HOOK"),
+        )
+
+    @override_settings(MICROSOFT_AUTH_CALLBACK_HOOK="tests.test_utils.hook_callback")
+    @patch("microsoft_auth.utils.importlib", wraps=importlib)
+    def test_get_hooks_cached(self, mock_import):
+        hooks = get_hooks("MICROSOFT_AUTH_CALLBACK_HOOK")
+
+        self.assertIs(hooks, get_hooks("MICROSOFT_AUTH_CALLBACK_HOOK"))
+        mock_import.import_module.assert_called_once()
+
+    def test_get_hooks_config_reloaded(self):
+        self.assertEqual((), get_hooks("MICROSOFT_AUTH_CALLBACK_HOOK"))
+
+        with override_settings(
+            MICROSOFT_AUTH_CALLBACK_HOOK="tests.test_utils.hook_callback"
+        ):
+            self.assertEqual(
+                (hook_callback,), get_hooks("MICROSOFT_AUTH_CALLBACK_HOOK")
+            )
+
+        self.assertEqual((), get_hooks("MICROSOFT_AUTH_CALLBACK_HOOK"))
+
+
+def hook_callback(*args):
+    pass
+
+
+def other_hook_callback(*args):
+    pass
@@ -1,11 +1,21 @@
+import asyncio
 import json
-from unittest.mock import Mock, patch
+from unittest.mock import AsyncMock, Mock, patch
 
 from django.contrib.auth import get_user_model
+from django.contrib.auth.signals import user_login_failed
+from django.contrib.sessions.backends.db import SessionStore
 from django.core.signing import dumps
+from django.test import RequestFactory, override_settings
 from django.urls import reverse
 
-from microsoft_auth.views import AuthenticateCallbackView
+from microsoft_auth.conf import SimpleConfig
+from microsoft_auth.views import (
+    AsyncAuthenticateCallbackRedirect,
+    AsyncAuthenticateCallbackView,
+    AuthenticateCallbackView,
+    _aauthenticate,
+)
 
 from . import TestCase
 
@@ -201,15 +211,15 @@ class ViewsTests(TestCase):
 
     @patch("microsoft_auth.views.authenticate")
     @patch("microsoft_auth.views.login")
-    @patch("microsoft_auth.views.get_hook")
-    def test_callback_hook(self, mock_get_hook, mock_login, mock_auth):
+    @patch("microsoft_auth.views.get_hooks")
+    def test_callback_hook(self, mock_get_hooks, mock_login, mock_auth):
         def callback(request, context):
             return context
 
         mock_auth.return_value = self.user
 
         mock_hook = Mock(side_effect=callback)
-        mock_get_hook.return_value = mock_hook
+        mock_get_hooks.return_value = (mock_hook,)
 
         response = self.client.post(
             reverse("microsoft_auth:auth-callback"),
@@ -229,3 +239,143 @@ class ViewsTests(TestCase):
         )
 
         self.assertEqual(302, response.status_code)
+
+
+class AsyncViewsTests(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        User = get_user_model()
+
+        self.user = User.objects.create(username="test")
+        self.factory = RequestFactory()
+
+    def _get_request(self, url_name, data):
+        request = self.factory.post(reverse(url_name), data)
+        request.session = SessionStore()
+        return request
+
+    @patch("microsoft_auth.views.alogin", new_callable=AsyncMock)
+    @patch("microsoft_auth.views.aauthenticate", new_callable=AsyncMock)
+    async def test_authenticate_callback_success(self, mock_auth, mock_login):
+        mock_auth.return_value = self.user
+        request = self._get_request(
+            "microsoft_auth:auth-callback", {"state": STATE, "code": "test_code"}
+        )
+
+        response = await AsyncAuthenticateCallbackView.as_view()(request)
+
+        self.assertEqual(200, response.status_code)
+        self.assertIn(b'{"microsoft_auth": {}}', response.content)
+        mock_auth.assert_awaited_once_with(request, code="test_code")
+        mock_login.assert_awaited_once_with(request, self.user)
+
+    @patch("microsoft_auth.views.aauthenticate", new_callable=AsyncMock)
+    async def test_authenticate_callback_fail_auth(self, mock_auth):
+        mock_auth.return_value = None
+        request = self._get_request(
+            "microsoft_auth:auth-callback", {"state": STATE, "code": "test_code"}
+        )
+
+        response = await AsyncAuthenticateCallbackView.as_view()(request)
+
+        self.assertEqual(400, response.status_code)
+        self.assertIn(b"login_failed", response.content)
+
+    @patch("microsoft_auth.views.aauthenticate", new_callable=AsyncMock)
+    async def test_authenticate_callback_config_in_thread(self, mock_auth):
+        def is_expired(config):
+            # reloading could query constance, not on the event loop
+            with self.assertRaises(RuntimeError):
+                asyncio.get_running_loop()
+            return True
+
+        mock_auth.return_value = None
+        request = self._get_request(
+            "microsoft_auth:auth-callback", {"state": STATE, "code": "test_code"}
+        )
+
+        with patch.object(
+            SimpleConfig, "_is_expired", autospec=True, side_effect=is_expired
+        ) as mock_expired:
+            response = await AsyncAuthenticateCallbackView.as_view()(request)
+
+        self.assertIn(b"login_failed", response.content)
+        mock_expired.assert_called()
+
+    async def test_authenticate_callback_bad_state(self):
+        request = self._get_request(
+            "microsoft_auth:auth-callback", {"state": STATE[:-1]}
+        )
+
+        response = await AsyncAuthenticateCallbackView.as_view()(request)
+
+        self.assertEqual(400, response.status_code)
+        self.assertIn(b"bad_state", response.content)
+
+    @patch("microsoft_auth.views.alogin", new_callable=AsyncMock)
+    @patch("microsoft_auth.views.aauthenticate", new_callable=AsyncMock)
+    async def test_authenticate_callback_redirect_next_path(
+        self, mock_auth, mock_login
+    ):
+        mock_auth.return_value = self.user
+        state = dumps({"token": TOKEN, "next": "/next/path"}, salt="microsoft_auth")
+        request = self._get_request(
+            "microsoft_auth:from-auth-redirect", {"state": state, "code": "test_code"}
+        )
+
+        response = await AsyncAuthenticateCallbackRedirect.as_view()(request)
+
+        self.assertEqual(302, response.status_code)
+        self.assertEqual("/next/path", response.url)
+
+
+@override_settings(
+    AUTHENTICATION_BACKENDS=[
+        "django.contrib.auth.backends.ModelBackend",
+        "microsoft_auth.backends.MicrosoftAuthenticationBackend",
+    ]
+)
+class AsyncAuthenticateTests(TestCase):
+    def setUp(self):
+        super().setUp()
+
+        User = get_user_model()
+
+        self.user = User.objects.create(username="test")
+        self.request = RequestFactory().post("/")
+
+    @patch(
+        "microsoft_auth.backends.MicrosoftAuthenticationBackend.authenticate",
+        side_effect=AssertionError("sync authenticate called"),
+    )
+    @patch(
+        "microsoft_auth.backends.MicrosoftAuthenticationBackend.aauthenticate",
+        new_callable=AsyncMock,
+    )
+    async def test_backend_aauthenticate(self, mock_aauthenticate, mock_authenticate):
+        mock_aauthenticate.return_value = self.user
+
+        user = await _aauthenticate(self.request, code="test_code")
+
+        self.assertEqual(self.user, user)
+        self.assertEqual(
+            "microsoft_auth.backends.MicrosoftAuthenticationBackend", user.backend
+        )
+        mock_aauthenticate.assert_awaited_once_with(self.request, code="test_code")
+
+    @patch(
+        "microsoft_auth.backends.MicrosoftAuthenticationBackend.aauthenticate",
+        new_callable=AsyncMock,
+    )
+    async def test_login_failed(self, mock_aauthenticate):
+        mock_aauthenticate.return_value = None
+        receiver = Mock()
+        user_login_failed.connect(receiver)
+        self.addCleanup(user_login_failed.disconnect, receiver)
+
+        user = await _aauthenticate(self.request, code="test_code")
+
+        self.assertIsNone(user)
+        receiver.assert_called_once()
+        self.assertEqual({"code": "test_code"}, receiver.call_args[1]["credentials"])
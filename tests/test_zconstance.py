@@ -35,6 +35,23 @@ class ConstanceTests(TestCase):
         with self.assertRaises(AttributeError):
             config.NOT_A_REAL_SETTING
 
+    @patch("constance.base.settings.CONFIG", DEFAULT_CONFIG["defaults"])
+    def test_config_constance_mget(self):
+        from constance import config as constance_config
+        from microsoft_auth.conf import config, init_config
+
+        init_config()
+        constance_config.MICROSOFT_AUTH_CLIENT_ID = "test"
+
+        backend = constance_config._backend
+        with patch.object(backend, "mget", wraps=backend.mget) as mock_mget:
+            with patch.object(backend, "get") as mock_get:
+                self.assertEqual("test", config.MICROSOFT_AUTH_CLIENT_ID)
+                self.assertEqual("", config.MICROSOFT_AUTH_CLIENT_SECRET)
+
+            mock_mget.assert_called_once()
+            mock_get.assert_not_called()
+
 
 @modify_settings(
     INSTALLED_APPS={"prepend": ["constance", "constance.backends.database"]}